@@ -2,17 +2,69 @@ import base64
 
 from flask import Blueprint, jsonify, request
 
+from batch import run_batch
 from bookmarks import list_bookmarks, save_bookmark, delete_bookmark
-from files import list_files, delete_file, move_file_for, rename_file_title, toggle_favorite
+from files import delete_file, move_file_for, rename_file_title, toggle_favorite
 from globals import ServerResponse
+from governor import governor_status
+from jobs import job_status, cancel_job, cancel_run
+from listing import ListQuery, query_files, DEFAULT_PAGE_SIZE, list_changes, library_snapshot
 from onlines import list_onlines, delete_online
+from payload import json_payload_response
+from search import search_library, DEFAULT_SEARCH_LIMIT
 from similar import find_similar, find_duplicates
 
 api_bp = Blueprint('api', __name__)
 
+def _bool_arg(name):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    return value.lower() in ('1', 'true', 'yes')
+
 @api_bp.route('/api/list')
 def get_files():
-    return jsonify(list_files())
+    # without query parameters the full list is returned
+    if not request.args:
+        files, generation = library_snapshot()
+        response = json_payload_response('list', (files,), lambda: files, etag=f"list-{generation}")
+        response.headers['X-Library-Generation'] = str(generation)
+        return response
+
+    try:
+        query = ListQuery(
+            folder=request.args.get('folder'),
+            favorite=_bool_arg('favorite'),
+            partial=_bool_arg('partial'),
+            failed=_bool_arg('failed'),
+            resolution=request.args.get('resolution', type=int),
+            stereo=request.args.get('stereo') or None,
+            title=request.args.get('q') or None,
+            sort=request.args.get('sort', 'created'),
+            descending=request.args.get('order', 'desc') != 'asc',
+            cursor=request.args.get('cursor') or None,
+            limit=request.args.get('limit', DEFAULT_PAGE_SIZE, type=int),
+        )
+        return jsonify(query_files(query))
+    except ValueError as e:
+        return jsonify(ServerResponse(False, str(e))), 400
+
+@api_bp.route('/api/list/changes')
+def get_file_changes():
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify(ServerResponse(False, "No generation provided")), 400
+    return jsonify(list_changes(since))
+
+@api_bp.route('/api/search')
+def search():
+    try:
+        results = search_library(request.args.get('q', ''),
+                                 limit=request.args.get('limit', DEFAULT_SEARCH_LIMIT, type=int),
+                                 kind=request.args.get('kind') or None)
+    except ValueError as e:
+        return jsonify(ServerResponse(False, str(e))), 400
+    return jsonify({'items': results})
 
 @api_bp.route('/api/move_file', methods=['POST'])
 def mf():
@@ -25,6 +77,34 @@ def mf():
 
     return jsonify(move_file_for(video_path, subfolder))
 
+@api_bp.route('/api/batch', methods=['POST'])
+def batch():
+    data = request.get_json(silent=True) or {}
+    result = run_batch(data.get("operations"))
+    if not result['results']:
+        return jsonify(result), 400
+    return jsonify(result)
+
+@api_bp.route('/api/jobs', methods=['GET'])
+def jobs():
+    return jsonify(job_status())
+
+@api_bp.route('/api/governor', methods=['GET'])
+def governor():
+    return jsonify(governor_status())
+
+@api_bp.route('/api/jobs/cancel', methods=['POST'])
+def cancel_jobs():
+    data = request.get_json(silent=True) or {}
+    if data.get("job_id") is not None:
+        if not cancel_job(int(data["job_id"])):
+            return jsonify(ServerResponse(False, "Job not found or already finished")), 404
+        return jsonify(ServerResponse(True, "Job cancelled"))
+    if data.get("run_id") is None and not data.get("all"):
+        return jsonify(ServerResponse(False, "No job_id, run_id or all provided")), 400
+    cancelled = cancel_run(None if data.get("all") else int(data["run_id"]))
+    return jsonify(ServerResponse(True, f"{cancelled} jobs cancelled"))
+
 @api_bp.route('/api/rename', methods=['POST'])
 def rf():
     data = request.get_json()
@@ -94,7 +174,8 @@ def dupl():
 
 @api_bp.route('/api/onlines', methods=['GET'])
 def lo():
-    return jsonify(list_onlines())
+    onlines = list_onlines()
+    return json_payload_response('onlines', (onlines,), lambda: onlines)
 
 @api_bp.route('/api/onlines', methods=['DELETE'])
 def do():
@@ -0,0 +1,101 @@
+import time
+from typing import Callable, Optional
+
+from loguru import logger
+
+from bus import push_text_to_client, suppress_client_messages
+from files import move_file_for, delete_file, set_favorite, rename_file_title, deferred_invalidation
+from globals import ServerResponse
+from jobs import JobRun, close_run
+from thumbnail import create_thumbnail_run, schedule_thumbnail_for_path
+
+MAX_BATCH_SIZE = 1000
+PROGRESS_INTERVAL = 1.0     # seconds between two progress messages
+
+
+# operation name -> (required parameters, handler called with the operation and the run of the batch jobs)
+# generate_thumbnail only schedules a job on the worker pool - the files are invalidated when the job is done
+OPERATIONS: dict[str, tuple[tuple[str, ...], Callable[[dict, JobRun], ServerResponse]]] = {
+    'move': (('video_path',), lambda o, run: move_file_for(o['video_path'], o.get('subfolder', ''))),
+    'delete': (('url',), lambda o, run: delete_file(o['url'])),
+    'favorite': (('video_path',), lambda o, run: set_favorite(o['video_path'], o.get('favorite'))),
+    'rename': (('video_path', 'title'), lambda o, run: rename_file_title(o['video_path'], o['title'])),
+    'generate_thumbnail': (('video_path',), lambda o, run: schedule_thumbnail_for_path(o['video_path'], run)),
+}
+
+# operations that only schedule jobs - a run is created for them
+JOB_OPERATIONS = {'generate_thumbnail'}
+
+
+def _run_operation(operation, run: Optional[JobRun]) -> ServerResponse:
+    if not isinstance(operation, dict):
+        return ServerResponse(False, "Operation must be an object")
+    name = operation.get('op')
+    if name not in OPERATIONS:
+        return ServerResponse(False, f"Unknown operation: {name}")
+    required, handler = OPERATIONS[name]
+    missing = [param for param in required if not operation.get(param)]
+    if missing:
+        return ServerResponse(False, f"Missing parameters for {name}: {', '.join(missing)}")
+    return handler(operation, run)
+
+
+def run_batch(operations: list) -> dict:
+    """
+    Run a list of file operations (move, delete, favorite, rename, generate_thumbnail) in one go, in request order.
+    Every operation commits its own database changes right after its file changes - a failing operation
+    only rolls back its own changes and no write lock is held while files are moved.
+    Thumbnail generations are scheduled on the job workers in one run and not waited for,
+    the run id is returned to follow them with /api/jobs.
+    The file list cache is cleared once at the end and instead of the messages of every single operation
+    a summarized progress is sent to the clients.
+    A failing operation does not stop the batch, the result for every operation is returned.
+
+    Example operation: {"op": "move", "video_path": "/static/videos/direct/a.mp4", "subfolder": "vr"}
+
+    :param operations: list of operation dicts with op and the parameters of the single file api
+    :return: dict with success, message, one result per operation (same order) and the run id of scheduled jobs or None
+    """
+    if not isinstance(operations, list) or not operations:
+        return {'success': False, 'message': "No operations provided", 'results': [], 'run': None}
+    if len(operations) > MAX_BATCH_SIZE:
+        return {'success': False, 'message': f"Too many operations (max {MAX_BATCH_SIZE})", 'results': [], 'run': None}
+
+    total = len(operations)
+    results: list[dict] = [None] * total
+    push_text_to_client(f"Batch started: {total} operations")
+    run_needed = any(isinstance(operation, dict) and operation.get('op') in JOB_OPERATIONS for operation in operations)
+    job_run = create_thumbnail_run("Batch thumbnails") if run_needed else None
+    last_progress = time.monotonic()
+    done = 0
+
+    def run(index: int) -> None:
+        nonlocal last_progress, done
+        operation = operations[index]
+        try:
+            with suppress_client_messages():
+                result = _run_operation(operation, job_run)
+        except Exception as e:
+            logger.exception(f"Batch operation failed: {operation}")
+            result = ServerResponse(False, f"Operation failed: {e}")
+        results[index] = {'success': result.success, 'message': result.message}
+        done += 1
+        if time.monotonic() - last_progress >= PROGRESS_INTERVAL and done < total:
+            push_text_to_client(f"Batch progress: {done}/{total} operations done")
+            last_progress = time.monotonic()
+
+    try:
+        with deferred_invalidation():
+            for index in range(total):
+                run(index)
+    finally:
+        if job_run:
+            close_run(job_run)
+
+    failed = sum(1 for result in results if not result['success'])
+    message = f"Batch finished: {total - failed} succeeded, {failed} failed"
+    if job_run and job_run.total:
+        message += f" - {job_run.total} thumbnail jobs scheduled (run {job_run.id})"
+    push_text_to_client(message)
+    return {'success': failed == 0, 'message': message, 'results': results,
+            'run': job_run.id if job_run and job_run.total else None}
@@ -1,4 +1,5 @@
 from collections import deque
+from contextlib import contextmanager
 from queue import Queue, Empty
 import threading
 from loguru import logger
@@ -6,6 +7,7 @@ import time
 
 clients = []
 last_sse_messages = deque(maxlen=10)
+_suppressed = threading.local()
 
 def get_clients():
     return clients
@@ -25,9 +27,24 @@ def clean_client_task():
 def push_text_to_client(txt):
     global last_sse_messages
     logger.debug(f"{txt}")
+    if getattr(_suppressed, 'active', False):
+        return
     broadcast_message(txt)
     last_sse_messages.append(txt)
 
+@contextmanager
+def suppress_client_messages():
+    """
+    Do not send messages pushed by the current thread to the clients (they are still logged)
+    Used by bulk operations that send their own summarized progress
+    """
+    previous = getattr(_suppressed, 'active', False)
+    _suppressed.active = True
+    try:
+        yield
+    finally:
+        _suppressed.active = previous
+
 def broadcast_message(message):
     for client_queue, stop_event in clients:
         client_queue.put(message)
@@ -0,0 +1,368 @@
+import json
+import os
+import threading
+from typing import NamedTuple, Callable, Optional
+
+from loguru import logger
+
+from database.search_table_functions import VIDEO
+from database.video_database import get_video_db
+from traversal import walk_directories
+
+
+class CatalogEntry(NamedTuple):
+    path: str
+    directory: str
+    size: int
+    mtime: int
+    inode: int
+    details: dict
+
+
+class CatalogDir(NamedTuple):
+    path: str
+    mtime: int
+    subdirs: tuple
+
+
+class CatalogChanges(NamedTuple):
+    added: list[CatalogEntry]
+    changed: list[CatalogEntry]
+    removed: list[CatalogEntry]
+    directories_changed: bool
+
+
+# extractor is called with (root, filename, stat) and returns the file details dict or an empty dict if not possible
+# an optional prepare attribute of the extractor is called with all paths of a refresh before they are extracted
+# (e.g. to probe them concurrently)
+Extractor = Callable[[str, str, os.stat_result], dict]
+
+_lock = threading.RLock()
+_entries: Optional[dict[str, CatalogEntry]] = None
+_directories: dict[str, CatalogDir] = {}
+_by_directory: dict[str, set[str]] = {}
+_dirty: set[str] = set()
+_watched_roots: set[str] = set()
+
+
+def is_ignored_file(filename: str) -> bool:
+    """
+    Check if a file should never show up in the catalog (download fragments and yt-dlp state files)
+
+    :param filename: name of the file
+    :return: True if the file is ignored
+    """
+    return 'part-Frag' in filename or filename.endswith('.ytdl')
+
+
+def _load_catalog() -> None:
+    global _entries
+    if _entries is not None:
+        return
+
+    entries = {}
+    directories = {}
+    by_directory = {}
+    with get_video_db() as db:
+        for row in db.for_catalog_table.list_entries():
+            try:
+                details = json.loads(row.details) if row.details else {}
+            except ValueError:
+                continue
+            entries[row.path] = CatalogEntry(row.path, row.directory, row.size, row.mtime, row.inode, details)
+            by_directory.setdefault(row.directory, set()).add(row.path)
+        for row in db.for_catalog_table.list_directories():
+            subdirs = tuple(json.loads(row.subdirs)) if row.subdirs else ()
+            directories[row.path] = CatalogDir(row.path, row.mtime, subdirs)
+
+    _directories.clear()
+    _directories.update(directories)
+    _by_directory.clear()
+    _by_directory.update(by_directory)
+    _entries = entries
+    logger.debug(f"Catalog loaded with {len(entries)} entries and {len(directories)} directories")
+
+
+def is_cataloged(path: str) -> bool:
+    """
+    :param path: full file path
+    :return: True if the file is a known entry of the catalog
+    """
+    if _entries is None:
+        with _lock:
+            _load_catalog()
+    return os.path.normpath(path) in _entries
+
+
+def invalidate_catalog_entry(*paths: str) -> None:
+    """
+    Mark catalog entries as dirty, the details for them are re-extracted on the next refresh
+    even if the file fingerprint (size, mtime, inode) did not change.
+    Used when sidecar information like thumbnails, title or favorite changed.
+
+    :param paths: full file paths to invalidate
+    """
+    with _lock:
+        _dirty.update(os.path.normpath(path) for path in paths if path)
+
+
+def set_catalog_watched(root: str, watched: bool) -> None:
+    """
+    Mark a root as watched - changes below it are reported by a watcher via update_catalog_paths,
+    so refresh_catalog does not need to check the directories for changes.
+
+    :param root: root directory
+    :param watched: True if a watcher keeps the catalog for the root up to date
+    """
+    root = os.path.normpath(root)
+    with _lock:
+        if watched:
+            _watched_roots.add(root)
+        else:
+            _watched_roots.discard(root)
+
+
+def _is_below(path: str, root: str) -> bool:
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+class _Refresh:
+    """
+    Bookkeeping for one catalog refresh - collects changes to be persisted at the end
+    """
+    def __init__(self, extract: Extractor):
+        self.extract = extract
+        self.added: dict[str, CatalogEntry] = {}
+        self.changed: dict[str, CatalogEntry] = {}
+        self.removed: dict[str, CatalogEntry] = {}
+        self.stored_dirs: dict[str, CatalogDir] = {}
+        self.removed_dirs: set[str] = set()
+        self.directories_changed = False
+        self.pending: dict[str, tuple[str, os.stat_result]] = {}
+
+    def update_file(self, path: str, directory: str, stat: Optional[os.stat_result]) -> None:
+        existing = _entries.get(path)
+        if stat is None:
+            self.remove_file(path)
+            return
+
+        fingerprint = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        if existing and path not in _dirty and (existing.size, existing.mtime, existing.inode) == fingerprint:
+            return
+        # extracted together in extract_pending
+        self.pending[path] = (directory, stat)
+
+    def extract_pending(self) -> None:
+        if not self.pending:
+            return
+        prepare = getattr(self.extract, 'prepare', None)
+        if prepare:
+            prepare(list(self.pending))
+        pending, self.pending = self.pending, {}
+        for path, (directory, stat) in pending.items():
+            self._extract_file(path, directory, stat)
+
+    def _extract_file(self, path: str, directory: str, stat: os.stat_result) -> None:
+        existing = _entries.get(path)
+        fingerprint = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        details = self.extract(directory, os.path.basename(path), stat)
+        _dirty.discard(path)
+        if not details:
+            self.remove_file(path)
+            return
+
+        entry = CatalogEntry(path, directory, *fingerprint, details)
+        _entries[path] = entry
+        _by_directory.setdefault(directory, set()).add(path)
+        if existing is None and path not in self.changed:
+            self.added[path] = entry
+        else:
+            self.changed[path] = entry
+            self.added.pop(path, None)
+        self.removed.pop(path, None)
+
+    def remove_file(self, path: str) -> None:
+        self.pending.pop(path, None)
+        entry = _entries.pop(path, None)
+        _dirty.discard(path)
+        if entry:
+            paths = _by_directory.get(entry.directory)
+            if paths:
+                paths.discard(path)
+            self.removed[path] = entry
+            self.added.pop(path, None)
+            self.changed.pop(path, None)
+
+    def store_directory(self, directory: str, mtime: int, subdirs: list[str]) -> None:
+        known = _directories.get(directory)
+        if known is None or set(known.subdirs) != set(subdirs):
+            self.directories_changed = True
+        catalog_dir = CatalogDir(directory, mtime, tuple(subdirs))
+        _directories[directory] = catalog_dir
+        self.stored_dirs[directory] = catalog_dir
+
+    def remove_directory(self, directory: str) -> None:
+        for path in list(_by_directory.get(directory, ())):
+            self.remove_file(path)
+        _by_directory.pop(directory, None)
+        if _directories.pop(directory, None):
+            self.directories_changed = True
+        self.stored_dirs.pop(directory, None)
+        self.removed_dirs.add(directory)
+
+    def changes(self) -> CatalogChanges:
+        return CatalogChanges(list(self.added.values()), list(self.changed.values()),
+                              list(self.removed.values()), self.directories_changed)
+
+    def persist(self) -> None:
+        self.extract_pending()
+        stored_entries = list(self.added.values()) + list(self.changed.values())
+        if not (stored_entries or self.removed or self.stored_dirs or self.removed_dirs):
+            return
+        with get_video_db() as db:
+            db.for_catalog_table.delete_entries(list(self.removed))
+            db.for_catalog_table.delete_directories(list(self.removed_dirs))
+            db.for_catalog_table.store_entries([
+                {'path': e.path, 'directory': e.directory, 'size': e.size, 'mtime': e.mtime,
+                 'inode': e.inode, 'details': json.dumps(e.details, ensure_ascii=False)}
+                for e in stored_entries
+            ])
+            db.for_catalog_table.store_directories([
+                {'path': d.path, 'mtime': d.mtime, 'subdirs': json.dumps(list(d.subdirs), ensure_ascii=False)}
+                for d in self.stored_dirs.values()
+            ])
+            # keep the full text search index in step with the catalog
+            db.for_search_table.delete_documents(VIDEO, [e.details['filename'] for e in self.removed.values()
+                                                         if e.details.get('filename')])
+            db.for_search_table.store_videos([e.details for e in stored_entries])
+        logger.debug(f"Catalog persisted - added: {len(self.added)} changed: {len(self.changed)} removed: {len(self.removed)} "
+                     f"dirs stored: {len(self.stored_dirs)} dirs removed: {len(self.removed_dirs)}")
+
+
+def _stat_or_none(path: str) -> Optional[os.stat_result]:
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def _refresh_tree(refresh: _Refresh, root: str) -> None:
+    def reuse(directory: str, stat: os.stat_result):
+        known = _directories.get(directory)
+        if known and known.mtime == stat.st_mtime_ns:
+            return known.subdirs
+        return None
+
+    visited = set()
+    for record in walk_directories(root, reuse=reuse):
+        directory = record.path
+        visited.add(directory)
+
+        if record.files is None:
+            # directory content unchanged - only check invalidated and still growing (partial) files
+            for path in list(_by_directory.get(directory, ())):
+                if path in _dirty or _entries[path].details.get('partial'):
+                    refresh.update_file(path, directory, _stat_or_none(path))
+            continue
+
+        files = {file.path: file for file in record.files if not is_ignored_file(file.name)}
+        for path, file in files.items():
+            refresh.update_file(path, directory, file.stat)
+        for path in _by_directory.get(directory, set()) - files.keys():
+            refresh.remove_file(path)
+        refresh.store_directory(directory, record.stat.st_mtime_ns, record.subdirs)
+
+    # directories that vanished below root
+    vanished = {d for d in _directories if _is_below(d, root)} | {d for d in _by_directory if _is_below(d, root)}
+    for directory in vanished - visited:
+        refresh.remove_directory(directory)
+
+
+def _refresh_dirty(refresh: _Refresh, root: str) -> None:
+    for path in [p for p in _dirty if _is_below(p, root)]:
+        entry = _entries.get(path)
+        if entry:
+            refresh.update_file(path, entry.directory, _stat_or_none(path))
+        else:
+            _dirty.discard(path)
+    for directory, paths in _by_directory.items():
+        if _is_below(directory, root):
+            for path in [p for p in paths if _entries[p].details.get('partial')]:
+                refresh.update_file(path, directory, _stat_or_none(path))
+
+
+def _entries_below(root: str) -> list[dict]:
+    return [_entries[path].details
+            for directory, paths in _by_directory.items() if _is_below(directory, root)
+            for path in paths]
+
+
+def refresh_catalog(root: str, extract: Extractor) -> list[dict]:
+    """
+    Refresh the catalog below the given root directory and return the details of all files below it.
+
+    Only directories with a changed mtime are listed again, files are only re-extracted
+    if their fingerprint (size, mtime, inode) changed or they were invalidated.
+    Directories starting with a dot are skipped.
+    For watched roots only invalidated and partial files are checked.
+
+    :param root: root directory to refresh
+    :param extract: function to extract the details for a file (root, filename, stat)
+    :return: list of file details dicts - shared with the catalog, copy before modifying
+    """
+    root = os.path.normpath(root)
+    with _lock:
+        _load_catalog()
+        refresh = _Refresh(extract)
+        if root in _watched_roots and root in _directories:
+            _refresh_dirty(refresh, root)
+        else:
+            _refresh_tree(refresh, root)
+        refresh.persist()
+        return _entries_below(root)
+
+
+def sync_catalog(root: str, extract: Extractor) -> CatalogChanges:
+    """
+    Check all directories below root for changes and report them
+
+    :param root: root directory to check
+    :param extract: function to extract the details for a file (root, filename, stat)
+    :return: changes found
+    """
+    root = os.path.normpath(root)
+    with _lock:
+        _load_catalog()
+        refresh = _Refresh(extract)
+        _refresh_tree(refresh, root)
+        refresh.persist()
+        return refresh.changes()
+
+
+def update_catalog_paths(paths: set[str], extract: Extractor) -> CatalogChanges:
+    """
+    Update the catalog for single files or directories that are known to have changed.
+    Directories are refreshed including all their sub folders, vanished paths are removed.
+
+    :param paths: full paths of changed files or directories
+    :param extract: function to extract the details for a file (root, filename, stat)
+    :return: changes found
+    """
+    with _lock:
+        _load_catalog()
+        refresh = _Refresh(extract)
+        for path in sorted(os.path.normpath(p) for p in paths):
+            name = os.path.basename(path)
+            stat = _stat_or_none(path)
+            if stat is None:
+                # vanished file or directory (including all sub folders)
+                refresh.remove_file(path)
+                for directory in [d for d in set(_directories) | set(_by_directory) if _is_below(d, path)]:
+                    refresh.remove_directory(directory)
+            elif os.path.isdir(path):
+                if not name.startswith('.'):
+                    _refresh_tree(refresh, path)
+            elif not is_ignored_file(name):
+                refresh.update_file(path, os.path.dirname(path), stat)
+        refresh.persist()
+        return refresh.changes()
@@ -0,0 +1,59 @@
+from typing import List
+
+from sqlalchemy import insert
+
+from .video_models import Catalog, CatalogDirectory
+
+# sqlite has a limit on bound parameters per statement, work in chunks
+CHUNK_SIZE = 500
+
+
+class ForCatalog:
+    def __init__(self, db):
+        self.db = db
+
+    def list_entries(self) -> List[Catalog]:
+        session = self.db.get_session()
+        return session.query(Catalog).all()
+
+    def list_directories(self) -> List[CatalogDirectory]:
+        session = self.db.get_session()
+        return session.query(CatalogDirectory).all()
+
+    def store_entries(self, entries: list[dict]) -> None:
+        """
+        Insert or replace catalog entries in bulk
+
+        :param entries: list of dicts with path, directory, size, mtime, inode and details
+        """
+        if not entries:
+            return
+        self.delete_entries([entry['path'] for entry in entries])
+        session = self.db.get_session()
+        for i in range(0, len(entries), CHUNK_SIZE):
+            session.execute(insert(Catalog), entries[i:i + CHUNK_SIZE])
+
+    def delete_entries(self, paths: list[str]) -> None:
+        session = self.db.get_session()
+        for i in range(0, len(paths), CHUNK_SIZE):
+            chunk = paths[i:i + CHUNK_SIZE]
+            session.query(Catalog).filter(Catalog.path.in_(chunk)).delete(synchronize_session=False)
+
+    def store_directories(self, directories: list[dict]) -> None:
+        """
+        Insert or replace catalog directories in bulk
+
+        :param directories: list of dicts with path, mtime and subdirs
+        """
+        if not directories:
+            return
+        self.delete_directories([directory['path'] for directory in directories])
+        session = self.db.get_session()
+        for i in range(0, len(directories), CHUNK_SIZE):
+            session.execute(insert(CatalogDirectory), directories[i:i + CHUNK_SIZE])
+
+    def delete_directories(self, paths: list[str]) -> None:
+        session = self.db.get_session()
+        for i in range(0, len(paths), CHUNK_SIZE):
+            chunk = paths[i:i + CHUNK_SIZE]
+            session.query(CatalogDirectory).filter(CatalogDirectory.path.in_(chunk)).delete(synchronize_session=False)
@@ -1,3 +1,5 @@
+import threading
+
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, Session
 
@@ -25,13 +27,29 @@ class Database:
     The __enter__ and __exit__ methods allow the database to be used as a context manager
     The new_session method creates a new session
     The get_session method returns the current session or creates a new one if needed
+    Sessions are kept per thread, background workers do not share a session with request threads
     """
     def __init__(self, db_path):
         self.db_path = db_path
-        self.engine = create_engine(f'sqlite:///{db_path}')
+        self.engine = create_engine(f'sqlite:///{db_path}', connect_args={'timeout': 30})
         self.SessionMaker = sessionmaker(bind=self.engine)
-        self.session: Session | None = None
-        self._enter_count = 0
+        self._local = threading.local()
+
+    @property
+    def session(self) -> Session | None:
+        return getattr(self._local, 'session', None)
+
+    @session.setter
+    def session(self, session: Session | None) -> None:
+        self._local.session = session
+
+    @property
+    def _enter_count(self) -> int:
+        return getattr(self._local, 'enter_count', 0)
+
+    @_enter_count.setter
+    def _enter_count(self, count: int) -> None:
+        self._local.enter_count = count
 
     def __enter__(self):
         if self.session is None:
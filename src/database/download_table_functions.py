@@ -4,6 +4,9 @@ from typing import Optional
 from globals import ID_NAME_SEPERATOR
 from .video_models import Downloads
 
+# sqlite has a limit on bound parameters per statement, work in chunks
+CHUNK_SIZE = 500
+
 class ForDownload:
     def __init__(self, db):
         self.db = db
@@ -35,6 +38,12 @@ class ForDownload:
         if download:
             session.delete(download)
 
+    def delete_downloads_by_id(self, ids: list[int]) -> None:
+        session = self.db.get_session()
+        for i in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[i:i + CHUNK_SIZE]
+            session.query(Downloads).filter(Downloads.id.in_(chunk)).delete(synchronize_session=False)
+
     def mark_download_failed(self, original_url) -> None:
         session = self.db.get_session()
         download = session.query(Downloads).filter_by(original_url=original_url).first()
@@ -0,0 +1,56 @@
+from typing import List
+
+from sqlalchemy import insert, func
+
+from .video_models import JobRecord
+
+# sqlite has a limit on bound parameters per statement, work in chunks
+CHUNK_SIZE = 500
+
+
+class ForJobs:
+    """
+    Persisted state of the background jobs - used to resume unfinished jobs after a restart
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def max_id(self) -> int:
+        session = self.db.get_session()
+        return max(session.query(func.max(JobRecord.id)).scalar() or 0,
+                   session.query(func.max(JobRecord.run_id)).scalar() or 0)
+
+    def store_jobs(self, jobs: list[dict]) -> None:
+        """
+        Insert jobs in bulk
+
+        :param jobs: list of dicts with the columns of the jobs table
+        """
+        session = self.db.get_session()
+        for i in range(0, len(jobs), CHUNK_SIZE):
+            session.execute(insert(JobRecord), jobs[i:i + CHUNK_SIZE])
+
+    def update_job(self, job_id: int, values: dict) -> None:
+        session = self.db.get_session()
+        session.query(JobRecord).filter(JobRecord.id == job_id).update(values, synchronize_session=False)
+
+    def list_jobs_by_state(self, states: list[str]) -> List[JobRecord]:
+        session = self.db.get_session()
+        return session.query(JobRecord).filter(JobRecord.state.in_(states)).order_by(JobRecord.priority, JobRecord.id).all()
+
+    def finished_since(self, since: float) -> List[tuple[str, int, float, float]]:
+        """
+        Summary of the jobs finished after a point in time
+
+        :param since: timestamp (seconds)
+        :return: list of (state, count, average run time in seconds, first start timestamp)
+        """
+        session = self.db.get_session()
+        rows = session.query(JobRecord.state, func.count(JobRecord.id), func.avg(JobRecord.finished - JobRecord.started),
+                             func.min(func.coalesce(JobRecord.started, JobRecord.finished))) \
+            .filter(JobRecord.finished >= since).group_by(JobRecord.state).all()
+        return [(state, count, duration or 0.0, first) for state, count, duration, first in rows]
+
+    def delete_finished(self, before: float) -> int:
+        session = self.db.get_session()
+        return session.query(JobRecord).filter(JobRecord.finished < before).delete(synchronize_session=False)
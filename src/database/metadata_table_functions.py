@@ -0,0 +1,47 @@
+from typing import List
+
+from sqlalchemy import insert
+
+from .video_models import VideoMetadata
+
+# sqlite has a limit on bound parameters per statement, work in chunks
+CHUNK_SIZE = 500
+
+
+class ForMetadata:
+    """
+    ffprobe results of the video files - parsed fields for queries and the raw json
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def list_raw_metadata(self) -> List[tuple[str, str]]:
+        """
+        :return: list of (path, raw json) for all videos - one query, no orm objects
+        """
+        session = self.db.get_session()
+        return session.query(VideoMetadata.path, VideoMetadata.info).all()
+
+    def store_metadata(self, entries: list[dict]) -> None:
+        """
+        Insert or replace metadata in bulk
+
+        :param entries: list of dicts with path, duration, width, height, codec, stereo, uid and info
+        """
+        if not entries:
+            return
+        self.delete_metadata([entry['path'] for entry in entries])
+        session = self.db.get_session()
+        for i in range(0, len(entries), CHUNK_SIZE):
+            session.execute(insert(VideoMetadata), entries[i:i + CHUNK_SIZE])
+
+    def move_metadata(self, path: str, new_path: str) -> None:
+        session = self.db.get_session()
+        self.delete_metadata([new_path])
+        session.query(VideoMetadata).filter(VideoMetadata.path == path).update({'path': new_path}, synchronize_session=False)
+
+    def delete_metadata(self, paths: list[str]) -> None:
+        session = self.db.get_session()
+        for i in range(0, len(paths), CHUNK_SIZE):
+            chunk = paths[i:i + CHUNK_SIZE]
+            session.query(VideoMetadata).filter(VideoMetadata.path.in_(chunk)).delete(synchronize_session=False)
@@ -0,0 +1,126 @@
+import hashlib
+from typing import List
+
+from loguru import logger
+from sqlalchemy import text
+
+from .video_models import Online
+
+# sqlite has a limit on bound parameters per statement, work in chunks
+CHUNK_SIZE = 500
+
+VIDEO = 'video'
+ONLINE = 'online'
+
+# weights for bm25 ranking - order of the columns in the search_index table
+RANK_WEIGHTS = {'key': 0.0, 'kind': 0.0, 'title': 10.0, 'basename': 5.0, 'folder': 2.0, 'source_url': 3.0, 'description': 1.0}
+
+CREATE_SEARCH_INDEX = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+    "key UNINDEXED, kind UNINDEXED, title, basename, folder, source_url, description, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+)
+
+
+def _rowid(kind: str, key: str) -> int:
+    # stable rowid derived from the document key - allows delete and replace without a lookup
+    return int.from_bytes(hashlib.sha1(f"{kind}:{key}".encode()).digest()[:8], 'big', signed=True)
+
+
+class ForSearch:
+    """
+    Full text search index (sqlite FTS5) over videos and online entries
+    """
+    def __init__(self, db):
+        self.db = db
+        self.available = False
+        try:
+            with db.engine.begin() as conn:
+                conn.exec_driver_sql(CREATE_SEARCH_INDEX)
+            self.available = True
+        except Exception as e:
+            logger.warning(f"Full text search not available (sqlite without FTS5?): {e}")
+
+    def store_documents(self, kind: str, documents: list[dict]) -> None:
+        """
+        Insert or replace documents in the search index
+
+        :param kind: kind of the documents (video or online)
+        :param documents: list of dicts with key and the text columns title, basename, folder, source_url, description
+        """
+        if not self.available or not documents:
+            return
+        documents = list({document['key']: document for document in documents}.values())
+        self.delete_documents(kind, [document['key'] for document in documents])
+        rows = [{
+            'rowid': _rowid(kind, document['key']),
+            'key': document['key'],
+            'kind': kind,
+            'title': document.get('title') or '',
+            'basename': document.get('basename') or '',
+            'folder': document.get('folder') or '',
+            'source_url': document.get('source_url') or '',
+            'description': document.get('description') or '',
+        } for document in documents]
+        session = self.db.get_session()
+        statement = text("INSERT INTO search_index(rowid, key, kind, title, basename, folder, source_url, description) "
+                         "VALUES (:rowid, :key, :kind, :title, :basename, :folder, :source_url, :description)")
+        for i in range(0, len(rows), CHUNK_SIZE):
+            session.execute(statement, rows[i:i + CHUNK_SIZE])
+
+    def store_videos(self, details: list[dict]) -> None:
+        """
+        Index video files - uses the file details as produced for the file list
+
+        :param details: list of file details dicts
+        """
+        self.store_documents(VIDEO, [{
+            'key': file['filename'],
+            'title': file.get('title'),
+            'basename': file.get('basename'),
+            'folder': file.get('folder'),
+            'source_url': file.get('url'),
+        } for file in details if file.get('filename')])
+
+    def store_onlines(self, onlines: list[Online]) -> None:
+        self.store_documents(ONLINE, [{
+            'key': online.original_url,
+            'title': online.title,
+            'source_url': online.original_url,
+            'description': online.description,
+        } for online in onlines if online.original_url])
+
+    def delete_documents(self, kind: str, keys: list[str]) -> None:
+        if not self.available or not keys:
+            return
+        session = self.db.get_session()
+        statement = text("DELETE FROM search_index WHERE rowid = :rowid")
+        rowids = [{'rowid': _rowid(kind, key)} for key in keys]
+        for i in range(0, len(rowids), CHUNK_SIZE):
+            session.execute(statement, rowids[i:i + CHUNK_SIZE])
+
+    def clear(self) -> None:
+        if self.available:
+            self.db.get_session().execute(text("DELETE FROM search_index"))
+
+    def count(self) -> int:
+        if not self.available:
+            return 0
+        return self.db.get_session().execute(text("SELECT count(*) FROM search_index")).scalar()
+
+    def search(self, match: str, limit: int, kind: str = None) -> List[tuple[str, str, float]]:
+        """
+        Run a FTS5 match query ranked by bm25
+
+        :param match: FTS5 match expression
+        :param limit: maximum number of results
+        :param kind: optional kind to restrict the results to
+        :return: list of (kind, key, rank) - best match first
+        """
+        if not self.available:
+            return []
+        weights = ', '.join(str(weight) for weight in RANK_WEIGHTS.values())
+        sql = (f"SELECT kind, key, bm25(search_index, {weights}) AS rank FROM search_index "
+               f"WHERE search_index MATCH :match {'AND kind = :kind ' if kind else ''}ORDER BY rank LIMIT :limit")
+        session = self.db.get_session()
+        return [tuple(row) for row in session.execute(text(sql), {'match': match, 'kind': kind, 'limit': limit})]
@@ -1,10 +1,13 @@
 from datetime import datetime
 from typing import Optional, List
 
-from sqlalchemy import inspect
-from sqlalchemy.orm import Session
+from sqlalchemy import inspect, insert, func, text
+from sqlalchemy.orm import Session, selectinload
 
-from .video_models import Videos, Similarity
+from .video_models import Videos, Similarity, SimilarityNeighbor
+
+# sqlite has a limit on bound parameters per statement, work in chunks
+CHUNK_SIZE = 500
 
 
 class ForSimilarity:
@@ -41,4 +44,110 @@ class ForSimilarity:
 
     def list_similarity(self) -> List[Similarity]:
         session = self.db.get_session()
-        return session.query(Similarity).all()
\ No newline at end of file
+        return session.query(Similarity).all()
+
+    def store_features(self, features: dict[str, tuple[bytes, bytes, bytes]]) -> None:
+        """
+        Store the features of many videos - urls without a video are skipped
+
+        :param features: dict of video url -> packed (histogram, phash, hog)
+        """
+        session = self.db.get_session()
+        video_urls = list(features)
+        for i in range(0, len(video_urls), CHUNK_SIZE):
+            chunk = video_urls[i:i + CHUNK_SIZE]
+            videos = session.query(Videos).options(selectinload(Videos.similarity)).filter(Videos.video_url.in_(chunk))
+            for video in videos:
+                histogramm, phash, hog = features[video.video_url]
+                similarity = video.similarity
+                if similarity:
+                    similarity.histogramm, similarity.phash, similarity.hog = histogramm, phash, hog
+                    similarity.changed = datetime.now()
+                else:
+                    video.similarity = Similarity(histogramm=histogramm, phash=phash, hog=hog)
+
+    def list_neighbors(self, video_url: str, min_score: float, limit: int) -> List[tuple[str, float]]:
+        """
+        :return: list of (neighbor url, score) with a score above min_score - best first
+        """
+        session = self.db.get_session()
+        return [tuple(row) for row in session.query(SimilarityNeighbor.neighbor_url, SimilarityNeighbor.score)
+                .filter(SimilarityNeighbor.video_url == video_url, SimilarityNeighbor.score > min_score)
+                .order_by(SimilarityNeighbor.score.desc()).limit(limit)]
+
+    def has_neighbors(self, video_url: str) -> bool:
+        session = self.db.get_session()
+        return session.query(SimilarityNeighbor.id).filter(SimilarityNeighbor.video_url == video_url).first() is not None
+
+    def store_neighbors(self, neighbors: list[dict]) -> None:
+        """
+        Insert or replace neighbors in bulk
+
+        :param neighbors: list of dicts with video_url, neighbor_url and score
+        """
+        session = self.db.get_session()
+        for i in range(0, len(neighbors), CHUNK_SIZE):
+            session.execute(insert(SimilarityNeighbor), neighbors[i:i + CHUNK_SIZE])
+
+    def delete_neighbors(self, video_urls: list[str]) -> None:
+        """
+        Delete the neighbor lists of videos
+        """
+        session = self.db.get_session()
+        for i in range(0, len(video_urls), CHUNK_SIZE):
+            chunk = video_urls[i:i + CHUNK_SIZE]
+            session.query(SimilarityNeighbor).filter(SimilarityNeighbor.video_url.in_(chunk)).delete(synchronize_session=False)
+
+    def remove_neighbor(self, neighbor_url: str) -> List[str]:
+        """
+        Remove a video from all neighbor lists
+
+        :return: urls of the videos whose list contained it
+        """
+        session = self.db.get_session()
+        query = session.query(SimilarityNeighbor).filter(SimilarityNeighbor.neighbor_url == neighbor_url)
+        video_urls = [row.video_url for row in query.with_entities(SimilarityNeighbor.video_url)]
+        query.delete(synchronize_session=False)
+        return video_urls
+
+    def delete_all_neighbors_of(self, urls: list[str]) -> None:
+        """
+        Delete videos from the neighbor table - their own lists and their entries in other lists
+        """
+        self.delete_neighbors(urls)
+        session = self.db.get_session()
+        for i in range(0, len(urls), CHUNK_SIZE):
+            chunk = urls[i:i + CHUNK_SIZE]
+            session.query(SimilarityNeighbor).filter(SimilarityNeighbor.neighbor_url.in_(chunk)).delete(synchronize_session=False)
+
+    def move_neighbors(self, video_url: str, new_url: str) -> None:
+        session = self.db.get_session()
+        session.query(SimilarityNeighbor).filter(SimilarityNeighbor.video_url == video_url) \
+            .update({'video_url': new_url}, synchronize_session=False)
+        session.query(SimilarityNeighbor).filter(SimilarityNeighbor.neighbor_url == video_url) \
+            .update({'neighbor_url': new_url}, synchronize_session=False)
+
+    def neighbor_list_bounds(self) -> dict[str, tuple[int, float]]:
+        """
+        :return: dict of video url -> (number of neighbors, lowest score) for all neighbor lists
+        """
+        session = self.db.get_session()
+        rows = session.query(SimilarityNeighbor.video_url, func.count(), func.min(SimilarityNeighbor.score)) \
+            .group_by(SimilarityNeighbor.video_url)
+        return {video_url: (count, min_score) for video_url, count, min_score in rows}
+
+    def trim_neighbors(self, video_urls: list[str], keep: int) -> None:
+        """
+        Keep only the best neighbors of videos
+
+        :param video_urls: videos to trim the lists of
+        :param keep: number of neighbors to keep
+        """
+        session = self.db.get_session()
+        statement = text("DELETE FROM similarity_neighbors WHERE id IN (SELECT id FROM similarity_neighbors "
+                         "WHERE video_url = :video_url ORDER BY score DESC LIMIT -1 OFFSET :keep)")
+        for video_url in video_urls:
+            session.execute(statement, {'video_url': video_url, 'keep': keep})
+
+    def clear_neighbors(self) -> None:
+        self.db.get_session().query(SimilarityNeighbor).delete(synchronize_session=False)
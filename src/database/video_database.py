@@ -2,9 +2,13 @@ import os
 from typing import Optional
 from database.database import Database, ReprMixin
 from globals import get_data_directory, ID_NAME_SEPERATOR
+from .catalog_table_functions import ForCatalog
 from .download_table_functions import ForDownload
+from .job_table_functions import ForJobs
+from .metadata_table_functions import ForMetadata
 from .similarity_table_functions import ForSimilarity
 from .online_table_functions import ForOnline
+from .search_table_functions import ForSearch
 from .video_table_functions import ForVideo
 from .video_models import Downloads, VideoBase, Videos
 
@@ -21,6 +25,10 @@ class VideoDatabase(Database):
         self.for_download_table = ForDownload(self)
         self.for_similarity_table = ForSimilarity(self)
         self.for_online_table = ForOnline(self)
+        self.for_catalog_table = ForCatalog(self)
+        self.for_search_table = ForSearch(self)
+        self.for_job_table = ForJobs(self)
+        self.for_metadata_table = ForMetadata(self)
 
     def set_favorite(self, video_url, favorite) -> None:
         video = self.for_video_table.get_video(video_url)
@@ -45,6 +53,7 @@ class VideoDatabase(Database):
         download = self.for_download_table.get_download(video_url)
         if download:
             download.video_url = new_url
+        self.for_similarity_table.move_neighbors(video_url, new_url)
 
 
 video_db: Optional[VideoDatabase] = None
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 import datetime
 
-from sqlalchemy import String, Integer, UniqueConstraint, LargeBinary, ForeignKey, func, DateTime
+from sqlalchemy import String, Integer, UniqueConstraint, LargeBinary, ForeignKey, func, DateTime, Index, Float
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from .database import ReprMixin
 
@@ -51,6 +51,19 @@ class Similarity(VideoBase, ReprMixin):
     changed: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=func.now())
 
 
+class SimilarityNeighbor(VideoBase, ReprMixin):
+    __tablename__ = 'similarity_neighbors'
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    video_url: Mapped[str] = mapped_column(String, nullable=False)
+    neighbor_url: Mapped[str] = mapped_column(String, nullable=False)
+    score: Mapped[float] = mapped_column(Float, nullable=False)
+    __table_args__ = (
+        UniqueConstraint('video_url', 'neighbor_url', sqlite_on_conflict='REPLACE'),
+        Index('ix_similarity_neighbors_video_score', 'video_url', 'score'),
+        Index('ix_similarity_neighbors_neighbor', 'neighbor_url'),
+    )
+
+
 class Online(VideoBase, ReprMixin):
     __tablename__ = 'online'
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
@@ -70,3 +83,68 @@ class Online(VideoBase, ReprMixin):
         UniqueConstraint('original_url', sqlite_on_conflict='IGNORE'),
         UniqueConstraint('video_url', sqlite_on_conflict='IGNORE'),
     )
+
+
+class Catalog(VideoBase, ReprMixin):
+    __tablename__ = 'catalog'
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    path: Mapped[str] = mapped_column(String, nullable=False)
+    directory: Mapped[str] = mapped_column(String, nullable=False)
+    size: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    mtime: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    inode: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    details: Mapped[str | None] = mapped_column(String)
+    changed: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=func.now(), onupdate=func.now())
+    __table_args__ = (
+        UniqueConstraint('path', sqlite_on_conflict='REPLACE'),
+        Index('ix_catalog_directory', 'directory'),
+    )
+
+
+class CatalogDirectory(VideoBase, ReprMixin):
+    __tablename__ = 'catalog_directory'
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    path: Mapped[str] = mapped_column(String, nullable=False)
+    mtime: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    subdirs: Mapped[str | None] = mapped_column(String)
+    __table_args__ = (
+        UniqueConstraint('path', sqlite_on_conflict='REPLACE'),
+    )
+
+
+class VideoMetadata(VideoBase, ReprMixin):
+    __tablename__ = 'video_metadata'
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    path: Mapped[str] = mapped_column(String, nullable=False)
+    duration: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    width: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    height: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    codec: Mapped[str | None] = mapped_column(String)
+    stereo: Mapped[str | None] = mapped_column(String)
+    uid: Mapped[str | None] = mapped_column(String)
+    info: Mapped[str] = mapped_column(String, nullable=False)
+    changed: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=func.now(), onupdate=func.now())
+    __table_args__ = (
+        UniqueConstraint('path', sqlite_on_conflict='REPLACE'),
+    )
+
+
+class JobRecord(VideoBase, ReprMixin):
+    __tablename__ = 'jobs'
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    kind: Mapped[str] = mapped_column(String, nullable=False)
+    target: Mapped[str] = mapped_column(String, nullable=False)
+    priority: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    state: Mapped[str] = mapped_column(String, nullable=False)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    last_error: Mapped[str | None] = mapped_column(String)
+    run_id: Mapped[int | None] = mapped_column(Integer)
+    run_name: Mapped[str | None] = mapped_column(String)
+    options: Mapped[str | None] = mapped_column(String)
+    created: Mapped[float] = mapped_column(Float, nullable=False)
+    started: Mapped[float | None] = mapped_column(Float)
+    finished: Mapped[float | None] = mapped_column(Float)
+    __table_args__ = (
+        Index('ix_jobs_state', 'state'),
+        Index('ix_jobs_finished', 'finished'),
+    )
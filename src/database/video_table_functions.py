@@ -1,5 +1,8 @@
 from typing import Optional, List
-from .video_models import Videos
+from .video_models import Videos, Similarity
+
+# sqlite has a limit on bound parameters per statement, work in chunks
+CHUNK_SIZE = 500
 
 class ForVideo:
     def __init__(self, db):
@@ -31,6 +34,7 @@ class ForVideo:
         video = session.query(Videos).filter_by(video_url=video_url).first()
         if video:
             session.delete(video)
+        self.db.for_similarity_table.delete_all_neighbors_of([video_url])
 
     def move_video(self, video_url: str, new_url: str) -> None:
         session = self.db.get_session()
@@ -38,6 +42,20 @@ class ForVideo:
         if video:
             video.video_url = new_url
 
+    def delete_videos_by_id(self, ids: list[int]) -> None:
+        """
+        Delete videos and their similarity data in bulk
+
+        :param ids: primary keys of the videos to delete
+        """
+        session = self.db.get_session()
+        for i in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[i:i + CHUNK_SIZE]
+            urls = [url for url, in session.query(Videos.video_url).filter(Videos.id.in_(chunk))]
+            self.db.for_similarity_table.delete_all_neighbors_of(urls)
+            session.query(Similarity).filter(Similarity.video_id.in_(chunk)).delete(synchronize_session=False)
+            session.query(Videos).filter(Videos.id.in_(chunk)).delete(synchronize_session=False)
+
     def list_videos(self) -> List[Videos]:
         session = self.db.get_session()
         return session.query(Videos).all()
\ No newline at end of file
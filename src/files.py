@@ -1,6 +1,9 @@
 import json
 import os
 import shutil
+import threading
+import time
+from contextlib import contextmanager
 
 from loguru import logger
 from bus import push_text_to_client
@@ -10,7 +13,11 @@ from database.video_models import Downloads
 from globals import get_static_directory, VideoInfo, get_real_path_from_url, \
     VideoFolder, THUMBNAIL_DIR_NAME, ServerResponse, FolderState, UNKNOWN_VIDEO_EXTENSION, get_application_path, get_url_from_path, get_thumbnail_directory, ID_NAME_SEPERATOR
 from utils import check_folder, get_mime_type
-from thumbnail import ThumbnailFormat, get_video_info, get_thumbnails, update_file_info
+from thumbnail import ThumbnailFormat, get_video_info, get_thumbnails, update_file_info, probe_videos, \
+    thumbnail_manifest, invalidate_thumbnails
+from metadata import move_video_info, delete_video_infos, stored_video_info_paths
+from catalog import refresh_catalog, invalidate_catalog_entry
+from traversal import walk_directories
 
 @cache(maxsize=128, ttl=3600)
 def library_subfolders() -> list:
@@ -22,15 +29,48 @@ def library_subfolders() -> list:
         logger.warning(f"(For Subfolder) Library folder not accessible: {folder} - state: {folder_state}")
         return subfolders
 
-    for root, dirs, files in os.walk(folder, followlinks=True):
-        # Exclude directories that start with a dot
-        dirs[:] = [d for d in dirs if not d.startswith('.')]
-        subfolder = os.path.relpath(root, os.path.join(get_static_directory(), VideoFolder.library.dir)).replace('\\', '/')
-        if subfolder != '.':
-            subfolders.append(subfolder)
+    for record in walk_directories(folder, stat_files=False):
+        if record.relative:
+            subfolders.append(record.relative)
+    subfolders.sort()
     return subfolders
 
 
+_deferred_invalidation = threading.local()
+
+
+def invalidate_files(*paths: str) -> None:
+    """
+    Mark files as changed so their details are extracted again and clear the list cache
+
+    :param paths: full file paths that changed
+    """
+    invalidate_catalog_entry(*paths)
+    if getattr(_deferred_invalidation, 'active', False):
+        _deferred_invalidation.pending = True
+    else:
+        list_files.cache__clear()
+
+
+@contextmanager
+def deferred_invalidation():
+    """
+    Collect the list cache invalidations of the current thread and clear the cache once at the end
+    Used by bulk operations to avoid a full relisting per file
+    """
+    if getattr(_deferred_invalidation, 'active', False):
+        yield
+        return
+    _deferred_invalidation.active = True
+    _deferred_invalidation.pending = False
+    try:
+        yield
+    finally:
+        _deferred_invalidation.active = False
+        if _deferred_invalidation.pending:
+            list_files.cache__clear()
+
+
 def find_file_info(video_url: str) -> dict | None:
     file_path, folder = get_real_path_from_url(video_url)
     if not file_path:
@@ -76,43 +116,23 @@ def list_files() -> list:
     """
     extracted_details = []
 
+    with get_video_db() as db:
+        failed_downloads = {download.file_name for download in db.session.query(Downloads).filter_by(failed=True).all()}
+
     for directory in VideoFolder:
-        base_path = directory.web_path
         folder, folder_state = check_folder(os.path.join(get_static_directory(),  directory.dir))
         if folder_state != FolderState.ACCESSIBLE:
             push_text_to_client(f"(For list) Folder: {directory.dir} not accessible: {folder} - state: {folder_state}")
             logger.warning(f"(For list) Folder: {directory.dir} not accessible: {folder} - state: {folder_state}")
             continue
 
-        with get_video_db() as db:
-            failed_downloads = [download.file_name for download in db.session.query(Downloads).filter_by(failed=True).all()]
-
-        for root, dirs, files in os.walk(folder, followlinks=True):
-            # Exclude directories that start with a dot
-            dirs[:] = [d for d in dirs if not d.startswith('.')]
-
-            for filename in files:
-                # ignore part-Frag and ytdl files
-                if 'part-Frag' in filename or filename.endswith('.ytdl'):
-                    continue
-
-                subfolder = os.path.relpath(root, folder).replace('\\', '/')
-                if subfolder == '.':
-                    subfolder = ''
-
-                # for unknown files special handling
-                if filename.endswith(UNKNOWN_VIDEO_EXTENSION):
-                    common_details = generic_file_details(root, filename, base_path, subfolder)
-                    extracted_details.append(common_details)
-                    continue
-
-                common_details = extract_file_details(root, filename, base_path, subfolder)
-
-                # only for videos directory
-                if directory == VideoFolder.videos:
-                    if filename in failed_downloads:
-                        common_details['failed'] = True
-                extracted_details.append(common_details)
+        for details in refresh_catalog(folder, catalog_extractor(folder, directory)):
+            # copy - the catalog details are shared and the duplicate check below modifies them
+            common_details = dict(details)
+            # only for videos directory
+            if directory == VideoFolder.videos and common_details.get('basename') in failed_downloads:
+                common_details['failed'] = True
+            extracted_details.append(common_details)
 
     # check for duplicates
     uids: dict = {}
@@ -141,7 +161,45 @@ def list_files() -> list:
     return extracted_details
 
 
-def generic_file_details(root: str, filename: str, base_weburl: str, subfolder: str) -> dict:
+def catalog_extractor(folder: str, directory: VideoFolder):
+    """
+    Create the details extractor used by the catalog for files of the given VideoFolder
+
+    :param folder: real path of the VideoFolder
+    :param directory: the VideoFolder
+    :return: extractor function (root, filename, stat) -> details
+    """
+    base_path = directory.web_path
+
+    def extract(root: str, filename: str, stat: os.stat_result) -> dict:
+        subfolder = os.path.relpath(root, folder).replace('\\', '/')
+        if subfolder == '.':
+            subfolder = ''
+
+        # drop cached infos for the file, the catalog only extracts new or changed files
+        realfile = os.path.join(root, filename)
+        get_basic_save_video_info.cache__evict(realfile)
+        get_thumbnails.cache__evict(realfile)
+
+        # for unknown files special handling
+        if filename.endswith(UNKNOWN_VIDEO_EXTENSION):
+            return generic_file_details(root, filename, base_path, subfolder, stat)
+        return extract_file_details(root, filename, base_path, subfolder, stat)
+
+    def prepare(paths: list[str]) -> None:
+        # list the .thumb folders of the refreshed directories once again - not once per extracted file
+        for directory in {os.path.dirname(path) for path in paths}:
+            thumbnail_manifest.cache__evict(os.path.join(directory, THUMBNAIL_DIR_NAME))
+        # probe all new files concurrently instead of one blocking ffprobe per extracted file
+        videos = [path for path in paths if not path.endswith((UNKNOWN_VIDEO_EXTENSION, '.part'))]
+        if len(videos) > 1:
+            probe_videos(videos)
+
+    extract.prepare = prepare
+    return extract
+
+
+def generic_file_details(root: str, filename: str, base_weburl: str, subfolder: str, stat: os.stat_result = None) -> dict:
     """
     Extract details from a file in given directory
     The returned dictionary contains the following keys:
@@ -158,24 +216,27 @@ def generic_file_details(root: str, filename: str, base_weburl: str, subfolder:
     :param filename: the file to get details from
     :param base_weburl: base weburl of the file (url part)
     :param subfolder: subfolder of the file
+    :param stat: optional stat result of the file (from directory traversal) to avoid further stat calls
     :return:  dictionary with extracted details
     """
     realfile = os.path.join(root, filename)
-    if not os.path.isfile(realfile):
-        return {}
-    mimetype, _ = get_mime_type(realfile)
+    if stat is None:
+        if not os.path.isfile(realfile):
+            return {}
+        stat = os.stat(realfile)
+    mimetype, _ = get_mime_type(realfile, stat=stat)
     result = {
         'mimetype': mimetype,
         'unknown': True,
         'title': os.path.splitext(filename)[0],
         'filename': f"{base_weburl}{subfolder + '/' if subfolder else ''}{filename}",
-        'filesize': os.path.getsize(realfile),
+        'filesize': stat.st_size,
         'folder' : subfolder,
-        'created': os.path.getctime(realfile)
+        'created': stat.st_ctime
     }
     return result
 
-def extract_file_details(root: str, filename: str, base_weburl: str, subfolder: str) -> dict:
+def extract_file_details(root: str, filename: str, base_weburl: str, subfolder: str, stat: os.stat_result = None) -> dict:
     """
     Extract details from a file in the videos directory
     The returned dictionary contains the following keys:
@@ -206,12 +267,15 @@ def extract_file_details(root: str, filename: str, base_weburl: str, subfolder:
     :param filename: the filename
     :param base_weburl: base weburl of the file (url part)
     :param subfolder: subfolder of the file
+    :param stat: optional stat result of the file (from directory traversal) to avoid further stat calls
     :return: dictionary with extracted details
     """
 
     realfile = os.path.join(root, filename)
-    if not os.path.isfile(realfile):
-        return {}
+    if stat is None:
+        if not os.path.isfile(realfile):
+            return {}
+        stat = os.stat(realfile)
 
     partial = filename.endswith('.part')
     download_id = filename.split('____')[0][:14]
@@ -238,14 +302,14 @@ def extract_file_details(root: str, filename: str, base_weburl: str, subfolder:
                     'title': download.title if download.title else file_title,
                 })
         result.update({
-            'created': os.path.getctime(realfile),
+            'created': stat.st_ctime,
         })
     else:
-        mimetype, _ = get_mime_type(realfile)
+        mimetype, _ = get_mime_type(realfile, stat=stat)
         thumbnails = get_thumbnails(realfile)
         thumbnail = thumbnails.get(ThumbnailFormat.WEBP, thumbnails.get(ThumbnailFormat.JPG))
         preview = thumbnails.get(ThumbnailFormat.WEBM)
-        info = get_basic_save_video_info(realfile)
+        info = get_basic_save_video_info(realfile, stat=stat)
         favorite = info.infos.get('favorite', False)
         download_date = info.infos.get('download_date')
         url = info.infos.get('original_url')
@@ -272,17 +336,20 @@ def extract_file_details(root: str, filename: str, base_weburl: str, subfolder:
 
 
 @cache(maxsize=4096, ttl=7200)
-def get_basic_save_video_info(file_path: str) -> VideoInfo:
+def get_basic_save_video_info(file_path: str, stat: os.stat_result = None) -> VideoInfo:
     """
     Get basic video information from a file,
     including created date, size, duration, width, height, resolution, stereo, uid and title
 
     :param file_path: the full file path to which information should be extracted
+    :param stat: optional stat result of the file (pass as keyword, it is not part of the cache key)
     :return: VideoInfo object with filled data including dict of infos from json
     """
 
-    size = os.path.getsize(file_path)
-    created = os.path.getctime(file_path)
+    if stat is None:
+        stat = os.stat(file_path)
+    size = stat.st_size
+    created = stat.st_ctime
     video_info = get_video_info(file_path)
     if video_info is not None:
         duration = int(float(video_info['format'].get('duration', 0))) if 'format' in video_info else 0
@@ -379,8 +446,10 @@ def move_file_with_thumbnails(file_path: str, target_path: str) -> None:
                 library_thumbnail_dir = get_thumbnail_directory(target_path)
                 os.makedirs(library_thumbnail_dir, exist_ok=True)
                 shutil.move(thumbnail_path, os.path.join(library_thumbnail_dir, f"{base_name}{fmt.extension}"))
+    move_video_info(file_path, target_path)
+    invalidate_thumbnails(file_path, target_path)
 
-    list_files.cache__clear()
+    invalidate_files(file_path, target_path)
     push_text_to_client(f"File and all thumbnails moved: {base_name}")
 
 
@@ -415,70 +484,114 @@ def delete_file(url: str) -> ServerResponse:
     with get_video_db() as db:
         db.for_video_table.delete_video(url)
         db.for_download_table.delete_download(url)
+    delete_video_infos([real_path])
+    invalidate_thumbnails(real_path)
 
-    list_files.cache__clear()
+    invalidate_files(real_path)
     push_text_to_client(f"File deleted: {base_name}")
     return ServerResponse(True, f"File {base_name} deleted")
 
-def cleanup() -> ServerResponse:
+def _directory_names(names_by_dir: dict[str, set[str]], directory: str) -> set[str]:
+    # directories not seen by the traversal (e.g. outside the video folders) are listed once on demand
+    names = names_by_dir.get(directory)
+    if names is None:
+        try:
+            with os.scandir(directory) as it:
+                names = {entry.name for entry in it if entry.is_file()}
+        except OSError:
+            names = set()
+        names_by_dir[directory] = names
+    return names
+
+
+def _orphan_rows(rows, names_by_dir: dict[str, set[str]]) -> list:
+    orphans = []
+    application_path = get_application_path()
+    for row in rows:
+        if row.video_url:
+            check_file = os.path.normpath(os.path.join(application_path, row.video_url.lstrip('/')))
+            if os.path.basename(check_file) not in _directory_names(names_by_dir, os.path.dirname(check_file)):
+                orphans.append(row)
+    return orphans
+
+
+def cleanup(dry_run: bool = False) -> dict:
     """
-    Cleanup the tracking map by removing entries that no longer exist.
-    Also, cleanup thumbnails that no longer have a corresponding video file.
+    Reconcile the database and the thumbnail folders with the files on disk.
+    Removes download, video and metadata entries whose file no longer exists
+    and thumbnails that no longer have a corresponding video file.
 
-    :return: object with success and message
-    """
+    All video folders are listed once into sets of file names per directory,
+    orphans are then found with set lookups and deleted in bulk.
 
-    to_remove = []
-    with get_video_db() as db:
-        all_downloads = db.for_download_table.list_downloads()
-        for download in all_downloads:
-            pk = download.id
-            video_url = download.video_url
-            if video_url:
-                check_file = os.path.normpath(os.path.join(get_application_path(), video_url.lstrip('/')))
-                logger.debug(f"Cleanup for download: {check_file}")
-                if not os.path.isfile(check_file):
-                    logger.debug(f"Removing: {video_url} for download")
-                    to_remove.append(pk)
-                    db.get_session().delete(download)
-        all_videos = db.for_video_table.list_videos()
-        for video in all_videos:
-            video_url = video.video_url
-            if video_url:
-                check_file = os.path.normpath(os.path.join(get_application_path(), video_url.lstrip('/')))
-                logger.debug(f"Cleanup for video: {check_file}")
-                if not os.path.isfile(check_file):
-                    logger.debug(f"Removing: {video_url} for video")
-                    to_remove.append(video_url)
-                    db.get_session().delete(video)
-
-    logger.debug(f"removed orphan db entries: {to_remove}")
-    push_text_to_client(f"Cleanup db entries finished (removed: {len(to_remove)} entries).")
-
-    # cleanup thumbnails from .thumb directory that no longer have a corresponding video file for both videos and library directory
-    known_extensions = [fmt.extension for fmt in ThumbnailFormat]
-    to_remove = []
+    :param dry_run: only compute and return the plan, do not delete anything
+    :return: dict with success, message, the orphan downloads, videos, metadata and thumbnails and timings in seconds
+    """
+    timings = {}
+    start = time.perf_counter()
+    known_extensions = tuple(fmt.extension for fmt in ThumbnailFormat)
+    names_by_dir: dict[str, set[str]] = {}
+    orphan_thumbnails = []
     for directory in VideoFolder:
         folder, folder_state = check_folder(os.path.join(get_static_directory(), directory.dir))
         if folder_state != FolderState.ACCESSIBLE:
             logger.warning(f"Folder not accessible: {folder} - skipping cleanup - state: {folder_state}")
             continue
-
-        # get all files from .thumb sub folders
-        for root, dirs, files in os.walk(folder, followlinks=True):
-            if THUMBNAIL_DIR_NAME in dirs:
-                thumb_dir = os.path.join(root, THUMBNAIL_DIR_NAME)
-                root_files = os.listdir(root)
-                for filename in os.listdir(thumb_dir):
-                    if not any(filename.startswith(f) for f in root_files):
-                        if any(filename.endswith(ext) for ext in known_extensions):
-                            thumb_file = os.path.join(thumb_dir, filename)
-                            to_remove.append(thumb_file)
-                            os.remove(thumb_file)
-
-    push_text_to_client(f"Cleanup thumbnails finished (removed: {len(to_remove)} orphan entries).")
+        for record in walk_directories(folder, stat_files=False):
+            names = {file.name for file in record.files}
+            names_by_dir[os.path.normpath(record.path)] = names
+            if THUMBNAIL_DIR_NAME not in record.hidden:
+                continue
+            # a thumbnail belongs to the file (or folder) named like the thumbnail without its extension
+            owners = names | {os.path.basename(d) for d in record.subdirs} | set(record.hidden)
+            thumb_dir = os.path.join(record.path, THUMBNAIL_DIR_NAME)
+            for filename in os.listdir(thumb_dir):
+                extension = next((ext for ext in known_extensions if filename.endswith(ext)), None)
+                if extension and filename[:-len(extension)] not in owners:
+                    orphan_thumbnails.append(os.path.join(thumb_dir, filename))
+    timings['scan'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with get_video_db() as db:
+        orphan_downloads = _orphan_rows(db.for_download_table.list_downloads(), names_by_dir)
+        orphan_videos = _orphan_rows(db.for_video_table.list_videos(), names_by_dir)
+        orphan_metadata = [path for path in stored_video_info_paths()
+                           if os.path.basename(path) not in _directory_names(names_by_dir, os.path.dirname(path))]
+        timings['plan'] = time.perf_counter() - start
+
+        result = {
+            'dry_run': dry_run,
+            'downloads': [download.video_url for download in orphan_downloads],
+            'videos': [video.video_url for video in orphan_videos],
+            'metadata': orphan_metadata,
+            'thumbnails': orphan_thumbnails,
+            'timings': timings,
+        }
+        if dry_run:
+            return {'success': True, 'message': f"Cleanup plan: {len(orphan_downloads)} downloads, "
+                                                f"{len(orphan_videos)} videos, {len(orphan_metadata)} metadata entries "
+                                                f"and {len(orphan_thumbnails)} thumbnails to remove",
+                    **result}
+
+        start = time.perf_counter()
+        db.for_download_table.delete_downloads_by_id([download.id for download in orphan_downloads])
+        db.for_video_table.delete_videos_by_id([video.id for video in orphan_videos])
+    delete_video_infos(orphan_metadata)
+
+    logger.debug(f"removed orphan db entries: {result['downloads'] + result['videos']}")
+    push_text_to_client(f"Cleanup db entries finished (removed: {len(orphan_downloads) + len(orphan_videos)} entries).")
+
+    for thumb_file in orphan_thumbnails:
+        try:
+            os.remove(thumb_file)
+        except OSError as e:
+            logger.warning(f"Could not remove orphan thumbnail {thumb_file}: {e}")
+    timings['delete'] = time.perf_counter() - start
+
+    thumbnail_manifest.cache__clear()
+    push_text_to_client(f"Cleanup thumbnails finished (removed: {len(orphan_thumbnails)} orphan entries).")
     list_files.cache__clear()
-    return ServerResponse(True, "Cleanup finished")
+    return {'success': True, 'message': "Cleanup finished", **result}
 
 
 def rename_file_title(video_path: str, new_title: str) -> ServerResponse:
@@ -510,7 +623,7 @@ def rename_file_title(video_path: str, new_title: str) -> ServerResponse:
 
     # clear the cache and push/return info
     get_basic_save_video_info.cache__evict(real_path)
-    list_files.cache__clear()
+    invalidate_files(real_path)
     push_text_to_client(f"File renamed: {video_path}")
     return ServerResponse(True, f"File {video_path} renamed")
 
@@ -547,7 +660,7 @@ def set_favorite(video_path: str, favorite: bool = None) -> ServerResponse:
 
     # clear the cache and push/return info
     get_basic_save_video_info.cache__evict(real_path)
-    list_files.cache__clear()
+    invalidate_files(real_path)
     push_text_to_client(f"File favorite changed to {favorite}: {base_name}")
     return ServerResponse(True, f"File {base_name} favorite changed")
 
@@ -155,6 +155,13 @@ def get_real_path_from_url(url) -> Tuple[Optional[str], Optional[VideoFolder]]:
         vid_folder = VideoFolder.videos
 
     real_path = os.path.normpath(real_path)
+    # '..' in the url must not lead out of the video folder
+    folder_root = os.path.normpath(os.path.join(static_dir, vid_folder.dir))
+    try:
+        if os.path.commonpath([folder_root, real_path]) != folder_root:
+            return None, None
+    except ValueError:
+        return None, None
     if not os.path.isfile(real_path):
         return None, None
 
@@ -0,0 +1,206 @@
+import os
+import shutil
+import subprocess
+import threading
+import time
+from enum import Enum
+from typing import Optional
+
+from loguru import logger
+
+PLAYBACK_IDLE_SECONDS = 10      # playback counts as stopped this long after the last media request
+PLAYBACK_JOB_LIMIT = 1          # background jobs running at the same time while playback is throttled
+BACKGROUND_NICE = 10            # cpu niceness added to ffmpeg / ffprobe processes during playback
+CHECK_INTERVAL = 1.0            # seconds between two checks for the end of a playback
+MEDIA_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.webm')
+
+
+class GovernorMode(Enum):
+    OFF = 'off'             # background work never yields to playback
+    THROTTLE = 'throttle'   # fewer background jobs, ffmpeg processes with lower cpu and io priority
+    PAUSE = 'pause'         # no new background jobs, running ffmpeg processes with lower cpu and io priority
+
+
+_condition = threading.Condition()
+_mode = GovernorMode.THROTTLE
+_streams = 0                    # media responses currently sent
+_last_request = 0.0             # monotonic time of the last media request
+_playback_since: Optional[float] = None
+_throttled = False
+_background_running = 0
+_processes: set[int] = set()
+_monitor: Optional[threading.Thread] = None
+_ionice = shutil.which('ionice')
+_base_nice = os.getpriority(os.PRIO_PROCESS, 0) if hasattr(os, 'getpriority') else 0
+
+
+def set_governor_mode(mode: GovernorMode) -> None:
+    """
+    Set how background jobs yield to playback
+
+    :param mode: off, throttle or pause
+    """
+    global _mode
+    with _condition:
+        _mode = mode
+    logger.info(f"Background job governor: {mode.value}")
+    _check()
+
+
+def is_media_request(filename: str) -> bool:
+    """
+    :param filename: path below the static folder
+    :return: True for video files - thumbnails and previews in .thumb folders are no playback
+    """
+    return filename.lower().endswith(MEDIA_EXTENSIONS) and '.thumb/' not in filename.replace('\\', '/')
+
+
+def media_request_started() -> None:
+    """
+    Called when a video file is sent - call media_request_finished when the response is closed
+    """
+    global _streams, _last_request
+    with _condition:
+        _streams += 1
+        _last_request = time.monotonic()
+    _start_monitor()
+    _check()
+
+
+def media_request_finished() -> None:
+    global _streams, _last_request
+    with _condition:
+        _streams = max(0, _streams - 1)
+        _last_request = time.monotonic()
+
+
+def admit_background_job() -> bool:
+    """
+    Ask to start a background job - while playback is throttled only PLAYBACK_JOB_LIMIT run, paused none.
+    Call background_job_finished when an admitted job is done.
+
+    :return: True if the job may start
+    """
+    global _background_running
+    with _condition:
+        if _throttled:
+            limit = 0 if _mode == GovernorMode.PAUSE else PLAYBACK_JOB_LIMIT
+            if _background_running >= limit:
+                return False
+        _background_running += 1
+        return True
+
+
+def background_job_finished() -> None:
+    global _background_running
+    with _condition:
+        _background_running = max(0, _background_running - 1)
+        _condition.notify_all()
+
+
+def wait_for_change(timeout: float = CHECK_INTERVAL) -> None:
+    """
+    Wait until playback stops or a background job finishes (or the timeout)
+    """
+    with _condition:
+        _condition.wait(timeout)
+
+
+def register_process(pid: int) -> None:
+    """
+    Track a background process (ffmpeg, ffprobe) - it gets a lower cpu and io priority during playback
+
+    :param pid: process id
+    """
+    with _condition:
+        _processes.add(pid)
+        throttled = _throttled
+    if throttled:
+        _set_process_priority(pid, True)
+
+
+def unregister_process(pid: int) -> None:
+    with _condition:
+        _processes.discard(pid)
+
+
+def governor_status() -> dict:
+    """
+    Example: {"mode": "throttle", "playback": true, "throttled": true, "active_streams": 1, "playback_seconds": 42.1,
+              "idle_seconds": 0.3, "background_running": 1, "background_limit": 1, "processes": 1}
+
+    :return: dict with the mode, the playback and throttle state and the background work
+    """
+    with _condition:
+        now = time.monotonic()
+        playback = _playback_active(now)
+        limit = None
+        if _throttled:
+            limit = 0 if _mode == GovernorMode.PAUSE else PLAYBACK_JOB_LIMIT
+        return {
+            'mode': _mode.value,
+            'playback': playback,
+            'throttled': _throttled,
+            'active_streams': _streams,
+            'playback_seconds': round(now - _playback_since, 1) if _playback_since is not None else None,
+            'idle_seconds': round(now - _last_request, 1) if _last_request else None,
+            'background_running': _background_running,
+            'background_limit': limit,
+            'processes': len(_processes),
+        }
+
+
+def _playback_active(now: float) -> bool:
+    # a headset requests ranges of the file while playing - between the requests no response may be open
+    return _streams > 0 or (_last_request > 0 and now - _last_request < PLAYBACK_IDLE_SECONDS)
+
+
+def _check() -> None:
+    global _throttled, _playback_since
+    with _condition:
+        now = time.monotonic()
+        playback = _playback_active(now)
+        if playback and _playback_since is None:
+            _playback_since = now
+        elif not playback:
+            _playback_since = None
+        throttled = playback and _mode != GovernorMode.OFF
+        if throttled == _throttled:
+            return
+        _throttled = throttled
+        pids = list(_processes)
+        _condition.notify_all()
+    logger.info(f"Playback {'started - background jobs throttled' if throttled else 'stopped - background jobs at full speed'}")
+    for pid in pids:
+        _set_process_priority(pid, throttled)
+
+
+def _start_monitor() -> None:
+    global _monitor
+    if _monitor is None:
+        with _condition:
+            if _monitor is None:
+                _monitor = threading.Thread(target=_watch_playback, name="job-governor", daemon=True)
+                _monitor.start()
+
+
+def _watch_playback() -> None:
+    while True:
+        time.sleep(CHECK_INTERVAL)
+        _check()
+
+
+def _set_process_priority(pid: int, throttled: bool) -> None:
+    # lowering the niceness again needs privileges on most systems - the process then keeps running niced
+    if hasattr(os, 'setpriority'):
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, _base_nice + BACKGROUND_NICE if throttled else _base_nice)
+        except OSError as e:
+            logger.debug(f"Failed to change cpu priority of process {pid}: {e}")
+    if _ionice:
+        # idle io class while throttled, default best effort class afterwards
+        cmd = [_ionice, '-c', '3', '-p', str(pid)] if throttled else [_ionice, '-c', '2', '-n', '4', '-p', str(pid)]
+        try:
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=5)
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.debug(f"Failed to change io priority of process {pid}: {e}")
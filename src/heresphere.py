@@ -9,7 +9,8 @@ from database.video_database import get_video_db
 from files import list_files, get_basic_save_video_info, library_subfolders, set_favorite
 from globals import get_static_directory, VideoFolder
 from onlines import list_onlines
-from thumbnail import ThumbnailFormat, get_thumbnails
+from payload import json_payload_response
+from thumbnail import ThumbnailFormat, get_thumbnails, request_thumbnail, PREVIEW_FORMATS
 from utils import check_video_url_stale
 from videos import get_stream
 
@@ -17,7 +18,11 @@ heresphere_bp = Blueprint('heresphere', __name__)
 
 @heresphere_bp.route('/heresphere', methods=['POST', 'GET'])
 def heresphere():
-    response = jsonify(generate_heresphere_json(request.root_url.rstrip('/')))
+    server_path = request.root_url.rstrip('/')
+    # the urls contain the server path - one payload per way the server is reached (bounded by payload.MAX_PAYLOADS)
+    response = json_payload_response(f"heresphere:{server_path}",
+                                     (list_files(), library_subfolders(), list_onlines()),
+                                     lambda: generate_heresphere_json(server_path))
     response.headers['heresphere-json-version'] = '1'
     return response
 
@@ -108,12 +113,15 @@ def generate_heresphere_json_item(server_path, file_base64, data):
         set_favorite(filename, is_favorite)
 
     thumbnails = get_thumbnails(real_path)
+    if any(fmt not in thumbnails for fmt in PREVIEW_FORMATS):
+        # generated in the background - the next request has them
+        request_thumbnail(real_path)
     thumbnail_url = thumbnails.get(ThumbnailFormat.JPG)
     if thumbnail_url is None:
         thumbnail_url = "/static/images/placeholder.png"
     thumbnail = f"{server_path}{urllib.parse.quote(thumbnail_url)}"
 
-    thumbnail_video_url = thumbnails[ThumbnailFormat.WEBM]
+    thumbnail_video_url = thumbnails.get(ThumbnailFormat.WEBM)
     if thumbnail_video_url is None:
         thumbnail_video_url = ''
     thumbnail_video = f"{server_path}{urllib.parse.quote(thumbnail_video_url)}"
@@ -0,0 +1,484 @@
+import itertools
+import json
+import queue
+import threading
+import time
+from enum import Enum, IntEnum
+from typing import Any, Callable, Optional
+
+from loguru import logger
+
+from database.video_database import get_video_db
+from governor import admit_background_job, background_job_finished, wait_for_change
+
+
+DEFAULT_JOB_WORKERS = 2
+FINISHED_JOBS_KEPT = 200        # finished jobs kept for the status endpoint
+MAX_JOB_ATTEMPTS = 3            # a job interrupted by a restart this often is not resumed again
+JOB_HISTORY_DAYS = 7            # finished jobs are kept this long in the database
+THROUGHPUT_WINDOW = 600         # seconds of finished jobs the throughput is calculated from
+PERSIST_BATCH_SIZE = 500        # job state changes written in one transaction
+
+
+class JobPriority(IntEnum):
+    """
+    Lower value runs first
+    """
+    DOWNLOAD = 0        # freshly downloaded file - the user waits for it
+    SINGLE = 10         # single file requested from the UI
+    BACKFILL = 100      # bulk generation for the whole library
+
+
+class JobState(Enum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+
+class JobRun:
+    """
+    Group of jobs started together (e.g. one generate thumbnails request) - used for progress and cancellation
+    """
+    def __init__(self, run_id: int, name: str, on_finished: Optional[Callable[['JobRun'], None]]):
+        self.id = run_id
+        self.name = name
+        self.on_finished = on_finished
+        self.total = 0
+        self.started = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.closed = False         # all jobs of the run are enqueued
+        self.finished = False
+
+    def to_dict(self) -> dict:
+        return {'id': self.id, 'name': self.name, 'total': self.total, 'succeeded': self.succeeded,
+                'failed': self.failed, 'cancelled': self.cancelled, 'finished': self.finished}
+
+
+class Job:
+    def __init__(self, job_id: int, kind: str, target: str, priority: JobPriority, run: Optional[JobRun],
+                 attempts: int = 0, created: Optional[float] = None, options: Optional[dict] = None):
+        self.id = job_id
+        self.kind = kind
+        self.target = target
+        self.options = options or {}    # handler specific options - json serializable
+        self.priority = priority
+        self.run = run
+        self.state = JobState.QUEUED
+        self.position = 0           # position inside its run when started - for progress messages
+        self.attempts = attempts
+        self.error: Optional[str] = None
+        self.created = created or time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.cancel_event = threading.Event()
+        self.done_event = threading.Event()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until the job is finished
+
+        :param timeout: optional timeout in seconds
+        :return: True if the job finished successfully
+        """
+        self.done_event.wait(timeout)
+        return self.state == JobState.DONE
+
+    def to_dict(self) -> dict:
+        return {'id': self.id, 'kind': self.kind, 'target': self.target, 'options': self.options, 'priority': int(self.priority),
+                'state': self.state.value, 'run': self.run.id if self.run else None, 'attempts': self.attempts,
+                'error': self.error, 'created': self.created, 'started': self.started, 'finished': self.finished}
+
+
+# handler is called with the job and returns True on success - it should stop early if job.cancel_event is set
+JobHandler = Callable[[Job], Optional[bool]]
+
+_handlers: dict[str, JobHandler] = {}
+_run_callbacks: dict[str, Callable[[JobRun], None]] = {}
+_queue: queue.PriorityQueue = queue.PriorityQueue()
+_lock = threading.Lock()
+_ids = itertools.count(1)
+_loaded = False
+_persist_queue: queue.Queue = queue.Queue()
+_persist_thread: Optional[threading.Thread] = None
+_persist_lock = threading.Lock()
+_jobs: dict[int, Job] = {}
+_active: dict[tuple[str, str], Job] = {}      # (kind, target) -> queued or running job
+_runs: dict[int, JobRun] = {}
+_finished: list[Job] = []
+_workers: list[threading.Thread] = []
+
+
+def register_job_handler(kind: str, handler: JobHandler, on_run_finished: Optional[Callable[[JobRun], None]] = None) -> None:
+    """
+    Register the function that executes jobs of a kind
+
+    :param kind: job kind
+    :param handler: function called with the job
+    :param on_run_finished: finished callback for runs resumed after a restart
+    """
+    _handlers[kind] = handler
+    if on_run_finished:
+        _run_callbacks[kind] = on_run_finished
+
+
+def start_job_workers(count: int = DEFAULT_JOB_WORKERS) -> None:
+    """
+    Start the worker threads - jobs are executed in parallel by this many workers.
+    On the first call the unfinished jobs of the last server run are enqueued again.
+
+    :param count: number of workers
+    """
+    _load_jobs()
+    with _lock:
+        for i in range(len(_workers), max(1, count)):
+            worker = threading.Thread(target=_work, name=f"job-worker-{i}", daemon=True)
+            _workers.append(worker)
+            worker.start()
+    logger.info(f"Job workers started: {len(_workers)}")
+
+
+def create_run(name: str, on_finished: Optional[Callable[[JobRun], None]] = None) -> JobRun:
+    """
+    Create a run to group jobs, close it with close_run after all jobs are enqueued
+
+    :param name: name of the run for progress messages
+    :param on_finished: called once all jobs of the run are finished
+    :return: the run
+    """
+    _load_jobs()
+    with _lock:
+        run = JobRun(next(_ids), name, on_finished)
+        _runs[run.id] = run
+    return run
+
+
+def close_run(run: JobRun) -> None:
+    """
+    Mark all jobs of the run as enqueued - the run finishes when its last job is done
+    """
+    with _lock:
+        run.closed = True
+        finished = _check_run_finished(run)
+    if finished:
+        _run_finished(run)
+
+
+def enqueue_job(kind: str, target: str, priority: JobPriority = JobPriority.SINGLE, run: Optional[JobRun] = None,
+                options: Optional[dict] = None) -> Job:
+    """
+    Enqueue a job. If a job for the same target is already queued or running it is returned instead,
+    a queued job is moved up if the new priority is higher.
+
+    :param kind: job kind - a handler has to be registered for it
+    :param target: what the job works on (e.g. the video path)
+    :param priority: priority of the job
+    :param run: optional run the job belongs to
+    :param options: optional handler specific options (json serializable) - kept when the job is resumed
+    :return: the job
+    """
+    if kind not in _handlers:
+        raise ValueError(f"No handler for job kind: {kind}")
+    if not _workers:
+        start_job_workers()
+
+    with _lock:
+        existing = _active.get((kind, target))
+        if existing:
+            if existing.state == JobState.QUEUED and priority < existing.priority:
+                # the old queue entry is skipped by the workers because its priority does not match anymore
+                existing.priority = priority
+                _persist('update', (existing.id, {'priority': int(priority)}))
+                _queue.put((priority, existing.id, existing))
+            return existing
+
+        job = Job(next(_ids), kind, target, priority, run, options=options)
+        _jobs[job.id] = job
+        _active[(kind, target)] = job
+        if run:
+            run.total += 1
+        _persist('insert', {'id': job.id, 'kind': kind, 'target': target, 'priority': int(priority),
+                            'state': job.state.value, 'attempts': 0, 'run_id': run.id if run else None,
+                            'run_name': run.name if run else None, 'created': job.created,
+                            'options': json.dumps(job.options) if job.options else None})
+        _queue.put((priority, job.id, job))
+    return job
+
+
+def cancel_job(job_id: int) -> bool:
+    """
+    Cancel a queued or running job
+
+    :param job_id: id of the job
+    :return: True if the job was found and not finished yet
+    """
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None or job.state not in (JobState.QUEUED, JobState.RUNNING):
+            return False
+        job.cancel_event.set()
+        queued = job.state == JobState.QUEUED
+    if queued:
+        _finish_job(job, JobState.CANCELLED)
+    return True
+
+
+def cancel_run(run_id: int = None) -> int:
+    """
+    Cancel all unfinished jobs of a run or all unfinished jobs
+
+    :param run_id: id of the run or None for all jobs
+    :return: number of cancelled jobs
+    """
+    with _lock:
+        jobs = [job for job in _jobs.values() if run_id is None or (job.run and job.run.id == run_id)]
+    return sum(1 for job in jobs if cancel_job(job.id))
+
+
+def job_status() -> dict:
+    """
+    Example throughput: {"window": 600, "done": 42, "failed": 1, "per_minute": 4.3, "avg_seconds": 13.2, "eta_seconds": 812}
+
+    :return: dict with queue depth per priority, queued and running jobs, runs, the recently finished jobs
+             and the throughput of the last THROUGHPUT_WINDOW seconds (from the database, survives restarts)
+    """
+    with _lock:
+        queued = [job for job in _jobs.values() if job.state == JobState.QUEUED]
+        status = {
+            'workers': len(_workers),
+            'queued': len(queued),
+            'queue_depth': {priority.name.lower(): sum(1 for job in queued if job.priority == priority) for priority in JobPriority},
+            'running': [job.to_dict() for job in _jobs.values() if job.state == JobState.RUNNING],
+            'runs': [run.to_dict() for run in _runs.values()],
+            'finished': [job.to_dict() for job in _finished[-20:]],
+        }
+
+    now = time.time()
+    counts = {state: (0, 0.0) for state in JobState}
+    first_started = now
+    try:
+        with get_video_db() as db:
+            for state, count, duration, first in db.for_job_table.finished_since(now - THROUGHPUT_WINDOW):
+                counts[JobState(state)] = (count, duration)
+                first_started = min(first_started, max(first, now - THROUGHPUT_WINDOW))
+    except Exception as e:
+        logger.warning(f"Failed to read job throughput: {e}")
+    finished = sum(count for count, _ in counts.values())
+    # rate over the time the jobs actually ran - a run started a minute ago is not averaged over the whole window
+    per_minute = finished / max(now - first_started, 1.0) * 60
+    status['throughput'] = {
+        'window': THROUGHPUT_WINDOW,
+        'done': counts[JobState.DONE][0],
+        'failed': counts[JobState.FAILED][0],
+        'cancelled': counts[JobState.CANCELLED][0],
+        'per_minute': round(per_minute, 2),
+        'avg_seconds': round(counts[JobState.DONE][1], 2),
+        'eta_seconds': round(status['queued'] / per_minute * 60) if per_minute else None,
+    }
+    return status
+
+
+def _load_jobs() -> None:
+    # resume the jobs that were queued or running when the server stopped
+    global _loaded, _ids
+    with _lock:
+        if _loaded:
+            return
+        # the id counter continues after the stored jobs before any job or run can take an id
+        try:
+            with get_video_db() as db:
+                db.for_job_table.delete_finished(time.time() - JOB_HISTORY_DAYS * 86400)
+                _ids = itertools.count(db.for_job_table.max_id() + 1)
+                records = [record.to_dict() for record in
+                           db.for_job_table.list_jobs_by_state([JobState.QUEUED.value, JobState.RUNNING.value])]
+        except Exception as e:
+            logger.error(f"Failed to load unfinished jobs: {e}")
+            records = None
+        _loaded = True
+    if records is None:
+        return
+
+    runs: dict[int, JobRun] = {}
+    resumed = 0
+    for record in records:
+        kind = record['kind']
+        if kind not in _handlers:
+            logger.warning(f"No handler for job kind {kind} - job {record['id']} not resumed")
+            continue
+        if record['attempts'] >= MAX_JOB_ATTEMPTS:
+            _persist('update', (record['id'], {'state': JobState.FAILED.value, 'finished': time.time(),
+                                               'last_error': f"Interrupted {record['attempts']} times"}))
+            continue
+        run = None
+        if record['run_id'] is not None:
+            run = runs.get(record['run_id'])
+            if run is None:
+                run = create_run(f"{record['run_name']} (resumed)", _run_callbacks.get(kind))
+                runs[record['run_id']] = run
+            # the job keeps its row, it is only moved to the new run
+            _persist('update', (record['id'], {'run_id': run.id, 'run_name': run.name}))
+        with _lock:
+            if (kind, record['target']) in _active:
+                continue
+            job = Job(record['id'], kind, record['target'], JobPriority(record['priority']), run,
+                      record['attempts'], record['created'], json.loads(record['options'] or '{}'))
+            _jobs[job.id] = job
+            _active[(kind, job.target)] = job
+            if run:
+                run.total += 1
+            _queue.put((job.priority, job.id, job))
+        if record['state'] != JobState.QUEUED.value:
+            _persist('update', (job.id, {'state': JobState.QUEUED.value}))
+        resumed += 1
+    for run in runs.values():
+        close_run(run)
+    if resumed:
+        logger.info(f"Resumed {resumed} unfinished jobs")
+
+
+def _persist(action: str, data) -> None:
+    # job state is written by a single writer thread, coalescing many changes into one transaction
+    # and never blocking a worker or running inside the transaction of the caller
+    global _persist_thread
+    _persist_queue.put((action, data))
+    if _persist_thread is None:
+        with _persist_lock:
+            if _persist_thread is None:
+                _persist_thread = threading.Thread(target=_write_jobs, name="job-writer", daemon=True)
+                _persist_thread.start()
+
+
+def _write_jobs() -> None:
+    while True:
+        changes = [_persist_queue.get()]
+        while len(changes) < PERSIST_BATCH_SIZE:
+            try:
+                changes.append(_persist_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _write_job_changes(changes)
+        except Exception as e:
+            # one bad change must not drop the others - written one by one instead
+            logger.warning(f"Failed to persist {len(changes)} job changes at once, writing them one by one: {e}")
+            for change in changes:
+                try:
+                    _write_job_changes([change])
+                except Exception as e:
+                    logger.error(f"Failed to persist job change {change[0]} for job {_change_job_id(change)}: {e}")
+        finally:
+            for _ in changes:
+                _persist_queue.task_done()
+
+
+def _change_job_id(change: tuple[str, Any]) -> Optional[int]:
+    action, data = change
+    return data.get('id') if action == 'insert' else data[0]
+
+
+def _write_job_changes(changes: list[tuple[str, Any]]) -> None:
+    with get_video_db() as db:
+        inserts = []
+        for action, data in changes:
+            if action == 'insert':
+                inserts.append(data)
+                continue
+            if inserts:
+                db.for_job_table.store_jobs(inserts)
+                inserts = []
+            db.for_job_table.update_job(*data)
+        if inserts:
+            db.for_job_table.store_jobs(inserts)
+
+
+def flush_job_state() -> None:
+    """
+    Wait until all job state changes are written to the database
+    """
+    _persist_queue.join()
+
+
+def _check_run_finished(run: JobRun) -> bool:
+    if run.finished or not run.closed or run.succeeded + run.failed + run.cancelled < run.total:
+        return False
+    run.finished = True
+    _runs.pop(run.id, None)
+    return True
+
+
+def _run_finished(run: JobRun) -> None:
+    if run.on_finished:
+        try:
+            run.on_finished(run)
+        except Exception as e:
+            logger.error(f"Run finished callback failed for {run.name}: {e}")
+
+
+def _finish_job(job: Job, state: JobState, error: Optional[str] = None) -> None:
+    with _lock:
+        if job.done_event.is_set():
+            return
+        job.state = state
+        job.error = error
+        job.finished = time.time()
+        _persist('update', (job.id, {'state': state.value, 'last_error': error, 'finished': job.finished}))
+        _jobs.pop(job.id, None)
+        if _active.get((job.kind, job.target)) is job:
+            del _active[(job.kind, job.target)]
+        _finished.append(job)
+        del _finished[:-FINISHED_JOBS_KEPT]
+        run_finished = False
+        if job.run:
+            if state == JobState.DONE:
+                job.run.succeeded += 1
+            elif state == JobState.FAILED:
+                job.run.failed += 1
+            else:
+                job.run.cancelled += 1
+            run_finished = _check_run_finished(job.run)
+    job.done_event.set()
+    if run_finished:
+        _run_finished(job.run)
+
+
+def _work() -> None:
+    while True:
+        priority, _, job = _queue.get()
+        with _lock:
+            # skip cancelled jobs and entries left over from a priority change
+            if job.state != JobState.QUEUED or priority != job.priority:
+                continue
+        # background jobs yield to playback - the job goes back to the queue so a more important one can run
+        background = job.priority == JobPriority.BACKFILL
+        if background and not admit_background_job():
+            _queue.put((priority, job.id, job))
+            wait_for_change()
+            continue
+        with _lock:
+            if job.state != JobState.QUEUED:
+                if background:
+                    background_job_finished()
+                continue
+            job.state = JobState.RUNNING
+            job.started = time.time()
+            job.attempts += 1
+            _persist('update', (job.id, {'state': job.state.value, 'attempts': job.attempts, 'started': job.started}))
+            if job.run:
+                job.run.started += 1
+                job.position = job.run.started
+
+        try:
+            success = _handlers[job.kind](job)
+            if job.cancel_event.is_set():
+                _finish_job(job, JobState.CANCELLED)
+            else:
+                _finish_job(job, JobState.DONE if success else JobState.FAILED, None if success else "Job failed")
+        except Exception as e:
+            logger.exception(f"Job {job.kind} failed for {job.target}")
+            _finish_job(job, JobState.FAILED, str(e))
+        finally:
+            if background:
+                background_job_finished()
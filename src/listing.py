@@ -0,0 +1,252 @@
+import base64
+import bisect
+import json
+import threading
+import time
+from typing import Optional, NamedTuple
+
+from files import list_files
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+HISTORY_SIZE = 5000         # number of changed entries kept for delta sync
+
+# sort key -> (field, default for missing values)
+SORT_KEYS = {
+    'created': ('created', 0),
+    'title': ('title', ''),
+    'filesize': ('filesize', 0),
+    'duration': ('duration', 0),
+    'resolution': ('resolution', 0),
+    'download_date': ('download_date', 0),
+}
+
+
+class ListQuery(NamedTuple):
+    folder: Optional[str] = None
+    favorite: Optional[bool] = None
+    partial: Optional[bool] = None
+    failed: Optional[bool] = None
+    resolution: Optional[int] = None
+    stereo: Optional[str] = None
+    title: Optional[str] = None
+    sort: str = 'created'
+    descending: bool = True
+    cursor: Optional[str] = None
+    limit: int = DEFAULT_PAGE_SIZE
+
+
+class _ListingIndex:
+    """
+    Index over one list_files result - folder buckets, lower case titles and lazily built sort orders
+    """
+    def __init__(self, files: list, generation: int):
+        self.files = files
+        self.generation = generation    # library generation of this file list
+        self.titles = [(file.get('title') or '').lower() for file in files]
+        self.by_folder: dict[str, set[int]] = {}
+        for i, file in enumerate(files):
+            self.by_folder.setdefault(file.get('folder', ''), set()).add(i)
+        self._orders: dict[str, tuple[list, list[int]]] = {}
+        self._lock = threading.Lock()
+
+    def order(self, sort: str) -> tuple[list, list[int]]:
+        """
+        :return: sorted keys (value, filename) and the file positions in the same order
+        """
+        with self._lock:
+            if sort not in self._orders:
+                field, default = SORT_KEYS[sort]
+                keyed = []
+                for i, file in enumerate(self.files):
+                    value = file.get(field)
+                    if value is None:
+                        value = default
+                    if isinstance(value, str):
+                        value = value.lower()
+                    keyed.append(((value, file.get('filename', '')), i))
+                keyed.sort(key=lambda x: x[0])
+                self._orders[sort] = ([k for k, _ in keyed], [i for _, i in keyed])
+            return self._orders[sort]
+
+
+class _LibraryHistory:
+    """
+    Library generation counter with a bounded history of changed entries.
+    Every new list_files result that differs from the previous one bumps the generation.
+    The generation starts at the current time in milliseconds so it keeps increasing over restarts,
+    history from before a restart is unknown and leads to a full resync.
+    """
+    def __init__(self):
+        self.generation = int(time.time() * 1000)
+        self.floor = self.generation        # all changes after floor are in the history
+        self.changes: list[tuple[int, str, str]] = []   # (generation, filename, kind)
+
+    def record(self, previous: Optional[list], current: list) -> None:
+        if previous is None:
+            return
+        before = {file.get('filename'): file for file in previous}
+        after = {file.get('filename'): file for file in current}
+        changes = [(name, 'added') for name in after.keys() - before.keys()]
+        changes += [(name, 'removed') for name in before.keys() - after.keys()]
+        changes += [(name, 'changed') for name, file in after.items() if name in before and before[name] != file]
+        if not changes:
+            return
+        self.generation += 1
+        self.changes.extend((self.generation, name, kind) for name, kind in changes)
+        if len(self.changes) > HISTORY_SIZE:
+            dropped = self.changes[:len(self.changes) - HISTORY_SIZE]
+            self.changes = self.changes[len(dropped):]
+            self.floor = dropped[-1][0]
+
+    def since(self, generation: int, until: int) -> Optional[dict[str, str]]:
+        """
+        :param generation: generation the client knows
+        :param until: generation of the file list the changes are reported for - newer changes are left out
+        :return: filename -> first change kind after the generation or None if the history does not reach back
+        """
+        if generation < self.floor or generation > until:
+            return None
+        first_kinds = {}
+        for change_generation, name, kind in self.changes:
+            if generation < change_generation <= until and name not in first_kinds:
+                first_kinds[name] = kind
+        return first_kinds
+
+
+_index: Optional[_ListingIndex] = None
+_history = _LibraryHistory()
+_index_lock = threading.Lock()
+
+
+def _current_index() -> _ListingIndex:
+    global _index
+    files = list_files()
+    with _index_lock:
+        index = _index
+        if index is None or index.files is not files:
+            _history.record(index.files if index else None, files)
+            index = _ListingIndex(files, _history.generation)
+            _index = index
+        return index
+
+
+def library_generation() -> int:
+    """
+    Current library generation - increases with every change of the file list
+
+    :return: generation number
+    """
+    return library_snapshot()[1]
+
+
+def library_snapshot() -> tuple[list, int]:
+    """
+    Current file list together with its generation
+
+    :return: tuple of (list_files result, generation)
+    """
+    index = _current_index()
+    return index.files, index.generation
+
+
+def list_changes(since: int) -> dict:
+    """
+    Changes of the file list since the given generation.
+    Entries added and removed again in between are not reported.
+
+    :param since: generation the client knows
+    :return: dict with generation, full_resync flag and added/changed entries and removed filenames
+    """
+    # the changes and the generation are reported for the same file list - a refresh in between is seen next time
+    index = _current_index()
+    generation = index.generation
+    with _index_lock:
+        first_kinds = _history.since(since, generation)
+    if first_kinds is None:
+        return {'generation': generation, 'full_resync': True, 'added': [], 'changed': [], 'removed': []}
+
+    current = {file.get('filename'): file for file in index.files}
+    added, changed, removed = [], [], []
+    for name, kind in first_kinds.items():
+        file = current.get(name)
+        if kind == 'added':
+            if file is not None:
+                added.append(file)
+        elif file is not None:
+            changed.append(file)
+        else:
+            removed.append(name)
+    return {'generation': generation, 'full_resync': False, 'added': added, 'changed': changed, 'removed': removed}
+
+
+def _encode_cursor(sort: str, descending: bool, key: tuple) -> str:
+    raw = json.dumps([sort, descending, list(key)], ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_cursor(cursor: str, sort: str, descending: bool) -> Optional[tuple]:
+    try:
+        cursor_sort, cursor_descending, key = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if cursor_sort != sort or cursor_descending != descending:
+        raise ValueError("Cursor does not match sort order")
+    return tuple(key)
+
+
+def _matches(index: _ListingIndex, i: int, query: ListQuery, title: Optional[str]) -> bool:
+    file = index.files[i]
+    if query.favorite is not None and bool(file.get('favorite')) != query.favorite:
+        return False
+    if query.partial is not None and bool(file.get('partial')) != query.partial:
+        return False
+    if query.failed is not None and bool(file.get('failed')) != query.failed:
+        return False
+    if query.resolution is not None and (file.get('resolution') or 0) < query.resolution:
+        return False
+    if query.stereo is not None and (file.get('stereo') or 'mono') != query.stereo:
+        return False
+    if title and title not in index.titles[i]:
+        return False
+    return True
+
+
+def query_files(query: ListQuery) -> dict:
+    """
+    Filter, sort and paginate the file list on the server.
+    The cursor is opaque for clients, it contains the sort key of the last returned item (keyset pagination),
+    so pages stay stable when files are added or removed in between.
+
+    :param query: filter, sort and page parameters
+    :return: dict with items and next_cursor (None on the last page)
+    """
+    if query.sort not in SORT_KEYS:
+        raise ValueError(f"Invalid sort key: {query.sort}")
+    limit = max(1, min(query.limit, MAX_PAGE_SIZE))
+    index = _current_index()
+    keys, positions = index.order(query.sort)
+    folder_positions = index.by_folder.get(query.folder, set()) if query.folder is not None else None
+    title = query.title.lower() if query.title else None
+
+    # start position behind the cursor in sort direction
+    if query.cursor:
+        cursor_key = _decode_cursor(query.cursor, query.sort, query.descending)
+        start = bisect.bisect_left(keys, cursor_key) - 1 if query.descending else bisect.bisect_right(keys, cursor_key)
+    else:
+        start = len(keys) - 1 if query.descending else 0
+    step = -1 if query.descending else 1
+
+    items = []
+    next_cursor = None
+    pos = start
+    while 0 <= pos < len(keys):
+        i = positions[pos]
+        if (folder_positions is None or i in folder_positions) and _matches(index, i, query, title):
+            if len(items) == limit:
+                next_cursor = _encode_cursor(query.sort, query.descending, keys[pos - step])
+                break
+            items.append(index.files[i])
+        pos += step
+
+    return {'items': items, 'next_cursor': next_cursor, 'generation': index.generation}
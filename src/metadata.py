@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Optional
+
+from loguru import logger
+
+from database.video_database import get_video_db
+
+FINGERPRINT_HASH_BYTES = 64 * 1024     # bytes read from the start and the end of a file for the content hash
+
+_lock = threading.Lock()
+_infos: Optional[dict[str, dict]] = None
+fingerprint_hash = False
+
+
+def _key(path: str) -> str:
+    return os.path.normpath(path)
+
+
+def _parse_metadata(path: str, info: dict) -> dict:
+    # the fields kept in own columns - the complete ffprobe result is stored as json next to them
+    video_stream = next((stream for stream in info.get('streams', []) if stream.get('codec_type') == 'video'), {})
+    width = video_stream.get('width', 0) or 0
+    height = video_stream.get('height', 0) or 0
+    if height > 0 and width / height == 2:
+        stereo = 'sbs'
+    elif height > 0 and width / height == 1:
+        stereo = 'tb'
+    else:
+        stereo = ''
+    try:
+        duration = float(info.get('format', {}).get('duration', 0))
+    except (TypeError, ValueError):
+        duration = 0.0
+    infos = info.get('infos', {})
+    return {
+        'path': path,
+        'duration': duration,
+        'width': width,
+        'height': height,
+        'codec': video_stream.get('codec_name'),
+        'stereo': stereo,
+        'uid': infos.get('video_uid', infos.get('unique_info')),
+        'info': json.dumps(info, ensure_ascii=False, separators=(',', ':')),
+    }
+
+
+def _load() -> dict[str, dict]:
+    global _infos
+    with _lock:
+        if _infos is None:
+            with get_video_db() as db:
+                rows = db.for_metadata_table.list_raw_metadata()
+            infos = {}
+            for path, raw in rows:
+                try:
+                    infos[path] = json.loads(raw)
+                except ValueError:
+                    logger.warning(f"Invalid video metadata stored for {path} - ignored")
+            _infos = infos
+            logger.debug(f"Loaded video metadata for {len(infos)} files")
+        return _infos
+
+
+def get_stored_video_info(path: str) -> Optional[dict]:
+    """
+    Get the stored ffprobe result of a video - all results are loaded with one query on first use
+
+    :param path: full path to the video file
+    :return: info dict as produced by get_video_info or None if the video was not probed yet
+    """
+    return _load().get(_key(path))
+
+
+def store_video_infos(infos: dict[str, dict]) -> None:
+    """
+    Store ffprobe results in the database and in memory
+
+    :param infos: dict of full video path -> info dict
+    """
+    if not infos:
+        return
+    infos = {_key(path): info for path, info in infos.items()}
+    with get_video_db() as db:
+        db.for_metadata_table.store_metadata([_parse_metadata(path, info) for path, info in infos.items()])
+    loaded = _load()
+    with _lock:
+        loaded.update(infos)
+
+
+def store_video_info(path: str, info: dict) -> None:
+    store_video_infos({path: info})
+
+
+def move_video_info(path: str, new_path: str) -> None:
+    """
+    Keep the stored info of a moved video under its new path
+    """
+    path, new_path = _key(path), _key(new_path)
+    with get_video_db() as db:
+        db.for_metadata_table.move_metadata(path, new_path)
+    loaded = _load()
+    with _lock:
+        info = loaded.pop(path, None)
+        if info is not None:
+            loaded[new_path] = info
+
+
+def delete_video_infos(paths: list[str]) -> None:
+    paths = [_key(path) for path in paths]
+    with get_video_db() as db:
+        db.for_metadata_table.delete_metadata(paths)
+    loaded = _load()
+    with _lock:
+        for path in paths:
+            loaded.pop(path, None)
+
+
+def set_fingerprint_hash(enabled: bool) -> None:
+    """
+    Add a partial content hash to the source fingerprints - a changed mtime with the same size
+    is then only stale if the content changed too (e.g. not for a copied or touched file)
+
+    :param enabled: hash the start and the end of the video files
+    """
+    global fingerprint_hash
+    fingerprint_hash = enabled
+
+
+def _content_hash(path: str, size: int) -> Optional[str]:
+    try:
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read(FINGERPRINT_HASH_BYTES))
+            if size > 2 * FINGERPRINT_HASH_BYTES:
+                f.seek(-FINGERPRINT_HASH_BYTES, os.SEEK_END)
+                digest.update(f.read(FINGERPRINT_HASH_BYTES))
+    except OSError as e:
+        logger.warning(f"Failed to hash {path}: {e}")
+        return None
+    return digest.hexdigest()
+
+
+def source_fingerprint(path: str, stat: os.stat_result = None) -> Optional[dict]:
+    """
+    Fingerprint of a video file - kept in the infos of the video info as 'source'
+
+    :param path: full path to the video file
+    :param stat: stat result of the file if already known
+    :return: dict with size, mtime (ns) and hash (only with set_fingerprint_hash) or None if the file is not accessible
+    """
+    try:
+        stat = stat or os.stat(path)
+    except OSError:
+        return None
+    fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if fingerprint_hash:
+        fingerprint['hash'] = _content_hash(path, stat.st_size)
+    return fingerprint
+
+
+def is_stale(path: str, info: dict, stat: os.stat_result) -> Optional[bool]:
+    """
+    Check if the stored info (and with it thumbnails and similarity features) was created from another version of the file.
+    A different size is always stale, a different mtime only if there is no content hash or the hash differs.
+
+    :param path: full path to the video file
+    :param info: stored video info
+    :param stat: current stat result of the file
+    :return: True if stale, False if not, None if the info has no fingerprint (probed before fingerprints were recorded)
+    """
+    source = (info.get('infos') or {}).get('source')
+    if not source:
+        # the size reported by ffprobe still tells a replaced file with another size
+        size = (info.get('format') or {}).get('size')
+        return True if size and str(size) != str(stat.st_size) else None
+    if source.get('size') != stat.st_size:
+        return True
+    if source.get('mtime') == stat.st_mtime_ns:
+        return False
+    if fingerprint_hash and source.get('hash'):
+        return _content_hash(path, stat.st_size) != source['hash']
+    return True
+
+
+def stored_video_info_paths() -> list[str]:
+    """
+    :return: paths of all videos with stored info
+    """
+    loaded = _load()
+    with _lock:
+        return list(loaded)
@@ -1,3 +1,4 @@
+from .migrate_metadata import migrate_video_metadata_from_sidecars
 from .migrate_online import migrate_online_db_duration_description
 from .migrate_similarity import migrate_similar_table_histogramm_phash
 from .migrate_utils import already_migrated, track_migration
@@ -7,6 +8,7 @@ def migrate():
     migrate_tracking()
     migrate_similar_table_histogramm_phash()
     migrate_online_db_duration_description()
+    migrate_video_metadata_from_sidecars()
 
 
 def migrate_tracking():
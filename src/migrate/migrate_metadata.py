@@ -0,0 +1,37 @@
+import json
+import os
+
+from loguru import logger
+
+from globals import VideoFolder, get_static_directory, THUMBNAIL_DIR_NAME
+from metadata import store_video_infos
+from migrate.migrate_utils import already_migrated, track_migration
+from thumbnail import ThumbnailFormat
+from traversal import walk_directories
+
+
+def migrate_video_metadata_from_sidecars():
+    if not already_migrated('video_metadata_sidecars'):
+        # import the ffprobe json files of the .thumb folders into the video_metadata table - the files are kept
+        infos = {}
+        for folder in VideoFolder:
+            video_dir = os.path.join(get_static_directory(), folder.dir)
+            if not os.path.isdir(video_dir):
+                continue
+            for record in walk_directories(video_dir, stat_files=False):
+                if THUMBNAIL_DIR_NAME not in record.hidden:
+                    continue
+                thumb_dir = os.path.join(record.path, THUMBNAIL_DIR_NAME)
+                sidecars = set(os.listdir(thumb_dir))
+                for file in record.files:
+                    sidecar = f"{file.name}{ThumbnailFormat.JSON.extension}"
+                    if sidecar not in sidecars:
+                        continue
+                    try:
+                        with open(os.path.join(thumb_dir, sidecar), 'r', encoding='utf-8') as f:
+                            infos[file.path] = json.load(f)
+                    except (OSError, ValueError) as e:
+                        logger.warning(f"Skipping invalid video info {sidecar}: {e}")
+        store_video_infos(infos)
+        track_migration('video_metadata_sidecars')
+        print(f"Migrated video metadata from {len(infos)} json files")
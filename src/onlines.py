@@ -1,4 +1,5 @@
 from cache import cache
+from database.search_table_functions import ONLINE
 from database.video_database import get_video_db
 from database.video_models import Videos
 
@@ -32,4 +33,5 @@ def delete_online(url: str):
     list_onlines.cache__clear()
     with get_video_db() as db:
         db.for_online_table.delete_online(url)
+        db.for_search_table.delete_documents(ONLINE, [url])
     return {'success': True, 'message': 'Online entry deleted successfully.'}
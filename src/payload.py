@@ -0,0 +1,88 @@
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, Any
+
+from flask import Response, current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+MAX_PAYLOADS = 16       # payloads kept - least recently used ones are dropped (e.g. one per host name of the server)
+
+
+class _Payload:
+    """
+    One serialized response body kept ready to send - raw and compressed
+    """
+    def __init__(self, sources: tuple, body: bytes, etag: str):
+        self.sources = sources
+        self.etag = etag
+        self.encoded = {'identity': body, 'gzip': gzip.compress(body, compresslevel=GZIP_LEVEL)}
+        if brotli is not None:
+            self.encoded['br'] = brotli.compress(body, quality=BROTLI_QUALITY)
+
+    def matches(self, sources: tuple) -> bool:
+        # compare by identity - the cached lists are replaced, never modified in place
+        return len(sources) == len(self.sources) and all(a is b for a, b in zip(sources, self.sources))
+
+    def etag_for(self, encoding: str) -> str:
+        # the encoded bodies differ - a strong etag must too
+        return self.etag if encoding == 'identity' else f"{self.etag}-{encoding}"
+
+
+_payloads: OrderedDict[str, _Payload] = OrderedDict()
+_lock = threading.Lock()
+
+
+def _negotiate_encoding(payload: _Payload) -> str:
+    accepted = request.accept_encodings
+    for encoding in ('br', 'gzip'):
+        if encoding in payload.encoded and accepted[encoding] > 0:
+            return encoding
+    return 'identity'
+
+
+def json_payload_response(name: str, sources: tuple, build: Callable[[], Any],
+                          etag: Optional[str] = None) -> Response:
+    """
+    Send a JSON response that is serialized and compressed only once per change of its sources.
+    The payload is rebuilt if any of the source objects is replaced (e.g. a cleared cache produced a new list).
+    Honors If-None-Match with a 304 and sends brotli or gzip encoded bytes when the client accepts them.
+
+    :param name: name of the payload - one payload is kept per name, at most MAX_PAYLOADS names
+    :param sources: objects the payload is built from, compared by identity
+    :param build: function returning the data to serialize
+    :param etag: optional etag value (e.g. derived from the library generation), default is a hash of the body
+    :return: response
+    """
+    with _lock:
+        payload = _payloads.get(name)
+        if payload is not None:
+            _payloads.move_to_end(name)
+    if payload is None or not payload.matches(sources) or (etag is not None and payload.etag != etag):
+        body = current_app.json.dumps(build()).encode('utf-8')
+        payload = _Payload(sources, body, etag or hashlib.sha1(body).hexdigest())
+        with _lock:
+            _payloads[name] = payload
+            _payloads.move_to_end(name)
+            while len(_payloads) > MAX_PAYLOADS:
+                _payloads.popitem(last=False)
+
+    encoding = _negotiate_encoding(payload)
+    payload_etag = payload.etag_for(encoding)
+    if payload_etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(payload.encoded[encoding], mimetype='application/json')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(payload_etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
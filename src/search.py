@@ -0,0 +1,102 @@
+import re
+import threading
+
+from loguru import logger
+
+from database.search_table_functions import VIDEO, ONLINE
+from database.video_database import get_video_db
+from files import list_files
+from migrate.migrate_utils import already_migrated, track_migration
+from onlines import list_onlines
+
+DEFAULT_SEARCH_LIMIT = 50
+MAX_SEARCH_LIMIT = 500
+
+_rebuild_lock = threading.Lock()
+
+
+def rebuild_search_index() -> int:
+    """
+    Rebuild the full text search index from the file list and the online entries
+
+    :return: number of indexed documents
+    """
+    files = list_files()
+    with get_video_db() as db:
+        onlines = db.for_online_table.list_online()
+        db.for_search_table.clear()
+        db.for_search_table.store_videos(files)
+        db.for_search_table.store_onlines(onlines)
+        count = db.for_search_table.count()
+    logger.info(f"Search index rebuilt with {count} documents")
+    return count
+
+
+def _ensure_index() -> None:
+    # the index is kept up to date incrementally - it only needs to be built once for existing libraries
+    with _rebuild_lock:
+        if not already_migrated('search_index'):
+            rebuild_search_index()
+            track_migration('search_index')
+
+
+def _match_expression(text: str) -> str:
+    # every word has to match, words are matched as prefix - quoting keeps FTS5 syntax characters out
+    return ' '.join(f'"{token}"*' for token in re.findall(r'\w+', text))
+
+
+def _fallback_search(text: str, limit: int, kind: str = None) -> list[dict]:
+    # substring search for sqlite builds without FTS5
+    tokens = [token.lower() for token in re.findall(r'\w+', text)]
+    results = []
+    if kind in (None, VIDEO):
+        for file in list_files():
+            haystack = ' '.join(str(file.get(k) or '') for k in ('title', 'basename', 'folder', 'url')).lower()
+            if all(token in haystack for token in tokens):
+                results.append({**file, 'kind': VIDEO})
+    if kind in (None, ONLINE):
+        for online in list_onlines():
+            haystack = ' '.join(str(online.get(k) or '') for k in ('title', 'original_url', 'description')).lower()
+            if all(token in haystack for token in tokens):
+                results.append({**online, 'kind': ONLINE})
+    return results[:limit]
+
+
+def search_library(text: str, limit: int = DEFAULT_SEARCH_LIMIT, kind: str = None) -> list[dict]:
+    """
+    Full text search over title, file name, folder and source url of the videos
+    and title, url and description of the online entries.
+    Words are prefix matched, results are ranked by relevance (bm25).
+
+    :param text: search text
+    :param limit: maximum number of results
+    :param kind: optional restriction to 'video' or 'online'
+    :return: list of file details or online entries with an additional kind key - best match first
+    """
+    if kind not in (None, VIDEO, ONLINE):
+        raise ValueError(f"Invalid kind: {kind}")
+    limit = max(1, min(limit, MAX_SEARCH_LIMIT))
+    match = _match_expression(text or '')
+    if not match:
+        return []
+
+    # refreshes the catalog and with it the index for changed files
+    files = list_files()
+    with get_video_db() as db:
+        available = db.for_search_table.available
+    if not available:
+        return _fallback_search(text, limit, kind)
+
+    _ensure_index()
+    with get_video_db() as db:
+        hits = db.for_search_table.search(match, limit, kind)
+
+    files_by_url = {file['filename']: file for file in files}
+    onlines_by_url = {online['original_url']: online for online in list_onlines()} if any(
+        hit_kind == ONLINE for hit_kind, _, _ in hits) else {}
+    results = []
+    for hit_kind, key, rank in hits:
+        item = files_by_url.get(key) if hit_kind == VIDEO else onlines_by_url.get(key)
+        if item is not None:
+            results.append({**item, 'kind': hit_kind})
+    return results
@@ -1,15 +1,25 @@
+import math
+import multiprocessing
 import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import NamedTuple
 
 import cv2
 import numpy as np
-from PIL import Image
+from loguru import logger
 from numpy import ndarray
 
+from bus import push_text_to_client
 from cache import cache
 from database.video_database import get_video_db
-from files import find_file_info
+from files import find_file_info, list_files
 from globals import get_real_path_from_url, get_thumbnail_directory
+from migrate.migrate_utils import already_migrated, track_migration
+from similarity_features import extract_features
+from similarity_index import SimilarityIndex
 from thumbnail import ThumbnailFormat
 
 class SimilarityFeatures(NamedTuple):
@@ -17,6 +27,20 @@ class SimilarityFeatures(NamedTuple):
     phash: ndarray
     hog: ndarray
 
+
+HIST_WEIGHT = 0.4
+PHASH_WEIGHT = 0.2
+HOG_WEIGHT = 0.4
+
+DUPLICATES_MEMORY_BUDGET = 64 * 1024 ** 2  # bytes for the intermediate results of one block of the pairwise scores
+PAIR_BYTES = 48                             # bytes per pair in a block - score matrices and the packed phash xor
+HIST_EPSILON = np.finfo(np.float64).eps     # compareHist returns 1 for a correlation with a denominator below
+INDEX_MIN_VIDEOS = 2000                     # smaller libraries are searched exactly, no approximate index
+SIMILARITY_CACHE_TTL = 3600                 # seconds until the feature matrix and the index are built again
+NEIGHBORS_K = 20                            # best matches stored per video in the similarity_neighbors table
+FEATURE_WORKERS = min(os.cpu_count() or 1, 4)  # processes decoding thumbnails for the similarity features
+FEATURE_BATCH_SIZE = 100                    # features written per transaction when built for many videos
+
 def _calc_cosine_similarity(phash_features_a: np.ndarray, phash_features_b: np.ndarray) -> float:
     if phash_features_a is None or phash_features_b is None:
         score = 0
@@ -87,22 +111,393 @@ def similar_compare(features_a: SimilarityFeatures, features_b: SimilarityFeatur
         score_hog = score_hog if score_hog > 0 else 0
 
     # combine the score 4:2:4
-    score = (0.4 * score_hist) + (0.2 * score_phash) + (0.4 * score_hog)
+    score = (HIST_WEIGHT * score_hist) + (PHASH_WEIGHT * score_phash) + (HOG_WEIGHT * score_hog)
 
     return score
 
+class FeatureMatrix:
+    """
+    The features of all videos stacked into contiguous matrices - one video is scored against all rows
+    with a few matrix operations instead of a similar_compare call per video.
+    The scores are the same as similar_compare (within float rounding).
+
+    Videos with feature sizes different from the majority (e.g. features of an older version)
+    can not be compared and are left out.
+
+    The matrices are views of buffers with spare rows - with_features returns a matrix with one more row
+    without copying the others (the buffers grow by doubling) and writes a replaced row in place.
+    Matrices returned before keep their number of rows.
+    """
+    def __init__(self, all_features: dict[str, SimilarityFeatures]):
+        shapes = Counter(self._shape(features) for features in all_features.values())
+        self.shape = shapes.most_common(1)[0][0] if shapes else ((0,), (0,), (0,))
+        self.urls = [url for url, features in all_features.items() if self._shape(features) == self.shape]
+        self.index = {url: i for i, url in enumerate(self.urls)}
+        self.phash_bits = self.shape[1][0]
+        self.hist, self.hist_sq, self.phash, self.hog = self._prepare([all_features[url] for url in self.urls], self.shape)
+        self._buffers = _RowBuffers((self.hist, self.hist_sq, self.phash, self.hog), len(self.urls))
+
+    @classmethod
+    def _prepare(cls, rows: list[SimilarityFeatures], shape: tuple) -> tuple[ndarray, ndarray, ndarray, ndarray]:
+        hist_size, phash_size, hog_size = (size[0] for size in shape)
+
+        # histogram correlation - rows centered and normalized once, compareHist works in double precision
+        hist = cls._stack([features.histogram for features in rows], hist_size, np.float64)
+        hist = hist - hist.mean(axis=1, keepdims=True) if hist.size else hist
+        hist_sq = np.einsum('ij,ij->i', hist, hist)
+        norms = np.sqrt(hist_sq)[:, None]
+        hist = np.divide(hist, norms, out=np.zeros_like(hist), where=norms != 0)
+
+        # phash packed into 64 bit words - hamming distance is a popcount of the xor
+        phash = cls._pack_phash(cls._stack([features.phash for features in rows], phash_size, np.int64))
+
+        # hog cosine similarity - rows normalized once, zero rows stay zero (score 0 like similar_compare)
+        hog = cls._stack([features.hog for features in rows], hog_size, np.float32)
+        norms = np.linalg.norm(hog, axis=1, keepdims=True)
+        hog = np.divide(hog, norms, out=np.zeros_like(hog), where=norms != 0)
+        return hist, hist_sq, phash, hog
+
+    def with_features(self, url: str, features: SimilarityFeatures) -> tuple['FeatureMatrix', int | None]:
+        """
+        Matrix with the features of one video added or replaced - call with _similarity_lock held.
+        An added row is written behind the rows of this matrix, its readers are not affected.
+        A replaced row is written in place.
+
+        :param url: video url
+        :param features: new features of the video
+        :return: the new matrix and the row of the video or None if the features have another size
+        """
+        if not self.urls:
+            matrix = FeatureMatrix({url: features})
+            return matrix, 0
+        if self._shape(features) != self.shape:
+            return self, None
+        row_values = tuple(values[0] for values in self._prepare([features], self.shape))
+        matrix = object.__new__(FeatureMatrix)
+        matrix.shape, matrix.phash_bits = self.shape, self.phash_bits
+        row = self.index.get(url)
+        if row is not None:
+            buffers = self._buffers
+            matrix.urls, matrix.index = self.urls, self.index
+        else:
+            row = len(self.urls)
+            # the buffers may already hold rows of another matrix derived from this one - then they are copied
+            buffers = self._buffers if self._buffers.used == row else self._buffers.copy(row)
+            matrix.urls = self.urls + [url]
+            matrix.index = {**self.index, url: row}
+        buffers.write(row, row_values)
+        matrix._buffers = buffers
+        matrix.hist, matrix.hist_sq, matrix.phash, matrix.hog = buffers.rows(len(matrix.urls))
+        return matrix, row
+
+    @staticmethod
+    def _shape(features: SimilarityFeatures) -> tuple:
+        return features.histogram.shape, features.phash.shape, features.hog.shape
+
+    @staticmethod
+    def _stack(arrays: list[ndarray], size: int, dtype) -> ndarray:
+        if not arrays:
+            return np.zeros((0, size), dtype=dtype)
+        return np.ascontiguousarray(np.stack(arrays), dtype=dtype)
+
+    @staticmethod
+    def _pack_phash(phash: ndarray) -> ndarray:
+        packed = np.packbits(phash != 0, axis=1)
+        padding = -packed.shape[1] % 8
+        if padding:
+            packed = np.pad(packed, ((0, 0), (0, padding)))
+        return np.ascontiguousarray(packed).view(np.uint64)
+
+    def __len__(self):
+        return len(self.urls)
+
+    def scores(self, features: SimilarityFeatures, rows: ndarray = None) -> ndarray:
+        """
+        Score the features against the rows of the matrix
+
+        :param features: features to compare
+        :param rows: optional row indexes to score, default all rows
+        :return: similar_compare score for each row (same order as urls or rows) - all 0 for features of another size
+        """
+        rows = slice(None) if rows is None else rows
+        count = self.hist[rows].shape[0]
+        if self._shape(features) != self.shape:
+            return np.zeros(count)
+
+        query_hist = features.histogram.astype(np.float64)
+        query_hist = query_hist - query_hist.mean()
+        query_sq = np.dot(query_hist, query_hist)
+        score = self.hist[rows] @ (query_hist / np.sqrt(query_sq)) if query_sq else np.zeros(count)
+        # correlation of a constant histogram is 1 in compareHist
+        score[self.hist_sq[rows] * query_sq <= HIST_EPSILON] = 1.0
+        np.maximum(score, 0, out=score)
+        score *= HIST_WEIGHT
+
+        query_hog = features.hog.astype(np.float32)
+        norm = np.linalg.norm(query_hog)
+        if norm != 0:
+            score += HOG_WEIGHT * np.maximum(self.hog[rows] @ (query_hog / norm), 0)
+
+        if self.phash_bits:
+            query_phash = self._pack_phash(features.phash[None, :])
+            distance = np.bitwise_count(self.phash[rows] ^ query_phash).sum(axis=1, dtype=np.int64)
+            score += PHASH_WEIGHT * (1 - distance / self.phash_bits)
+        return score
+
+    def pair_scores(self, rows_a: slice, rows_b: slice) -> ndarray:
+        """
+        Score all pairs of two row ranges
+
+        :return: matrix of similar_compare scores with one row per row of rows_a and one column per row of rows_b
+        """
+        score = self.hist[rows_a] @ self.hist[rows_b].T
+        hist_sq_a, hist_sq_b = self.hist_sq[rows_a], self.hist_sq[rows_b]
+        if hist_sq_a.size and hist_sq_b.size and hist_sq_a.min() * hist_sq_b.min() <= HIST_EPSILON:
+            score[np.outer(hist_sq_a, hist_sq_b) <= HIST_EPSILON] = 1.0
+        np.maximum(score, 0, out=score)
+        score *= HIST_WEIGHT
+
+        score_hog = self.hog[rows_a] @ self.hog[rows_b].T
+        np.maximum(score_hog, 0, out=score_hog)
+        score_hog *= HOG_WEIGHT
+        score += score_hog
+
+        if self.phash_bits:
+            distance = np.bitwise_count(self.phash[rows_a][:, None, :] ^ self.phash[rows_b][None, :, :]).sum(axis=2, dtype=np.int64)
+            score += PHASH_WEIGHT * (1 - distance / self.phash_bits)
+        return score
+
+    def similar(self, url: str, features: SimilarityFeatures, similarity_threshold: float,
+                rows: ndarray = None) -> list[tuple[str, float]]:
+        """
+        :param rows: optional candidate rows to score, default all rows
+        :return: list of (url, score) above the threshold without the video itself - in library order
+        """
+        scores = self.scores(features, rows)
+        rows = np.arange(len(self.urls)) if rows is None else rows
+        return [(self.urls[rows[i]], float(scores[i])) for i in np.flatnonzero(scores > similarity_threshold)
+                if self.urls[rows[i]] != url]
+
+    def query_values(self, features: SimilarityFeatures) -> tuple[ndarray, ndarray] | None:
+        """
+        :return: packed phash and normalized hog of the features as used by the index or None for another feature size
+        """
+        if self._shape(features) != self.shape:
+            return None
+        _, _, phash, hog = self._prepare([features], self.shape)
+        return phash[0], hog[0]
+
+
+class _RowBuffers:
+    """
+    Backing arrays of the feature matrices with spare rows - grown by doubling when full
+    """
+    def __init__(self, arrays: tuple[ndarray, ...], used: int):
+        self.arrays = arrays
+        self.used = used
+
+    def copy(self, used: int) -> '_RowBuffers':
+        return _RowBuffers(tuple(array[:used].copy() for array in self.arrays), used)
+
+    def write(self, row: int, values: tuple[ndarray, ...]) -> None:
+        if row >= len(self.arrays[0]):
+            capacity = max(2 * len(self.arrays[0]), 16)
+            grown = []
+            for array in self.arrays:
+                buffer = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+                buffer[:self.used] = array[:self.used]
+                grown.append(buffer)
+            self.arrays = tuple(grown)
+        for array, value in zip(self.arrays, values):
+            array[row] = value
+        self.used = max(self.used, row + 1)
+
+    def rows(self, count: int) -> tuple[ndarray, ...]:
+        return tuple(array[:count] for array in self.arrays)
+
+
+_similarity_lock = threading.Lock()
+_matrix: FeatureMatrix | None = None
+_index: SimilarityIndex | None = None
+_matrix_built = 0.0
+
+
 def clear_similarity_cache():
-    _all_features.cache__clear()
+    """
+    Drop all cached features - the feature matrix and the index are built again on next use
+    """
+    global _matrix, _index
+    with _similarity_lock:
+        _all_features.cache__clear()
+        _matrix, _index = None, None
+    _duplicate_clusters.cache__clear()
+
+
+def update_similarity_features(video_url: str, features: SimilarityFeatures) -> None:
+    """
+    Update the cached features of one video after its features were stored - instead of clear_similarity_cache,
+    the feature matrix and the index are updated incrementally
+
+    :param video_url: url of the video
+    :param features: the stored features
+    """
+    global _matrix
+    with _similarity_lock:
+        _all_features()[video_url] = features
+        if _matrix is not None:
+            _matrix, row = _matrix.with_features(video_url, features)
+            if _index is not None and row is not None:
+                _index.update(row, *_matrix.query_values(features))
+    _duplicate_clusters.cache__clear()
+    _update_neighbors(video_url, features)
+
+def _unpack(histogram: bytes, phash: bytes, hog: bytes) -> SimilarityFeatures:
+    return SimilarityFeatures(np.frombuffer(histogram, dtype=np.float32),
+                              np.frombuffer(phash, dtype=np.int64),
+                              np.frombuffer(hog, dtype=np.float32))
+
 
 @cache(ttl=3600)
 def _all_features() -> dict[str, SimilarityFeatures]:
     with get_video_db() as db:
         all_features = db.for_similarity_table.list_similarity()
-        return {row.video.video_url: SimilarityFeatures(np.frombuffer(row.histogramm, dtype=np.float32),
-                                      np.frombuffer(row.phash, dtype=np.int64),
-                                      np.frombuffer(row.hog, dtype=np.float32)) for row in all_features}
+        return {row.video.video_url: _unpack(row.histogramm, row.phash, row.hog) for row in all_features}
+
+
+def _feature_matrix() -> FeatureMatrix:
+    global _matrix, _index, _matrix_built
+    with _similarity_lock:
+        if _matrix is None or time.monotonic() - _matrix_built > SIMILARITY_CACHE_TTL:
+            _matrix, _index = FeatureMatrix(_all_features()), None
+            _matrix_built = time.monotonic()
+        return _matrix
+
+
+def _similarity_index() -> SimilarityIndex | None:
+    """
+    Approximate index over the feature matrix - built lazily, None for small libraries (searched exactly)
+    """
+    global _index
+    matrix = _feature_matrix()
+    if len(matrix) < INDEX_MIN_VIDEOS:
+        return None
+    with _similarity_lock:
+        if _index is None and matrix is _matrix:
+            _index = SimilarityIndex(matrix.phash, matrix.hog)
+        return _index
 
 
+_neighbors_lock = threading.Lock()
+
+
+def _top_neighbors(scores: ndarray, count: int) -> ndarray:
+    # rows of the best scores - best first
+    count = min(count, len(scores))
+    if count <= 0:
+        return np.zeros(0, dtype=np.int64)
+    best = np.argpartition(-scores, count - 1)[:count]
+    return best[np.argsort(-scores[best], kind='stable')]
+
+
+def _neighbor_rows(matrix: FeatureMatrix, row: int, scores: ndarray) -> list[dict]:
+    scores = scores.copy()
+    scores[row] = -np.inf
+    return [{'video_url': matrix.urls[row], 'neighbor_url': matrix.urls[i], 'score': float(scores[i])}
+            for i in _top_neighbors(scores, NEIGHBORS_K) if np.isfinite(scores[i])]
+
+
+def rebuild_similarity_neighbors() -> int:
+    """
+    Calculate the NEIGHBORS_K best matches of all videos and store them in the similarity_neighbors table.
+    All pairs are scored once in blocks (see _cluster_pairs), the best matches are merged per block.
+
+    :return: number of stored neighbors
+    """
+    with _neighbors_lock:
+        matrix = _feature_matrix()
+        count = len(matrix)
+        keep = min(NEIGHBORS_K, max(count - 1, 0))
+        best_scores = np.full((count, keep), -np.inf)
+        best_rows = np.zeros((count, keep), dtype=np.int64)
+
+        def merge(start: int, scores: ndarray, columns: ndarray) -> None:
+            rows = slice(start, start + scores.shape[0])
+            merged_scores = np.concatenate([best_scores[rows], scores], axis=1)
+            merged_rows = np.concatenate([best_rows[rows], np.broadcast_to(columns, scores.shape)], axis=1)
+            best = np.argpartition(-merged_scores, keep - 1, axis=1)[:, :keep]
+            best_scores[rows] = np.take_along_axis(merged_scores, best, axis=1)
+            best_rows[rows] = np.take_along_axis(merged_rows, best, axis=1)
+
+        block = max(1, math.isqrt(DUPLICATES_MEMORY_BUDGET // (PAIR_BYTES + 8 * matrix.phash.shape[1])))
+        for start_a in range(0, count if keep else 0, block):
+            end_a = min(start_a + block, count)
+            for start_b in range(start_a, count, block):
+                end_b = min(start_b + block, count)
+                scores = matrix.pair_scores(slice(start_a, end_a), slice(start_b, end_b))
+                if start_a == start_b:
+                    np.fill_diagonal(scores, -np.inf)
+                merge(start_a, scores, np.arange(start_b, end_b))
+                if start_a != start_b:
+                    merge(start_b, scores.T, np.arange(start_a, end_a))
+
+        neighbors = [{'video_url': matrix.urls[row], 'neighbor_url': matrix.urls[neighbor], 'score': float(score)}
+                     for row in range(count) for neighbor, score in zip(best_rows[row].tolist(), best_scores[row].tolist())
+                     if score != -np.inf]
+        with get_video_db() as db:
+            db.for_similarity_table.clear_neighbors()
+            db.for_similarity_table.store_neighbors(neighbors)
+        track_migration('similarity_neighbors')
+    logger.info(f"Similarity neighbors rebuilt for {count} videos")
+    return len(neighbors)
+
+
+def _ensure_neighbors() -> None:
+    # the table is kept up to date incrementally - it only needs to be built once for existing libraries
+    if not already_migrated('similarity_neighbors'):
+        rebuild_similarity_neighbors()
+
+
+def _update_neighbors(video_url: str, features: SimilarityFeatures) -> None:
+    """
+    Update the similarity_neighbors table for the new features of one video - its own list is calculated again,
+    it is added to the lists of the videos it is now one of the best matches for. Lists it was in before are
+    calculated again, with changed features it may drop out and the next best match is not known otherwise.
+    """
+    if not already_migrated('similarity_neighbors'):
+        rebuild_similarity_neighbors()
+        return
+    with _neighbors_lock:
+        matrix = _feature_matrix()
+        row = matrix.index.get(video_url)
+        if row is None:
+            return
+        scores = matrix.scores(features)
+        with get_video_db() as db:
+            table = db.for_similarity_table
+            previous = set(table.remove_neighbor(video_url))
+            table.delete_neighbors([video_url])
+            table.store_neighbors(_neighbor_rows(matrix, row, scores))
+
+            entered = []
+            bounds = table.neighbor_list_bounds()
+            for other_row, other_url in enumerate(matrix.urls):
+                if other_row == row or other_url in previous:
+                    continue
+                count, lowest = bounds.get(other_url, (0, 0.0))
+                if count < NEIGHBORS_K or scores[other_row] > lowest:
+                    entered.append({'video_url': other_url, 'neighbor_url': video_url, 'score': float(scores[other_row])})
+            table.store_neighbors(entered)
+            table.trim_neighbors([neighbor['video_url'] for neighbor in entered], NEIGHBORS_K)
+
+            all_features = _all_features()
+            for other_url in previous:
+                other_row = matrix.index.get(other_url)
+                if other_row is not None and other_url in all_features:
+                    table.delete_neighbors([other_url])
+                    table.store_neighbors(_neighbor_rows(matrix, other_row, matrix.scores(all_features[other_url])))
+        logger.debug(f"Similarity neighbors updated for {video_url}: entered {len(entered)} lists, "
+                     f"{len(previous)} lists calculated again")
+
 
 def find_similar(provided_video_path, similarity_threshold=0.6, limit=10) -> list:
     """
@@ -110,45 +505,68 @@ def find_similar(provided_video_path, similarity_threshold=0.6, limit=10) -> lis
     Currently only compares the similarity of the thumbnail images.
     Current video path is not included in the result
 
+    Up to NEIGHBORS_K results are read from the similarity_neighbors table, more are calculated.
+    Videos with features but without a neighbor list (yet) are calculated too.
+
     :param provided_video_path: for which to find similar videos
     :param similarity_threshold: threshold for similarity default 0.4
     :param limit: number of similar videos to return default 10
     :return: list of similar videos with similarity score (tuple)
     """
 
-    all_features = _all_features()
-    provided_features = all_features.get(provided_video_path)
+    if limit <= NEIGHBORS_K:
+        _ensure_neighbors()
+        with get_video_db() as db:
+            neighbors = db.for_similarity_table.list_neighbors(provided_video_path, similarity_threshold, limit)
+            listed = bool(neighbors) or db.for_similarity_table.has_neighbors(provided_video_path)
+        if listed:
+            files = {file['filename']: file for file in list_files()}
+            return [(video_url, int(score * 100), files[video_url]) for video_url, score in neighbors if video_url in files]
+
+    provided_features = _all_features().get(provided_video_path)
     if provided_features is None:
         return []
 
-    similars = _build_similar_list(all_features, provided_features, provided_video_path, similarity_threshold)
+    # large libraries - a shortlist from the index is re-ranked with the exact score
+    index = _similarity_index()
+    matrix = _feature_matrix()
+    rows = None
+    query_values = matrix.query_values(provided_features) if index is not None else None
+    if query_values is not None:
+        rows = index.candidates(*query_values)
+        rows = rows[rows < len(matrix)]
+
+    similars = _build_similar_list(matrix, provided_features, provided_video_path, similarity_threshold, rows)
     return similars[:limit]
 
 
-def _build_similar_list(all_features, compare_features, compare_video_path, similarity_threshold):
+def _build_similar_list(matrix: FeatureMatrix, compare_features, compare_video_path, similarity_threshold, rows=None):
     similars = []
-    for video_path, features in all_features.items():
-        if video_path == compare_video_path:  # ignore myself in the comparison
-            continue
-        similar = similar_compare(compare_features, features)
-        if similar > similarity_threshold:
-            file_info = find_file_info(video_path)
-            if file_info:
-                similars.append((video_path, int(similar * 100), file_info))
+    for video_path, similar in matrix.similar(compare_video_path, compare_features, similarity_threshold, rows):
+        file_info = find_file_info(video_path)
+        if file_info:
+            similars.append((video_path, int(similar * 100), file_info))
     # Sort similar images by similarity score in descending order
     similars.sort(key=lambda x: x[1], reverse=True)
     return similars
 
 
-def build_features_for_video(video_url: str) -> SimilarityFeatures | None:
-    """
-    Build the features for the given video_url and return the features
-    uses the thumbnail webm file to get a histogram and phash of the video
+_feature_pool: ProcessPoolExecutor | None = None
+_feature_pool_lock = threading.Lock()
+
+
+def _features_pool() -> ProcessPoolExecutor:
+    # spawned processes - forking the threaded server could copy locks held by other threads into the children,
+    # worker processes are only started when needed. Each worker imports main.py again, which only loads the server
+    # in main() - the workers just hold similarity_features with numpy and opencv
+    global _feature_pool
+    with _feature_pool_lock:
+        if _feature_pool is None:
+            _feature_pool = ProcessPoolExecutor(max_workers=FEATURE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _feature_pool
 
-    :param video_url: url of the video to build features
-    :return: features for the video tuple (histogram, phash, hog) or None if not possible
-    """
 
+def _thumbnail_for_features(video_url: str) -> str | None:
     if not video_url:
         return None
 
@@ -159,11 +577,66 @@ def build_features_for_video(video_url: str) -> SimilarityFeatures | None:
     base_name = os.path.basename(file_path)
     thumbnail_dir = get_thumbnail_directory(file_path)
     thumbnail_file = os.path.join(thumbnail_dir, f"{base_name}{ThumbnailFormat.WEBP.extension}")
-    if os.path.isfile(thumbnail_file):
-        return _create_video_features_for_similarity_compare(thumbnail_file)
+    return thumbnail_file if os.path.isfile(thumbnail_file) else None
+
+
+def build_features_for_video(video_url: str) -> SimilarityFeatures | None:
+    """
+    Build the features for the given video_url and return the features
+    uses the thumbnail webm file to get a histogram and phash of the video.
+    The thumbnail is decoded in the feature pool - do not hold a database session while waiting.
+
+    :param video_url: url of the video to build features
+    :return: features for the video tuple (histogram, phash, hog) or None if not possible
+    """
+    thumbnail_file = _thumbnail_for_features(video_url)
+    if thumbnail_file:
+        return _unpack(*_features_pool().submit(extract_features, thumbnail_file).result())
     return None
 
 
+def build_features_for_videos(video_urls: list[str]) -> dict[str, SimilarityFeatures]:
+    """
+    Build and store the features of many videos (scan, watcher) - the thumbnails are decoded on all cores
+    in the feature pool, the results are written in batches of FEATURE_BATCH_SIZE as they come in.
+    A thumbnail that fails to decode is logged and skipped.
+    The cached features are not updated - call update_similarity_features or clear_similarity_cache afterward.
+
+    :param video_urls: urls of the videos to build features for
+    :return: dict of video url -> stored features
+    """
+    thumbnails = {video_url: thumbnail_file for video_url in video_urls
+                  if (thumbnail_file := _thumbnail_for_features(video_url))}
+    if not thumbnails:
+        return {}
+
+    push_text_to_client(f"Generating similarity hashes for {len(thumbnails)} videos")
+    pool = _features_pool()
+    futures = {pool.submit(extract_features, thumbnail_file): video_url for video_url, thumbnail_file in thumbnails.items()}
+    batch = {}
+    stored = {}
+
+    def write_batch() -> None:
+        with get_video_db() as db:
+            db.for_similarity_table.store_features(batch)
+        stored.update((video_url, _unpack(*packed)) for video_url, packed in batch.items())
+        batch.clear()
+        push_text_to_client(f"...similarity hashes generated for {len(stored)}/{len(thumbnails)} videos - running")
+
+    for future in as_completed(futures):
+        video_url = futures[future]
+        try:
+            batch[video_url] = future.result()
+        except Exception as e:
+            logger.warning(f"Failed to generate similarity hash for {video_url}: {e}")
+            continue
+        if len(batch) >= FEATURE_BATCH_SIZE:
+            write_batch()
+    if batch:
+        write_batch()
+    return stored
+
+
 class VideoCaptureContext:
     def __init__(self, video_path):
         self.video_path = video_path
@@ -180,103 +653,163 @@ class VideoCaptureContext:
             self.cap.release()
 
 
-def _resize_and_pad(image, target_size):
-    h, w = image.shape[:2]
-    if h > w:
-        new_h = target_size
-        new_w = int(w * (target_size / h))
-    else:
-        new_w = target_size
-        new_h = int(h * (target_size / w))
-    resized_image = cv2.resize(image, (new_w, new_h))
-
-    delta_w = target_size - new_w
-    delta_h = target_size - new_h
-    top, bottom = delta_h // 2, delta_h - (delta_h // 2)
-    left, right = delta_w // 2, delta_w - (delta_w // 2)
-
-    color = [0, 0, 0]
-    new_image = cv2.copyMakeBorder(resized_image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)
-    return new_image
-
-
-_hog_descriptor = cv2.HOGDescriptor((128, 128), (32, 32), (16, 16), (16, 16), 9)
-def _create_video_features_for_similarity_compare(webp_path: str) -> SimilarityFeatures:
-    hist_list = []
-    phash_list = []
-    hog_list = []
-
-    with Image.open(webp_path) as img:
-        for frame in range(img.n_frames):
-            img.seek(frame)
-            frame_image = img.convert('RGB')
-            rgb_frame = np.array(frame_image)
-            gray_frame = cv2.cvtColor(rgb_frame, cv2.COLOR_BGR2GRAY)
-            gray_frame_resized = _resize_and_pad(gray_frame, 128)
-
-            # Calculate histogram
-            hist = cv2.calcHist([rgb_frame], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
-            hist = cv2.normalize(hist, hist).flatten()
-            hist_list.append(hist)
-
-            # Calculate phash
-            dct = cv2.dct(np.float32(gray_frame_resized))
-            dct_low_freq = dct[:8, :8]
-            median = np.median(dct_low_freq)
-            phash = (dct_low_freq > median).astype(int)
-            phash_list.append(phash.flatten())
-
-            # HOG features from the frame
-            h = np.array(_hog_descriptor.compute(gray_frame_resized)).flatten()
-            hog_list.append(h)
-
-            #cv2.imshow('Frame', gray_frame)
-            #if cv2.waitKey(0) & 0xFF == ord('q'):
-            #    break
-    #cv2.destroyAllWindows()
-
-    avg_hist = np.mean(hist_list, axis=0)
-    avg_phash = np.mean(phash_list, axis=0)
-    avg_hog = np.mean(hog_list, axis=0)
-    binary_avg_phash = (avg_phash > 0.5).astype(int)
-    return SimilarityFeatures(avg_hist, binary_avg_phash, avg_hog)
-
-
-def find_duplicates(similarity_threshold=0.96) -> dict:
+def _find_root(parents: list[int], i: int) -> int:
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+def _cluster_pairs(matrix: FeatureMatrix, similarity_threshold: float) -> list[tuple[list[str], list[tuple[str, str, int]]]]:
     """
-    Find duplicate videos in the database
+    All pairs above the threshold grouped into connected clusters (union-find).
+    The pairwise scores are calculated in square blocks sized to DUPLICATES_MEMORY_BUDGET,
+    only blocks on and above the diagonal - every pair is scored once.
 
-    the result should be a dictionary with the video path as key and a list of similar videos as value
+    :param matrix: features of all videos
+    :param similarity_threshold: minimum score for a pair
+    :return: list of clusters with the video urls and the pairs (url, url, score in percent) - biggest cluster first
+    """
+    count = len(matrix)
+    block = max(1, math.isqrt(DUPLICATES_MEMORY_BUDGET // (PAIR_BYTES + 8 * matrix.phash.shape[1])))
+    parents = list(range(count))
+    pairs = []
+    for start_a in range(0, count, block):
+        rows_a = slice(start_a, min(start_a + block, count))
+        for start_b in range(start_a, count, block):
+            rows_b = slice(start_b, min(start_b + block, count))
+            scores = matrix.pair_scores(rows_a, rows_b)
+            if start_a == start_b:
+                scores = np.triu(scores, k=1)
+            for i, j in zip(*np.nonzero(scores > similarity_threshold)):
+                a, b = start_a + int(i), start_b + int(j)
+                pairs.append((a, b, int(scores[i, j] * 100)))
+                root_a, root_b = _find_root(parents, a), _find_root(parents, b)
+                if root_a != root_b:
+                    parents[root_b] = root_a
+
+    clusters: dict[int, tuple[list[str], list[tuple[str, str, int]]]] = {}
+    for a, b, score in pairs:
+        cluster = clusters.setdefault(_find_root(parents, a), ([], []))
+        cluster[1].append((matrix.urls[a], matrix.urls[b], score))
+    for i in range(count):
+        cluster = clusters.get(_find_root(parents, i))
+        if cluster is not None:
+            cluster[0].append(matrix.urls[i])
+    return sorted(clusters.values(), key=lambda cluster: len(cluster[0]), reverse=True)
+
+
+@cache(maxsize=8, ttl=3600)
+def _duplicate_clusters(similarity_threshold: float) -> list[tuple[list[str], list[tuple[str, str, int]]]]:
+    """
+    (cached until the features change; max time in cache 1 hour)
+    """
+    return _cluster_pairs(_feature_matrix(), similarity_threshold)
 
-    :param similarity_threshold: threshold for similarity default 0.90
-    :return: list of duplicate videos with similarity score (tuple)
+
+def find_duplicates(similarity_threshold=0.96) -> list:
+    """
+    Find duplicate videos in the database - videos with a similarity above the threshold are grouped
+    into clusters, a video similar to one of a cluster is part of it.
+
+    Example cluster:
+    {
+        "videos": [{"video_url": "...", "file": {...}}, ...],
+        "pairs": [{"a": "<video_url>", "b": "<video_url>", "score": 98}, ...],
+        "score": 98 // best score of the cluster
+    }
+
+    :param similarity_threshold: threshold for similarity default 0.96
+    :return: list of clusters, biggest first
     """
 
-    result = {}
-    all_features = _all_features()
-    for video_path, features in all_features.items():
-        similars = _build_similar_list(all_features, features, video_path, similarity_threshold)
-        if len(similars) > 0:
-            file_info = find_file_info(video_path)
-            if file_info:
-                sim_data = [{'video_url': sim[0], 'score': sim[1], 'file': sim[2]} for sim in similars]
-                result[video_path] = { 'file': file_info, 'similar': sim_data }
+    files = {file['filename']: file for file in list_files()}
+    result = []
+    for urls, pairs in _duplicate_clusters(similarity_threshold):
+        videos = [{'video_url': url, 'file': files[url]} for url in urls if url in files]
+        if len(videos) < 2:
+            continue
+        found = {video['video_url'] for video in videos}
+        pairs = [{'a': a, 'b': b, 'score': score} for a, b, score in pairs if a in found and b in found]
+        if pairs:
+            result.append({'videos': videos, 'pairs': pairs, 'score': max(pair['score'] for pair in pairs)})
     return result
 
 
+def _benchmark(count: int) -> None:
+    # random features in the stored format - compares the loop over similar_compare with the matrix scoring
+    rng = np.random.default_rng(42)
+    all_features = {f"/static/videos/bench/{i}.mp4": SimilarityFeatures(rng.random(512, dtype=np.float32),
+                                                                       rng.integers(0, 2, 64, dtype=np.int64),
+                                                                       rng.random(1764, dtype=np.float32))
+                    for i in range(count)}
+    query_url, query = next(iter(all_features.items()))
+
+    start = time.perf_counter()
+    expected = np.array([similar_compare(query, features) for features in all_features.values()])
+    loop_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matrix = FeatureMatrix(all_features)
+    build_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    scores = matrix.scores(query)
+    query_seconds = time.perf_counter() - start
+
+    print(f"{count} videos: loop {loop_seconds * 1000:.1f} ms, matrix build {build_seconds * 1000:.1f} ms, "
+          f"query {query_seconds * 1000:.2f} ms - max difference {np.max(np.abs(scores - expected)):.2e}")
+
+    # near copies of some videos (a few phash bits and the hog changed) - duplicates for the all pairs clustering
+    originals = [f"/static/videos/bench/{i}.mp4" for i in range(0, count, 50)]
+    for url in originals:
+        features = all_features[url]
+        phash = features.phash.copy()
+        phash[rng.choice(len(phash), 3, replace=False)] ^= 1
+        hog = (features.hog * (1 + 0.05 * rng.standard_normal(len(features.hog)))).astype(np.float32)
+        all_features[url.replace('.mp4', '-copy.mp4')] = SimilarityFeatures(features.histogram * 1.01, phash, hog)
+    matrix = FeatureMatrix(all_features)
+    start = time.perf_counter()
+    clusters = _cluster_pairs(matrix, 0.96)
+    print(f"{len(matrix)} videos: all pairs duplicates {time.perf_counter() - start:.2f} s - {len(clusters)} clusters")
+
+    start = time.perf_counter()
+    index = SimilarityIndex(matrix.phash, matrix.hog)
+    build_seconds = time.perf_counter() - start
+    found = expected_count = shortlist = 0
+    exact_seconds = index_seconds = 0.0
+    for url in originals:
+        features = all_features[url]
+        start = time.perf_counter()
+        exact = {match for match, _ in matrix.similar(url, features, 0.6)}
+        exact_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        rows = index.candidates(*matrix.query_values(features))
+        approximate = {match for match, _ in matrix.similar(url, features, 0.6, rows)}
+        index_seconds += time.perf_counter() - start
+        expected_count += len(exact)
+        found += len(exact & approximate)
+        shortlist += len(rows)
+    print(f"{len(matrix)} videos: index build {build_seconds:.2f} s, query exact {exact_seconds / len(originals) * 1000:.2f} ms, "
+          f"index {index_seconds / len(originals) * 1000:.2f} ms (shortlist {shortlist // len(originals)}) - "
+          f"recall {found}/{expected_count}")
+
+
 def main():
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        _benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+        return
+
     similarity_threshold = 0.90
 
     print("\n\nGrouping similar videos")
     out = find_duplicates(similarity_threshold)
-    for video, similar_groups in out.items():
-        print(f"Video: [{video}] has similar videos:")
-        sim_data = similar_groups.get('similar')
-        if sim_data:
-            for similar_video in sim_data:
-                print(f"...Score: {similar_video.get('score')} - Similar to: {similar_video.get('video_url')}")
-
-    print(f"Found {len(out)} videos")
+    for cluster in out:
+        print(f"Cluster of {len(cluster['videos'])} similar videos (best score {cluster['score']}):")
+        for pair in cluster['pairs']:
+            print(f"...Score: {pair['score']} - [{pair['a']}] similar to [{pair['b']}]")
+
+    print(f"Found {len(out)} clusters")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,73 @@
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def _resize_and_pad(image, target_size):
+    h, w = image.shape[:2]
+    if h > w:
+        new_h = target_size
+        new_w = int(w * (target_size / h))
+    else:
+        new_w = target_size
+        new_h = int(h * (target_size / w))
+    resized_image = cv2.resize(image, (new_w, new_h))
+
+    delta_w = target_size - new_w
+    delta_h = target_size - new_h
+    top, bottom = delta_h // 2, delta_h - (delta_h // 2)
+    left, right = delta_w // 2, delta_w - (delta_w // 2)
+
+    color = [0, 0, 0]
+    new_image = cv2.copyMakeBorder(resized_image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)
+    return new_image
+
+
+_hog_descriptor = cv2.HOGDescriptor((128, 128), (32, 32), (16, 16), (16, 16), 9)
+def extract_features(webp_path: str) -> tuple[bytes, bytes, bytes]:
+    """
+    Calculate the similarity features of the frames of an animated webp thumbnail.
+    Runs in the worker processes of the feature pool - only depends on cv2, numpy and PIL.
+
+    :param webp_path: full path to the webp thumbnail
+    :return: packed features (histogram float32, phash int64, hog float32) in the stored format
+    """
+    hist_list = []
+    phash_list = []
+    hog_list = []
+
+    with Image.open(webp_path) as img:
+        for frame in range(img.n_frames):
+            img.seek(frame)
+            frame_image = img.convert('RGB')
+            rgb_frame = np.array(frame_image)
+            gray_frame = cv2.cvtColor(rgb_frame, cv2.COLOR_BGR2GRAY)
+            gray_frame_resized = _resize_and_pad(gray_frame, 128)
+
+            # Calculate histogram
+            hist = cv2.calcHist([rgb_frame], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
+            hist = cv2.normalize(hist, hist).flatten()
+            hist_list.append(hist)
+
+            # Calculate phash
+            dct = cv2.dct(np.float32(gray_frame_resized))
+            dct_low_freq = dct[:8, :8]
+            median = np.median(dct_low_freq)
+            phash = (dct_low_freq > median).astype(int)
+            phash_list.append(phash.flatten())
+
+            # HOG features from the frame
+            h = np.array(_hog_descriptor.compute(gray_frame_resized)).flatten()
+            hog_list.append(h)
+
+            #cv2.imshow('Frame', gray_frame)
+            #if cv2.waitKey(0) & 0xFF == ord('q'):
+            #    break
+    #cv2.destroyAllWindows()
+
+    avg_hist = np.mean(hist_list, axis=0)
+    avg_phash = np.mean(phash_list, axis=0)
+    avg_hog = np.mean(hog_list, axis=0)
+    binary_avg_phash = (avg_phash > 0.5).astype(np.int64)
+    return (avg_hist.astype(np.float32).tobytes(), binary_avg_phash.tobytes(),
+            avg_hog.astype(np.float32).tobytes())
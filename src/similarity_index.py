@@ -0,0 +1,145 @@
+import threading
+from collections import defaultdict
+
+import numpy as np
+from numpy import ndarray
+
+CHUNK_BITS = 16             # phash words are split into chunks of this many bits - one hash table per chunk
+CHUNK_PROBE_RADIUS = 1      # chunk values within this hamming distance are probed - finds every phash within
+                            # (radius + 1) * chunks - 1 bits (7 of 64 bits)
+HOG_LISTS_PER_VIDEO = 100   # videos per hog cluster on average (number of clusters = videos / this)
+HOG_MIN_LISTS = 16
+HOG_MAX_LISTS = 1024
+HOG_PROBE_LISTS = 8         # nearest hog clusters searched for a query
+HOG_KMEANS_ITERATIONS = 8
+HOG_KMEANS_SAMPLE = 50      # training rows per cluster
+
+
+def _chunk_values(phash: ndarray) -> ndarray:
+    # packed phash words (n, words) -> chunk values (n, chunks)
+    chunks_per_word = 64 // CHUNK_BITS
+    shifts = np.arange(chunks_per_word, dtype=np.uint64) * np.uint64(CHUNK_BITS)
+    mask = np.uint64((1 << CHUNK_BITS) - 1)
+    return ((phash[:, :, None] >> shifts) & mask).reshape(phash.shape[0], -1).astype(np.int64)
+
+
+def _probe_values(value: int) -> list[int]:
+    values = [value]
+    for _ in range(CHUNK_PROBE_RADIUS):
+        values = list({v ^ (1 << bit) for v in values for bit in range(CHUNK_BITS)} | set(values))
+    return values
+
+
+class SimilarityIndex:
+    """
+    Approximate nearest neighbour index over the similarity features - returns a shortlist of candidate rows
+    that is re-ranked with the exact score.
+
+    - multi-index hashing of the phash: the packed phash is split into 16 bit chunks with a hash table per chunk,
+      two phashes with a small hamming distance have at least one chunk (nearly) equal
+    - coarse quantizer for the hog vectors: spherical k-means clusters of the vectors relative to their mean,
+      a query searches the lists of the nearest clusters
+
+    Rows can be added or replaced, the clusters are only trained on build.
+    """
+    def __init__(self, phash: ndarray, hog: ndarray, seed: int = 0):
+        """
+        :param phash: packed phash words (rows, words) as uint64
+        :param hog: normalized hog vectors (rows, size)
+        :param seed: random seed for the k-means initialization
+        """
+        self._lock = threading.Lock()
+        count = phash.shape[0]
+        self._chunks = _chunk_values(phash) if count else np.zeros((0, 0), dtype=np.int64)
+        self._tables: list[dict[int, set[int]]] = [defaultdict(set) for _ in range(self._chunks.shape[1])]
+        for table, values in zip(self._tables, self._chunks.T):
+            for row, value in enumerate(values.tolist()):
+                table[value].add(row)
+
+        # hog vectors are all positive and point in a similar direction - clustered relative to their mean
+        self._mean = hog.mean(axis=0) if count else np.zeros(hog.shape[1], dtype=np.float32)
+        hog = self._centered(hog)
+        self._centroids = self._train(hog, seed)
+        self._assignments = self._assign(hog) if count else np.zeros(0, dtype=np.int64)
+        self._lists: dict[int, set[int]] = defaultdict(set)
+        for row, cluster in enumerate(self._assignments.tolist()):
+            self._lists[cluster].add(row)
+
+    @staticmethod
+    def _train(hog: ndarray, seed: int) -> ndarray:
+        count = hog.shape[0]
+        lists = max(1, min(HOG_MAX_LISTS, max(HOG_MIN_LISTS, count // HOG_LISTS_PER_VIDEO), count))
+        if not count:
+            return np.zeros((0, hog.shape[1]), dtype=np.float32)
+        rng = np.random.default_rng(seed)
+        sample = hog[rng.choice(count, min(count, lists * HOG_KMEANS_SAMPLE), replace=False)]
+        centroids = sample[rng.choice(sample.shape[0], lists, replace=False)].copy()
+        for _ in range(HOG_KMEANS_ITERATIONS):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            for cluster in range(lists):
+                members = sample[assignments == cluster]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    norm = np.linalg.norm(centroid)
+                    if norm:
+                        centroids[cluster] = centroid / norm
+        return centroids
+
+    def _centered(self, hog: ndarray) -> ndarray:
+        hog = hog - self._mean
+        norms = np.linalg.norm(hog, axis=1, keepdims=True)
+        return np.divide(hog, norms, out=np.zeros_like(hog), where=norms != 0)
+
+    def _assign(self, hog: ndarray) -> ndarray:
+        return np.argmax(hog @ self._centroids.T, axis=1)
+
+    def update(self, row: int, phash: ndarray, hog: ndarray) -> None:
+        """
+        Add a row or replace the features of a row
+
+        :param row: row of the features in the feature matrix
+        :param phash: packed phash words of the row
+        :param hog: normalized hog vector of the row
+        """
+        chunks = _chunk_values(phash[None, :])[0]
+        cluster = int(self._assign(self._centered(hog[None, :]))[0]) if len(self._centroids) else 0
+        with self._lock:
+            if row < len(self._assignments):
+                for table, value in zip(self._tables, self._chunks[row].tolist()):
+                    table[value].discard(row)
+                self._lists[int(self._assignments[row])].discard(row)
+                self._chunks[row] = chunks
+                self._assignments[row] = cluster
+            else:
+                self._chunks = np.vstack([self._chunks.reshape(-1, len(chunks)), chunks[None, :]])
+                self._assignments = np.append(self._assignments, cluster)
+                if not self._tables:
+                    self._tables = [defaultdict(set) for _ in range(len(chunks))]
+            for table, value in zip(self._tables, chunks.tolist()):
+                table[value].add(row)
+            self._lists[cluster].add(row)
+
+    def candidates(self, phash: ndarray, hog: ndarray) -> ndarray:
+        """
+        Candidate rows for a query - rows with a close phash or in the nearest hog clusters
+
+        :param phash: packed phash words of the query
+        :param hog: normalized hog vector of the query
+        :return: sorted row indexes
+        """
+        nearest = []
+        if len(self._centroids) and np.any(hog):
+            probe = min(HOG_PROBE_LISTS, len(self._centroids))
+            distances = -(self._centroids @ self._centered(hog[None, :])[0])
+            nearest = np.argpartition(distances, probe - 1)[:probe].tolist()
+        chunks = _chunk_values(phash[None, :])[0].tolist()
+        rows: set[int] = set()
+        with self._lock:
+            for table, value in zip(self._tables, chunks):
+                for probe_value in _probe_values(value):
+                    bucket = table.get(probe_value)
+                    if bucket:
+                        rows.update(bucket)
+            for cluster in nearest:
+                rows.update(self._lists.get(cluster, ()))
+        return np.fromiter(sorted(rows), dtype=np.int64, count=len(rows))
@@ -1,10 +1,13 @@
+import asyncio
 import os
 import subprocess
 import json
 import threading
+import time
 from enum import Enum
-from typing import Optional
+from typing import Optional, NamedTuple, Callable
 from flask import Blueprint, jsonify, request
+from werkzeug.security import safe_join
 from loguru import logger
 from bus import push_text_to_client
 from cache import cache, clear_cache_by_name
@@ -12,8 +15,24 @@ from database.video_database import get_video_db
 from globals import is_debug, get_static_directory, get_real_path_from_url, VideoFolder, \
     THUMBNAIL_DIR_NAME, ServerResponse, FolderState, ID_NAME_SEPERATOR, get_thumbnail_directory, \
     get_url_from_path
-from database.video_models import Similarity
 from utils import check_folder
+from catalog import invalidate_catalog_entry, is_cataloged
+from traversal import walk_directories
+from metadata import get_stored_video_info, store_video_info, store_video_infos, source_fingerprint, is_stale
+from governor import register_process, unregister_process
+from jobs import JobPriority, Job, JobRun, JobState, register_job_handler, enqueue_job, create_run, close_run
+
+THUMBNAIL_JOB = 'thumbnail'
+FFMPEG_TIMELIMIT = 180      # seconds for one ffmpeg run
+FFPROBE_TIMELIMIT = 60      # seconds for one ffprobe run
+FFPROBE_COMMAND = ['ffprobe', '-v', 'error', '-show_entries', 'format', '-show_entries', 'stream', '-of', 'json']
+DEFAULT_PROBE_CONCURRENCY = 8       # ffprobe mostly waits for the disk - more processes than cores is fine
+PROBE_STORE_BATCH = 50              # probe results stored in one transaction
+PROBE_PROGRESS_INTERVAL = 2.0       # seconds between two progress messages
+ON_DEMAND_RETRY_AFTER = 3600        # seconds before a failed on demand generation is tried again
+PLACEHOLDER_IMAGE = 'images/placeholder.png'    # relative to the static folder
+
+probe_concurrency = DEFAULT_PROBE_CONCURRENCY
 
 
 class ThumbnailFormat(Enum):
@@ -27,14 +46,24 @@ class ThumbnailFormat(Enum):
         self.extension = extension
 
 
+class ThumbnailSpeed(Enum):
+    AUTO = 'auto'           # fast for files above the size or bitrate threshold
+    ACCURATE = 'accurate'   # frame accurate seek, all frames decoded
+    FAST = 'fast'           # keyframes only around the midpoint, downscaled before the reprojection
+
+
 thumbnail_bp = Blueprint('thumbnail', __name__)
 
 @thumbnail_bp.route('/api/generate_thumbnails', methods=['POST'])
 def gts():
     data = request.get_json()
     mode = data.get("mode")
+    try:
+        speed = ThumbnailSpeed(data.get("speed") or ThumbnailSpeed.AUTO.value)
+    except ValueError:
+        return jsonify(ServerResponse(False, f"Invalid speed: {data.get('speed')}")), 400
 
-    thumbnail_thread = threading.Thread(target=generate_thumbnails, args=(mode,))
+    thumbnail_thread = threading.Thread(target=generate_thumbnails, args=(mode, speed))
     thumbnail_thread.daemon = True
     thumbnail_thread.start()
 
@@ -48,16 +77,52 @@ def gt():
 
     if not video_path:
         return jsonify(ServerResponse(False, "No video path provided")), 400
+    try:
+        speed = ThumbnailSpeed(data.get("speed") or ThumbnailSpeed.AUTO.value)
+    except ValueError:
+        return jsonify(ServerResponse(False, f"Invalid speed: {data.get('speed')}")), 400
 
     clear_cache_by_name('list_files')
-    return jsonify(generate_thumbnail_for_path(video_path))
+    return jsonify(generate_thumbnail_for_path(video_path, speed=speed))
+
+def _sidecar_path(video_path: str) -> str:
+    return os.path.join(get_thumbnail_directory(video_path), os.path.basename(video_path)) + ThumbnailFormat.JSON.extension
+
+
+def _write_sidecar(video_path: str, info: dict) -> None:
+    # the json in the .thumb folder is kept in sync so a folder can be moved to another installation
+    json_path = _sidecar_path(video_path)
+    try:
+        os.makedirs(os.path.dirname(json_path), exist_ok=True)
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(info, f, indent=2, ensure_ascii=False)
+        thumbnail_manifest.cache__evict(os.path.dirname(json_path))
+    except OSError as e:
+        logger.warning(f"Failed to write video info to {json_path}: {e}")
+
+
+def _load_video_info(video_path: str) -> Optional[dict]:
+    info = get_stored_video_info(video_path)
+    if info is None:
+        # not in the database yet - e.g. a file copied into the library together with its .thumb folder
+        json_path = _sidecar_path(video_path)
+        if os.path.isfile(json_path):
+            try:
+                with open(json_path, 'r', encoding='utf-8') as f:
+                    logger.debug(f"Loading pre existing video info from {json_path}")
+                    info = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Failed to load video info from {json_path}: {e}")
+                return None
+            store_video_info(video_path, info)
+    return info
+
 
-@cache(maxsize=4096, bypass_cache_param='force')
 def get_video_info(video_path, force=False):
     """
-    (cached; max time in cache CACHE_EXPIRATION_TIME)
-    Get video info using ffprobe, try to load from .thumb folder first
-    if not found, run ffprobe command and store the json in .thumb folder
+    Get video info using ffprobe, the results are stored in the video_metadata table
+    (loaded into memory once) and as json in the .thumb folder.
+    if not found, run ffprobe command and store the result
 
     Example:
     {
@@ -76,79 +141,188 @@ def get_video_info(video_path, force=False):
         if video_path.endswith('.part'):
             return None
 
-        # find the video json in .thumb folder first
+        # stored info first, the additional infos (title, favorite, ...) survive a forced probe
         infos = {}
-        json_path = os.path.join(get_thumbnail_directory(video_path), os.path.basename(video_path)) + ThumbnailFormat.JSON.extension
-        os.makedirs(os.path.dirname(json_path), exist_ok=True)
-        if os.path.isfile(json_path):
-            with open(json_path, 'r', encoding='utf-8') as f:
-                logger.debug(f"Loading pre existing video info from {json_path} - force: {force}")
-                info = json.load(f)
-            if 'infos' in info:
-                infos = info['infos']
+        info = _load_video_info(video_path)
+        if info is not None:
             if not force:
                 return info
+            infos = dict(info.get('infos', {}))
 
         logger.debug(f"Running ffprobe for {video_path}")
         push_text_to_client(f"Running ffprobe to get video info for {os.path.basename(video_path)}")
-        result = subprocess.run(
-            ['ffprobe', '-v', 'error', '-show_entries', 'format', '-show_entries', 'stream', '-of', 'json', video_path],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True
-        )
-        info = json.loads(result.stdout)
-
-        # additional infos
-        info['infos'] = infos
-
-        # find title and stuff from db
-        video_url = get_url_from_path(video_path)
-        with get_video_db() as db:
-            download = db.for_download_table.get_download(video_url)
-            download_id = os.path.basename(video_path).split(ID_NAME_SEPERATOR)[0][:14]
-            if download:
-                infos['download_id'] = download_id
-                title = download.title
-                if title:
-                    infos['title'] = title
-                url = download.original_url
-                if url:
-                    infos['original_url'] = url
-                download_date = download.download_date
-                if download_date:
-                    infos['download_date'] = download_date
-
-        # generate unique info string from specific fields
-        format_info = info.get('format', {})
-        streams_info = info.get('streams', [])
-        video_uid = f"{format_info.get('format_name', '')}_{format_info.get('duration', '')}_{format_info.get('size', '')}"
-        for stream in streams_info:
-            video_uid += f"_{stream.get('codec_name', '')}_{stream.get('width', '')}_{stream.get('height', '')}_{stream.get('bit_rate', '')}_{stream.get('sample_rate', '')}_{stream.get('channels', '')}"
-        infos['video_uid'] = video_uid
-
-        # store json to .thumb folder
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(info, f, indent=2, ensure_ascii=False)
-
+        result = subprocess.run(FFPROBE_COMMAND + [video_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        info = _complete_video_info(video_path, json.loads(result.stdout), infos)
+        store_video_info(video_path, info)
+        _write_sidecar(video_path, info)
         return info
     except subprocess.CalledProcessError as e:
         logger.error(f"Failed to get video info for {video_path}: {e}")
         return None
 
-def generate_thumbnails(mode) -> ServerResponse:
+
+def _complete_video_info(video_path: str, info: dict, infos: dict) -> dict:
+    # additional infos
+    info['infos'] = infos
+
+    # find title and stuff from db
+    video_url = get_url_from_path(video_path)
+    with get_video_db() as db:
+        download = db.for_download_table.get_download(video_url)
+        download_id = os.path.basename(video_path).split(ID_NAME_SEPERATOR)[0][:14]
+        if download:
+            infos['download_id'] = download_id
+            title = download.title
+            if title:
+                infos['title'] = title
+            url = download.original_url
+            if url:
+                infos['original_url'] = url
+            download_date = download.download_date
+            if download_date:
+                infos['download_date'] = download_date
+
+    # generate unique info string from specific fields
+    format_info = info.get('format', {})
+    streams_info = info.get('streams', [])
+    video_uid = f"{format_info.get('format_name', '')}_{format_info.get('duration', '')}_{format_info.get('size', '')}"
+    for stream in streams_info:
+        video_uid += f"_{stream.get('codec_name', '')}_{stream.get('width', '')}_{stream.get('height', '')}_{stream.get('bit_rate', '')}_{stream.get('sample_rate', '')}_{stream.get('channels', '')}"
+    infos['video_uid'] = video_uid
+
+    # size and mtime of the probed file - tells if thumbnails, info and similarity features are stale
+    infos['source'] = source_fingerprint(video_path)
+    return info
+
+
+def set_probe_concurrency(concurrency: int) -> None:
+    """
+    Set how many ffprobe processes probe_videos runs at the same time
+
+    :param concurrency: number of concurrent ffprobe processes
+    """
+    global probe_concurrency
+    probe_concurrency = max(1, concurrency)
+
+
+async def _ffprobe(video_path: str, semaphore: asyncio.Semaphore) -> Optional[dict]:
+    async with semaphore:
+        try:
+            process = await asyncio.create_subprocess_exec(*FFPROBE_COMMAND, video_path,
+                                                           stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        except OSError as e:
+            logger.error(f"Failed to start ffprobe for {video_path}: {e}")
+            return None
+        register_process(process.pid)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), FFPROBE_TIMELIMIT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            logger.error(f"Failed to get video info for {video_path} (timeout)")
+            return None
+        finally:
+            unregister_process(process.pid)
+        if process.returncode != 0:
+            logger.error(f"Failed to get video info for {video_path}: {stderr.decode(errors='replace').strip()}")
+            return None
+        try:
+            return json.loads(stdout)
+        except ValueError as e:
+            logger.error(f"Invalid ffprobe output for {video_path}: {e}")
+            return None
+
+
+async def _probe_all(paths: list[str], concurrency: int, on_result: Callable[[str, Optional[dict]], None]) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def probe(video_path: str) -> tuple[str, Optional[dict]]:
+        return video_path, await _ffprobe(video_path, semaphore)
+
+    for next_done in asyncio.as_completed([probe(video_path) for video_path in paths]):
+        on_result(*await next_done)
+
+
+def probe_videos(paths: list[str], force: bool = False) -> dict:
+    """
+    Run ffprobe for many videos concurrently (probe_concurrency processes at a time).
+    Results are stored in the metadata store in batches as they complete, videos with stored info are skipped.
+
+    :param paths: full paths of the video files
+    :param force: probe videos with stored info again
+    :return: dict with probed, failed and skipped counts, seconds and files_per_second
+    """
+    start = time.perf_counter()
+    todo = []
+    existing_infos = {}
+    for video_path in dict.fromkeys(paths):
+        if video_path.endswith('.part'):
+            continue
+        info = _load_video_info(video_path)
+        if info is None or force:
+            todo.append(video_path)
+            existing_infos[video_path] = dict(info.get('infos', {})) if info else {}
+    result = {'probed': 0, 'failed': 0, 'skipped': len(paths) - len(todo), 'seconds': 0.0, 'files_per_second': 0.0}
+    if not todo:
+        return result
+
+    push_text_to_client(f"Running ffprobe for {len(todo)} videos ({probe_concurrency} at a time)")
+    batch: dict[str, dict] = {}
+    last_progress = time.monotonic()
+
+    def store_batch():
+        with get_video_db():
+            completed = {video_path: _complete_video_info(video_path, info, existing_infos[video_path])
+                         for video_path, info in batch.items()}
+        store_video_infos(completed)
+        for video_path, info in completed.items():
+            _write_sidecar(video_path, info)
+        batch.clear()
+
+    def on_result(video_path: str, info: Optional[dict]):
+        nonlocal last_progress
+        if info is None:
+            result['failed'] += 1
+        else:
+            result['probed'] += 1
+            batch[video_path] = info
+            if len(batch) >= PROBE_STORE_BATCH:
+                store_batch()
+        done = result['probed'] + result['failed']
+        if time.monotonic() - last_progress >= PROBE_PROGRESS_INTERVAL and done < len(todo):
+            push_text_to_client(f"...probed {done}/{len(todo)} videos "
+                                f"({done / (time.perf_counter() - start):.1f} files/s)")
+            last_progress = time.monotonic()
+
+    asyncio.run(_probe_all(todo, probe_concurrency, on_result))
+    if batch:
+        store_batch()
+
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    result['files_per_second'] = round(len(todo) / result['seconds'], 1) if result['seconds'] else 0.0
+    message = (f"Probed {result['probed']} videos in {result['seconds']:.1f}s ({result['files_per_second']} files/s)"
+               f"{' - ' + str(result['failed']) + ' failed' if result['failed'] else ''}")
+    logger.info(message)
+    push_text_to_client(message)
+    return result
+
+def generate_thumbnails(mode, speed: ThumbnailSpeed = ThumbnailSpeed.AUTO) -> ServerResponse:
     """
     Generate thumbnails for all videos
 
-    :param mode: mode for generating thumbnails (e.g., 'force' or 'missing')
-    :return: json object with success and generated_thumbnails
+    :param mode: mode for generating thumbnails - 'force' all, 'missing' thumbnails or 'stale' for videos changed
+                 since their thumbnails were generated (size or mtime of the file differs from the recorded fingerprint)
+    :param speed: fast, accurate or auto (fast only for very large files) generation for this run
+    :return: json object with success and the number of scheduled thumbnails
     """
     static_dir = get_static_directory()
-    generated_thumbnails = []
-    thumbnail_errors = []
     force = mode == 'force'
-    push_text_to_client(f"Generating {'all thumbnails (force)' if force else 'missing thumbnails'}")
+    stale = mode == 'stale'
+    push_text_to_client(f"Generating {'all thumbnails (force)' if force else 'stale thumbnails' if stale else 'missing thumbnails'}")
 
 
     thumbnails_to_process = []
+    fingerprints = {}
     for folder in VideoFolder:
         video_dir = os.path.join(static_dir, folder.dir)
 
@@ -159,31 +333,231 @@ def generate_thumbnails(mode) -> ServerResponse:
             logger.warning(msg)
             return ServerResponse(False, msg)
 
-        for root, dirs, files in os.walk(video_dir, followlinks=True):
-            # Exclude directories that start with a dot
-            dirs[:] = [d for d in dirs if not d.startswith('.')]
-
-            for filename in files:
+        for record in walk_directories(video_dir, stat_files=stale):
+            # fresh listing of the .thumb folder - the scan should see thumbnails created outside of the server
+            thumbnail_dir = os.path.join(record.path, THUMBNAIL_DIR_NAME)
+            thumbnail_manifest.cache__evict(thumbnail_dir)
+            manifest = thumbnail_manifest(thumbnail_dir) if THUMBNAIL_DIR_NAME in record.hidden else frozenset()
+            for file in record.files:
+                filename = file.name
                 if filename.endswith(('.mp4', '.mkv', '.avi', '.webm')):
-                    video_path = os.path.join(root, filename)
-                    thumbnail_dir = os.path.join(root, THUMBNAIL_DIR_NAME)
+                    if stale:
+                        info = get_stored_video_info(file.path)
+                        if info is None or file.stat is None:
+                            continue
+                        changed = is_stale(file.path, info, file.stat)
+                        if changed:
+                            thumbnails_to_process.append(file.path)
+                        elif ((info.get('infos') or {}).get('source') or {}).get('mtime') != file.stat.st_mtime_ns:
+                            # no fingerprint yet (probed by an older version) or only touched - record the current one
+                            fingerprints[file.path] = info
                     # if one of the thumbs for file is missing, generate all thumbs
-                    if force or any(not os.path.isfile(os.path.join(thumbnail_dir, f"{filename}{fmt.extension}")) for fmt in ThumbnailFormat):
-                        thumbnails_to_process.append(video_path)
+                    elif force or any(f"{filename}{fmt.extension}" not in manifest for fmt in ThumbnailFormat):
+                        thumbnails_to_process.append(file.path)
+
+    if fingerprints:
+        infos = {video_path: {**info, 'infos': {**(info.get('infos') or {}), 'source': source_fingerprint(video_path)}}
+                 for video_path, info in fingerprints.items()}
+        store_video_infos(infos)
+        for video_path, info in infos.items():
+            _write_sidecar(video_path, info)
+        logger.info(f"Recorded the source fingerprint for {len(infos)} unchanged videos")
 
     thumbnails_process_count = len(thumbnails_to_process)
     push_text_to_client(f"{thumbnails_process_count} thumbnails will be generated")
-    for index, video_path in enumerate(thumbnails_to_process):
-            if generate_thumbnail(video_path, index + 1, thumbnails_process_count):
-                generated_thumbnails.append(video_path)
+
+    # the jobs run on the worker pool - downloads and single requests are scheduled before this backfill
+    run = create_run(f"Generate thumbnails ({mode})", on_finished=_thumbnails_run_finished)
+    options = {'speed': speed.value} if speed != ThumbnailSpeed.AUTO else None
+    for video_path in thumbnails_to_process:
+        enqueue_job(THUMBNAIL_JOB, video_path, JobPriority.BACKFILL, run, options)
+    close_run(run)
+    return ServerResponse(True, f"thumbnails scheduled: {run.total} (run {run.id})")
+
+
+def _thumbnails_run_finished(run: JobRun) -> None:
+    clear_cache_by_name('list_files')
+    push_text_to_client(f"Generate thumbnails finished with {run.succeeded} thumbnails "
+                        f"{'(' + str(run.failed) + ' failed)' if run.failed else ''}"
+                        f"{'(' + str(run.cancelled) + ' cancelled)' if run.cancelled else ''}")
+
+
+def _thumbnail_job(job: Job) -> Optional[bool]:
+    total = job.run.total if job.run else 0
+    speed = ThumbnailSpeed(job.options.get('speed', ThumbnailSpeed.AUTO.value))
+    return generate_thumbnail(job.target, job.position, total, cancel_event=job.cancel_event, speed=speed)
+
+
+register_job_handler(THUMBNAIL_JOB, _thumbnail_job, _thumbnails_run_finished)
+
+
+class ThumbnailCancelled(Exception):
+    pass
+
+
+def _run_ffmpeg(cmd: list[str], stdout, timeout: float, cancel_event: Optional[threading.Event]) -> None:
+    """
+    Run ffmpeg and wait for it - the process is killed on timeout or when the cancel event is set
+
+    :raises subprocess.TimeoutExpired: on timeout
+    :raises subprocess.CalledProcessError: if ffmpeg fails
+    :raises ThumbnailCancelled: if cancelled
+    """
+    process = subprocess.Popen(cmd, stdout=stdout, stderr=stdout)
+    # runs with lower cpu and io priority while a video is played
+    register_process(process.pid)
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            try:
+                process.wait(timeout=0.5)
+                break
+            except subprocess.TimeoutExpired:
+                cancelled = cancel_event is not None and cancel_event.is_set()
+                if cancelled or time.monotonic() > deadline:
+                    process.kill()
+                    process.wait()
+                    if cancelled:
+                        raise ThumbnailCancelled()
+                    raise subprocess.TimeoutExpired(cmd, timeout)
+    finally:
+        unregister_process(process.pid)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+
+
+class ThumbnailPipeline(Enum):
+    SEPARATE = 'separate'   # one ffmpeg process per format - each decodes and reprojects the clip
+    COMBINED = 'combined'   # one ffmpeg process - decode, reproject and scale once, split into all formats
+
+
+class PipelineResult(Enum):
+    SUCCESS = 'success'
+    FAILED = 'failed'       # ffmpeg exited with an error - another pipeline may still work
+    TIMEOUT = 'timeout'     # ffmpeg took too long - another pipeline decoding more would take longer
+
+
+THUMBNAIL_PIPELINE = ThumbnailPipeline.COMBINED
+PREVIEW_FORMATS = (ThumbnailFormat.WEBP, ThumbnailFormat.JPG, ThumbnailFormat.WEBM)
+PREVIEW_SIZE = (1024, 768)
+REPROJECT_FILTER = "v360=input=hequirect:output=flat:in_stereo=sbs:h_fov=120:v_fov=90"
+FAST_MODE_MIN_SIZE = 20 * 1024 ** 3        # bytes - files above use the fast mode in auto
+FAST_MODE_MIN_BITRATE = 100_000_000        # bits per second - files above use the fast mode in auto
+FAST_MODE_DECODE_WIDTH = 2048              # fast mode scales the frames down to this width before anything else
+
+
+class ThumbnailParams(NamedTuple):
+    duration: float
+    midpoint: float
+    clip_duration: int
+    sbs: bool
+    fast: bool = False
+
+
+def _use_fast_mode(video_info: dict, speed: ThumbnailSpeed, size: int = 0) -> bool:
+    if speed != ThumbnailSpeed.AUTO:
+        return speed == ThumbnailSpeed.FAST
+    format_info = video_info.get('format', {})
+    try:
+        size = max(size, int(format_info.get('size') or 0))
+        bitrate = int(format_info.get('bit_rate') or 0)
+    except ValueError:
+        bitrate = 0
+    return size >= FAST_MODE_MIN_SIZE or bitrate >= FAST_MODE_MIN_BITRATE
+
+
+def _input_args(video_path: str, params: ThumbnailParams, clip: bool = True, audio: bool = True) -> list[str]:
+    # fast: seek to the keyframe before the midpoint and only decode keyframes
+    fast = ['-noaccurate_seek', '-skip_frame', 'nokey'] if params.fast else []
+    return (['ffmpeg'] + fast + ['-ss', str(params.midpoint)] + ([] if audio else ['-an'])
+            + (['-t', str(params.clip_duration)] if clip else []) + ['-y', '-i', video_path])
+
+
+def _reproject_filter(params: ThumbnailParams, size: str = "") -> str:
+    if not params.sbs:
+        return ""
+    downscale = f"scale={FAST_MODE_DECODE_WIDTH}:-2," if params.fast else ""
+    return f"{downscale}{REPROJECT_FILTER}{size},"
+
+
+def _thumbnail_params(video_info: dict, fast: bool = False) -> ThumbnailParams:
+    duration = float(video_info['format']['duration'])
+    midpoint = duration / 2
+
+    # find aspect ratio
+    aspect_ratio = None
+    for stream in video_info['streams']:
+        if stream['codec_type'] == 'video':
+            if 'display_aspect_ratio' in stream:
+                aspect_ratio = stream['display_aspect_ratio']
             else:
-                thumbnail_errors.append(video_path)
+                # try calc with width and height
+                width = stream['width'] if 'width' in stream else 0
+                height = stream['height'] if 'height' in stream else 0
+                # check if 2:1 aspect ratio
+                if width > 0 and height > 0 and width / height == 2:
+                    aspect_ratio = '2:1'
+            break
+    clip_duration = 8
+    if midpoint + clip_duration > duration:
+        clip_duration = int((duration - midpoint - 1) if duration - midpoint - 1 > 0 else 1)
+    return ThumbnailParams(duration, midpoint, clip_duration, aspect_ratio == '2:1', fast)
+
+
+def _separate_commands(video_path: str, params: ThumbnailParams, outfiles: dict) -> list[tuple[str, list[str]]]:
+    crop_filter = _reproject_filter(params)
+    scale = f"scale=w={PREVIEW_SIZE[0]}:h={PREVIEW_SIZE[1]}:force_original_aspect_ratio=decrease"
+    return [
+        ('webp', _input_args(video_path, params, audio=False) + ['-loop', '0', '-vf', crop_filter + 'fps=1,' + scale, outfiles[ThumbnailFormat.WEBP]]),
+        ('jpg', _input_args(video_path, params, clip=False, audio=False) + ['-vf', crop_filter + 'fps=1,' + scale, '-frames:v', '1', '-update', '1', outfiles[ThumbnailFormat.JPG]]),
+        ('webm', _input_args(video_path, params) + ['-vf', crop_filter + 'scale=380:-1', '-c:v', 'libvpx', '-b:v', '256k', '-c:a', 'libvorbis', outfiles[ThumbnailFormat.WEBM]]),
+    ]
+
+
+def _combined_command(video_path: str, params: ThumbnailParams, outfiles: dict) -> list[tuple[str, list[str]]]:
+    # the reprojection renders directly in preview size instead of the full source resolution
+    width, height = PREVIEW_SIZE
+    reproject = _reproject_filter(params, f":w={width}:h={height}")
+    filter_graph = (f"[0:v]{reproject}scale=w={width}:h={height}:force_original_aspect_ratio=decrease,split=3[anim][still][clip];"
+                    f"[anim]fps=1[webp];[still]fps=1[jpg];[clip]scale=380:-1[webm]")
+    return [('webp, jpg and webm', _input_args(video_path, params) + [
+        '-filter_complex', filter_graph,
+        '-map', '[webp]', '-an', '-loop', '0', outfiles[ThumbnailFormat.WEBP],
+        '-map', '[jpg]', '-an', '-frames:v', '1', '-update', '1', outfiles[ThumbnailFormat.JPG],
+        '-map', '[webm]', '-map', '0:a?', '-c:v', 'libvpx', '-b:v', '256k', '-c:a', 'libvorbis', outfiles[ThumbnailFormat.WEBM],
+    ])]
+
+
+def _run_pipeline(pipeline: ThumbnailPipeline, video_path: str, params: ThumbnailParams, outfiles: dict,
+                  cancel_event: Optional[threading.Event]) -> PipelineResult:
+    """
+    Run the ffmpeg commands of a pipeline
 
-    push_text_to_client(f"Generate thumbnails finished with {len(generated_thumbnails)} thumbnails {'(' + str(len(thumbnail_errors)) + ' failed)' if thumbnail_errors else ''}")
-    return ServerResponse(True, f"generated_thumbnails: {len(generated_thumbnails)}")
+    :return: SUCCESS if all previews were generated, otherwise FAILED or TIMEOUT
+    :raises ThumbnailCancelled: if cancelled
+    """
+    base_name = os.path.basename(video_path)
+    commands = _combined_command(video_path, params, outfiles) if pipeline == ThumbnailPipeline.COMBINED \
+        else _separate_commands(video_path, params, outfiles)
+    with open(os.devnull, 'w') as devnull:
+        stdout = None if is_debug() else devnull
+        for label, cmd in commands:
+            push_text_to_client(f"Starting ffmpeg for {label} - {base_name}")
+            logger.debug(f"Running command - {label}: {' '.join(cmd)}")
+            try:
+                _run_ffmpeg(cmd, stdout, FFMPEG_TIMELIMIT, cancel_event)
+            except subprocess.TimeoutExpired:
+                logger.error(f"Failed to generate thumbnail for {label} (timeout): {video_path}")
+                push_text_to_client(f"Failed to generate thumbnail for {label} (timeout): {video_path}")
+                return PipelineResult.TIMEOUT
+            except subprocess.CalledProcessError as e:
+                logger.error(f"Failed to generate thumbnail for {label}: {video_path} - {e}")
+                return PipelineResult.FAILED
+    return PipelineResult.SUCCESS
 
 
-def generate_thumbnail(video_path, currentCount = 0, maxCount = 0) -> Optional[bool]:
+def generate_thumbnail(video_path, currentCount = 0, maxCount = 0, cancel_event: threading.Event = None,
+                       speed: ThumbnailSpeed = ThumbnailSpeed.AUTO) -> Optional[bool]:
     """
     Generate thumbnail for video file using ffmpeg
     this method will generate a webp, jpg and webm thumbnails
@@ -191,7 +565,9 @@ def generate_thumbnail(video_path, currentCount = 0, maxCount = 0) -> Optional[b
     :param video_path: full path to video file
     :param currentCount: optional current count  - default 0
     :param maxCount:  optional max count - default 0
-    :return: true if success, false if failed
+    :param cancel_event: optional event to cancel the generation - running ffmpeg processes are killed
+    :param speed: fast (keyframes only) or accurate generation, auto decides by file size and bitrate
+    :return: true if success, false if failed, None if skipped or cancelled
     """
     try:
         # exclude file with '.part' extension
@@ -204,7 +580,7 @@ def generate_thumbnail(video_path, currentCount = 0, maxCount = 0) -> Optional[b
         base_name = os.path.basename(video_path)
         push_text_to_client(f"{f'{currentCount} / {maxCount} ' if currentCount > 0 else ''}Generating thumbnail and info for {base_name}")
         logger.debug(f"Evict cache for {video_path}")
-        get_thumbnails.cache__evict(video_path)   # evict cache for thumbnails
+        invalidate_thumbnails(video_path)   # evict cache for thumbnails
 
         thumbnail_dir = get_thumbnail_directory(video_path)
         os.makedirs(thumbnail_dir, exist_ok=True)
@@ -214,86 +590,83 @@ def generate_thumbnail(video_path, currentCount = 0, maxCount = 0) -> Optional[b
             logger.error(f"Failed to get video info for {video_path}")
             return False
 
-        duration = float(video_info['format']['duration'])
-        midpoint = duration / 2
-        logger.debug(f"Video duration: {duration} seconds - taking thumbnail at {midpoint} seconds")
-
-        # find aspect ratio
-        aspect_ratio = None
-        for stream in video_info['streams']:
-            if stream['codec_type'] == 'video':
-                if 'display_aspect_ratio' in stream:
-                    aspect_ratio = stream['display_aspect_ratio']
-                else:
-                    # try calc with width and height
-                    width = stream['width'] if 'width' in stream else 0
-                    height = stream['height'] if 'height' in stream else 0
-                    # check if 2:1 aspect ratio
-                    if width > 0 and height > 0 and width / height == 2:
-                        aspect_ratio = '2:1'
-                break
-        sbs_video = True if aspect_ratio == '2:1' else False
-        crop_filter = "" if not sbs_video else "v360=input=hequirect:output=flat:in_stereo=sbs:h_fov=120:v_fov=90,"
-        clip_duration = 8
-        if midpoint + clip_duration > duration:
-            clip_duration = int((duration - midpoint - 1) if duration - midpoint - 1 > 0 else 1)
-
-        with open(os.devnull, 'w') as devnull:
-            stdout = None if is_debug() else devnull
-            execution_timelimit = 180
-
-            outfile = os.path.join(thumbnail_dir, f"{base_name}{ThumbnailFormat.WEBP.extension}")
-            push_text_to_client(f"Starting ffmpeg for webp - {base_name}")
-            cmd = ['ffmpeg', '-ss', str(midpoint), '-an', '-t', str(clip_duration), '-y', '-i', video_path, '-loop', '0', '-vf', crop_filter + 'fps=1,scale=w=1024:h=768:force_original_aspect_ratio=decrease', outfile]
-            logger.debug(f"Running command - webp: {' '.join(cmd)}")
-            try:
-                subprocess.run(cmd, check=True, stdout=stdout, stderr=stdout, timeout=execution_timelimit)
-            except subprocess.TimeoutExpired:
-                logger.error(f"Failed to generate thumbnail for webp (timeout): {video_path}")
-                push_text_to_client(f"Failed to generate thumbnail for webp (timeout): {video_path}")
-                return False
-
-            outfile = os.path.join(thumbnail_dir, f"{base_name}{ThumbnailFormat.JPG.extension}")
-            push_text_to_client(f"Starting ffmpeg for jpg - {base_name}")
-            cmd = ['ffmpeg', '-ss', str(midpoint), '-an', '-y', '-i', video_path, '-vf', crop_filter + 'fps=1,scale=w=1024:h=768:force_original_aspect_ratio=decrease', '-frames:v', '1', '-update', '1', outfile]
-            logger.debug(f"Running command - jpg: {' '.join(cmd)}")
-            try:
-                subprocess.run(cmd, check=True, stdout=stdout, stderr=stdout, timeout=execution_timelimit)
-            except subprocess.TimeoutExpired:
-                logger.error(f"Failed to generate thumbnail for jpg (timeout): {video_path}")
-                push_text_to_client(f"Failed to generate thumbnail for jpg (timeout): {video_path}")
-                return False
-
-            outfile = os.path.join(thumbnail_dir, f"{base_name}{ThumbnailFormat.WEBM.extension}")
-            push_text_to_client(f"Starting ffmpeg for webm - {base_name}")
-            cmd = ['ffmpeg', '-ss', str(midpoint), '-t', str(clip_duration), '-y', '-i', video_path, '-vf', crop_filter + 'scale=380:-1', '-c:v', 'libvpx', '-b:v', '256k', '-c:a', 'libvorbis', outfile]
-            logger.debug(f"Running command - webm: {' '.join(cmd)}")
-            try:
-                subprocess.run(cmd, check=True, stdout=stdout, stderr=stdout, timeout=execution_timelimit)
-            except subprocess.TimeoutExpired:
-                logger.error(f"Failed to generate thumbnail for webm (timeout): {video_path}")
-                push_text_to_client(f"Failed to generate thumbnail for webm (timeout): {video_path}")
-                return False
+        params = _thumbnail_params(video_info, _use_fast_mode(video_info, speed, os.path.getsize(video_path)))
+        logger.debug(f"Video duration: {params.duration} seconds - taking thumbnail at {params.midpoint} seconds"
+                     f"{' (fast mode)' if params.fast else ''}")
+        outfiles = {fmt: os.path.join(thumbnail_dir, f"{base_name}{fmt.extension}") for fmt in PREVIEW_FORMATS}
+
+        try:
+            result = _run_pipeline(THUMBNAIL_PIPELINE, video_path, params, outfiles, cancel_event)
+            # the separate processes decode the clip once per format - no fallback after a timeout
+            if result == PipelineResult.FAILED and THUMBNAIL_PIPELINE == ThumbnailPipeline.COMBINED:
+                logger.warning(f"Combined ffmpeg pipeline failed for {base_name} - falling back to separate processes")
+                result = _run_pipeline(ThumbnailPipeline.SEPARATE, video_path, params, outfiles, cancel_event)
+            success = result == PipelineResult.SUCCESS
+        except ThumbnailCancelled:
+            # do not leave half written thumbnails behind
+            for outfile in outfiles.values():
+                if os.path.exists(outfile):
+                    os.remove(outfile)
+            push_text_to_client(f"Generating thumbnail cancelled for {base_name}")
+            return None
+        finally:
+            invalidate_thumbnails(video_path)
+        if not success:
+            return False
 
         # re-generate similarity hash
+        from similar import build_features_for_video, update_similarity_features
         video_url = get_url_from_path(video_path)
+        features = None
         with get_video_db() as db:
-            video = db.for_video_table.get_video(video_url)
-            if video:
-                logger.debug(f"Generating similarity hash for {video_url}")
-                push_text_to_client(f"Generating similarity hash for {video_url}")
-                from src.similar import build_features_for_video
-                features = build_features_for_video(video_url)
-                if features:
-                    video.similarity = Similarity(histogramm=features.histogram.tobytes(),
-                                                  phash=features.phash.tobytes(),
-                                                  hog=features.hog.tobytes())
-
+            known_video = db.for_video_table.get_video(video_url) is not None
+        if known_video:
+            logger.debug(f"Generating similarity hash for {video_url}")
+            push_text_to_client(f"Generating similarity hash for {video_url}")
+            # the thumbnail is decoded in the feature pool - the session is only opened to store the result
+            features = build_features_for_video(video_url)
+            if features:
+                with get_video_db() as db:
+                    db.for_similarity_table.store_features({video_url: (features.histogram.tobytes(),
+                                                                        features.phash.tobytes(),
+                                                                        features.hog.tobytes())})
+        if features:
+            update_similarity_features(video_url, features)
+
+        invalidate_catalog_entry(video_path)
         return True
     except Exception as e:
         logger.error(f"Failed to generate thumbnail for {video_path}: {e}")
         return False
 
+@cache(maxsize=4096, ttl=3600)
+def thumbnail_manifest(thumbnail_dir: str) -> frozenset[str]:
+    """
+    (cached; max time in cache 1 hour)
+    Names of all files in a .thumb directory - listed with one scandir,
+    thumbnail lookups are set membership tests instead of a stat call per file and format
+
+    :param thumbnail_dir: full path to the .thumb directory
+    :return: set of file names, empty if the directory does not exist
+    """
+    try:
+        with os.scandir(thumbnail_dir) as it:
+            return frozenset(entry.name for entry in it)
+    except OSError:
+        return frozenset()
+
+
+def invalidate_thumbnails(*video_paths: str) -> None:
+    """
+    Drop the cached thumbnails and the .thumb directory manifest for video files - call after thumbnails changed
+
+    :param video_paths: full paths to the video files
+    """
+    for video_path in video_paths:
+        get_thumbnails.cache__evict(video_path)
+        thumbnail_manifest.cache__evict(get_thumbnail_directory(video_path))
+
+
 @cache(maxsize=4096, ttl=3600)
 def get_thumbnails(filename):
     """
@@ -307,37 +680,131 @@ def get_thumbnails(filename):
     base_name = os.path.basename(filename)
     thumbnail_directory = get_thumbnail_directory(filename)
     relative_path = os.path.relpath(thumbnail_directory, get_static_directory()).replace('\\', '/')
+    manifest = thumbnail_manifest(thumbnail_directory)
 
     return {
         fmt: f"/static/{relative_path}/{base_name}{fmt.extension}"
         for fmt in ThumbnailFormat
-        if os.path.exists(os.path.join(thumbnail_directory, f"{base_name}{fmt.extension}"))
+        if f"{base_name}{fmt.extension}" in manifest
     }
 
 
-def generate_thumbnail_for_path(video_path):
+_on_demand_lock = threading.Lock()
+_on_demand_jobs: dict[str, Job] = {}
+
+
+def request_thumbnail(video_path: str) -> Optional[Job]:
     """
-    Generate thumbnail for a single provided video url link
-    will always generate a new set of thumbnails
+    Generate the thumbnails of a single video in the background - does not wait for the generation.
+    Concurrent requests for the same video share one job. A failed generation is not tried again
+    for ON_DEMAND_RETRY_AFTER seconds, requests in this time return None.
 
-    the video_path should be an url path to the video file it should be in the static/videos or static/library folder
-    the url is used to determine the thumbnail path (library or videos)
+    :param video_path: full path to the video file
+    :return: the queued or running job or None if the video does not exist or failed recently
+    """
+    if video_path.endswith('.part') or not os.path.isfile(video_path):
+        return None
+    with _on_demand_lock:
+        job = _on_demand_jobs.get(video_path)
+        if job is not None:
+            if job.state in (JobState.QUEUED, JobState.RUNNING):
+                return job
+            if job.state == JobState.FAILED and time.time() - (job.finished or 0) < ON_DEMAND_RETRY_AFTER:
+                return None
+        job = enqueue_job(THUMBNAIL_JOB, video_path, JobPriority.SINGLE)
+        _on_demand_jobs[video_path] = job
+        # forget finished successful jobs - the thumbnails exist now
+        for path in [p for p, j in _on_demand_jobs.items() if j.state in (JobState.DONE, JobState.CANCELLED)]:
+            del _on_demand_jobs[path]
+    logger.debug(f"On demand thumbnail generation for {video_path} - job {job.id}")
+    return job
+
+
+def request_missing_thumbnail(static_path: str) -> Optional[ThumbnailFormat]:
+    """
+    Called for a missing file below the static folder - if it is a preview thumbnail of a video in the catalog
+    the generation for this video is requested. Paths leading out of the static folder are ignored.
 
-    :param video_path: url part of the video file
-    :return: json object with success and message
+    :param static_path: path relative to the static folder e.g. library/sub/.thumb/video.mp4.thumb.jpg
+    :return: the format of the requested thumbnail if generation was requested, otherwise None
     """
+    if safe_join(get_static_directory(), static_path) is None:
+        return None
+    directory, name = os.path.split(static_path.replace('\\', '/'))
+    if os.path.basename(directory) != THUMBNAIL_DIR_NAME:
+        return None
+    fmt = next((fmt for fmt in PREVIEW_FORMATS if name.endswith(fmt.extension)), None)
+    if fmt is None:
+        return None
+    video_path, _ = get_real_path_from_url(f"/static/{os.path.dirname(directory)}/{name[:-len(fmt.extension)]}")
+    if not video_path or not is_cataloged(video_path) or request_thumbnail(video_path) is None:
+        return None
+    return fmt
 
+
+def _thumbnail_target(video_path) -> tuple[Optional[str], Optional[ServerResponse]]:
     real_path, _ = get_real_path_from_url(video_path)
     if not real_path:
         logger.debug(f"Invalid video path: {video_path}")
-        return ServerResponse(False, "Invalid video path")
+        return None, ServerResponse(False, "Invalid video path")
 
     if not os.path.isfile(real_path):
         logger.debug(f"Video file does not exist: {real_path}")
-        return ServerResponse(False, "Video file does not exist")
+        return None, ServerResponse(False, "Video file does not exist")
+    return real_path, None
+
+
+def create_thumbnail_run(name: str) -> JobRun:
+    """
+    Create a run for thumbnail jobs - the list cache is cleared once when its last job is done.
+    Close it with jobs.close_run after all jobs are scheduled.
+
+    :param name: name of the run for progress messages
+    :return: the run
+    """
+    return create_run(name, on_finished=_thumbnails_run_finished)
+
+
+def schedule_thumbnail_for_path(video_path, run: JobRun, priority: JobPriority = JobPriority.SINGLE) -> ServerResponse:
+    """
+    Schedule the generation of the thumbnails of a single video url in a run - does not wait for the generation
+
+    :param video_path: url part of the video file
+    :param run: run the job belongs to (see create_thumbnail_run)
+    :param priority: priority of the job
+    :return: json object with success and message (including the job id)
+    """
+    real_path, error = _thumbnail_target(video_path)
+    if error:
+        return error
+
+    job = enqueue_job(THUMBNAIL_JOB, real_path, priority, run)
+    return ServerResponse(True, f"Generate thumbnails scheduled for {os.path.basename(real_path)} (job {job.id})")
+
+
+def generate_thumbnail_for_path(video_path, priority: JobPriority = JobPriority.SINGLE,
+                                speed: ThumbnailSpeed = ThumbnailSpeed.AUTO):
+    """
+    Generate thumbnail for a single provided video url link
+    will always generate a new set of thumbnails
+    the generation runs on the job workers, this call waits for it
+
+    the video_path should be an url path to the video file it should be in the static/videos or static/library folder
+    the url is used to determine the thumbnail path (library or videos)
+
+    :param video_path: url part of the video file
+    :param priority: priority of the job - downloads are generated before everything else
+    :param speed: fast, accurate or auto (fast only for very large files) generation
+    :return: json object with success and message
+    """
+
+    real_path, error = _thumbnail_target(video_path)
+    if error:
+        return error
 
     base_name = os.path.basename(real_path)
-    success = generate_thumbnail(real_path)
+    options = {'speed': speed.value} if speed != ThumbnailSpeed.AUTO else None
+    success = enqueue_job(THUMBNAIL_JOB, real_path, priority, options=options).wait()
     push_text_to_client(f"Generate thumbnails finished for {base_name} with {'success' if success else 'failure'}")
     if success:
         return ServerResponse(True, f"Generate thumbnails finished for {base_name}")
@@ -346,25 +813,72 @@ def generate_thumbnail_for_path(video_path):
 
 def update_file_info(file_path: str, updated_dict: dict) -> None:
     """
-    Change the file info for a video file in the json file
+    Change the additional infos of a video file in the stored video info and the json file
 
     :param file_path: full path to video file
     :param updated_dict: info to update
     :return: none
     """
-    base_name = os.path.basename(file_path)
-    json_path = os.path.join(get_thumbnail_directory(file_path), base_name) + ThumbnailFormat.JSON.extension
-    if os.path.isfile(json_path):
-        with open(json_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            infos = data.get('infos')
-            # add info to existing infos if None
-            if infos is None:
-                infos = {}
-                data['infos'] = infos
-
-        infos.update(updated_dict)
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-        get_video_info.cache__evict(file_path)
+    info = _load_video_info(file_path)
+    if info is not None:
+        # replace instead of modify - readers may hold the old dict
+        info = {**info, 'infos': {**(info.get('infos') or {}), **updated_dict}}
+        store_video_info(file_path, info)
+        _write_sidecar(file_path, info)
+
 
+def main():
+    """
+    Compare the separate (one ffmpeg per format), the combined (single decode) and the combined fast (keyframes only)
+    thumbnail generation
+
+    usage: python thumbnail.py video_file [runs] - the previews are written to a temporary directory
+    """
+    import sys
+    import tempfile
+    try:
+        import resource
+    except ImportError:
+        resource = None     # no child cpu times on windows
+
+    if len(sys.argv) < 2:
+        print(main.__doc__)
+        return
+    video_path = os.path.abspath(sys.argv[1])
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    probe = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format', '-show_entries', 'stream', '-of', 'json', video_path],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    params = _thumbnail_params(json.loads(probe.stdout))
+    print(f"{os.path.basename(video_path)}: duration {params.duration:.1f}s, sbs {params.sbs}, clip {params.clip_duration}s")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        results = {}
+        variants = [('separate', ThumbnailPipeline.SEPARATE, params._replace(fast=False)),
+                    ('combined', ThumbnailPipeline.COMBINED, params._replace(fast=False)),
+                    ('fast', ThumbnailPipeline.COMBINED, params._replace(fast=True))]
+        for name, pipeline, variant_params in variants:
+            outfiles = {fmt: os.path.join(temp_dir, f"{name}{fmt.extension}") for fmt in PREVIEW_FORMATS}
+            wall = cpu = 0.0
+            for _ in range(runs):
+                cpu_before = resource.getrusage(resource.RUSAGE_CHILDREN) if resource else None
+                start = time.perf_counter()
+                result = _run_pipeline(pipeline, video_path, variant_params, outfiles, None)
+                if result != PipelineResult.SUCCESS:
+                    print(f"{name} pipeline failed ({result.value})")
+                    return
+                wall += time.perf_counter() - start
+                if resource:
+                    cpu_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+                    cpu += (cpu_after.ru_utime - cpu_before.ru_utime) + (cpu_after.ru_stime - cpu_before.ru_stime)
+            results[name] = (wall / runs, cpu / runs)
+            sizes = ', '.join(f"{fmt.fmt} {os.path.getsize(path) // 1024}KB" for fmt, path in outfiles.items())
+            print(f"{name:>9}: wall {wall / runs:.2f}s, ffmpeg cpu {cpu / runs:.2f}s - {sizes}")
+
+        separate = results['separate']
+        for name in ('combined', 'fast'):
+            print(f"{name} speedup: wall {separate[0] / results[name][0]:.2f}x"
+                  + (f", cpu {separate[1] / results[name][1]:.2f}x" if resource and results[name][1] else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import NamedTuple, Optional, Callable, Iterator
+
+from loguru import logger
+
+# directories are listed in parallel - most time is spent waiting for the (network) filesystem
+TRAVERSAL_WORKERS = 8
+
+
+class FileRecord(NamedTuple):
+    path: str
+    name: str
+    directory: str
+    stat: Optional[os.stat_result]
+
+
+class DirRecord(NamedTuple):
+    path: str
+    relative: str
+    stat: os.stat_result
+    files: Optional[list[FileRecord]]
+    subdirs: list[str]
+    hidden: list[str]
+
+
+# called with (directory, stat) - return the known sub folders to skip listing the directory or None to list it
+ReuseCallback = Callable[[str, os.stat_result], Optional[tuple | list]]
+
+
+def _relative(path: str, root: str) -> str:
+    relative = os.path.relpath(path, root).replace('\\', '/')
+    return '' if relative == '.' else relative
+
+
+def _scan_directory(path: str, root: str, stat_files: bool, reuse: Optional[ReuseCallback]) -> DirRecord:
+    stat = os.stat(path)
+    if reuse:
+        known_subdirs = reuse(path, stat)
+        if known_subdirs is not None:
+            return DirRecord(path, _relative(path, root), stat, None, list(known_subdirs), [])
+
+    files = []
+    subdirs = []
+    hidden = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    if entry.name.startswith('.'):
+                        hidden.append(entry.name)
+                    else:
+                        subdirs.append(entry.path)
+                elif entry.is_file():
+                    files.append(FileRecord(entry.path, entry.name, path, entry.stat() if stat_files else None))
+            except OSError:
+                continue
+    return DirRecord(path, _relative(path, root), stat, files, subdirs, hidden)
+
+
+def walk_directories(root: str, stat_files: bool = True, reuse: Optional[ReuseCallback] = None,
+                     workers: int = TRAVERSAL_WORKERS) -> Iterator[DirRecord]:
+    """
+    Walk all directories below root (following symlinks) and yield one record per directory.
+    Sub folders are listed in parallel on a bounded thread pool, the stat result of every file is taken
+    from the scandir entry so no further isfile/getsize/getctime calls are needed.
+    Directories starting with a dot are not descended into, their names are reported in hidden.
+    The order of the records is not defined.
+
+    :param root: directory to start from
+    :param stat_files: stat every file, otherwise the stat of the file records is None
+    :param reuse: optional callback to skip listing unchanged directories, records for them have files None
+    :param workers: number of parallel directory listings
+    :return: iterator of directory records
+    """
+    root = os.path.normpath(root)
+    visited = set()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='traversal') as pool:
+        pending = {pool.submit(_scan_directory, root, root, stat_files, reuse)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    record = future.result()
+                except OSError as e:
+                    logger.warning(f"Could not list directory: {e}")
+                    continue
+                # protect against symlink loops
+                key = (record.stat.st_dev, record.stat.st_ino)
+                if key in visited:
+                    continue
+                visited.add(key)
+                for subdir in record.subdirs:
+                    pending.add(pool.submit(_scan_directory, subdir, root, stat_files, reuse))
+                yield record
+
+
+def walk_files(root: str, workers: int = TRAVERSAL_WORKERS) -> Iterator[tuple[DirRecord, FileRecord]]:
+    """
+    Walk all files below root, see walk_directories
+
+    :param root: directory to start from
+    :param workers: number of parallel directory listings
+    :return: iterator of (directory record, file record)
+    """
+    for record in walk_directories(root, workers=workers):
+        for file in record.files:
+            yield record, file
+
+
+def _create_benchmark_tree(target: str, depth: int, width: int, files: int) -> int:
+    count = 0
+    stack = [(target, 0)]
+    while stack:
+        path, level = stack.pop()
+        os.makedirs(path, exist_ok=True)
+        for i in range(files):
+            with open(os.path.join(path, f"video_{i}.mp4"), 'wb') as f:
+                f.write(b'\0' * 16)
+            count += 1
+        if level < depth:
+            stack.extend((os.path.join(path, f"dir_{i}"), level + 1) for i in range(width))
+    return count
+
+
+def _serial_walk(root: str) -> int:
+    # the previous way: os.walk and separate stat calls per file
+    count = 0
+    for current, dirs, files in os.walk(root, followlinks=True):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for filename in files:
+            path = os.path.join(current, filename)
+            if os.path.isfile(path):
+                os.path.getsize(path)
+                os.path.getctime(path)
+                count += 1
+    return count
+
+
+def _drop_caches() -> bool:
+    # needs root on linux - otherwise the runs after the first one are measured with warm caches
+    try:
+        os.sync()
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return True
+    except (OSError, AttributeError):
+        return False
+
+
+def main():
+    """
+    Benchmark the serial os.walk against the parallel traversal
+
+    usage: python traversal.py [directory] - without directory a deep temporary tree is created
+    to see the effect of cold caches on a network mount run it against the mounted library
+    """
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if len(sys.argv) > 1:
+            root = sys.argv[1]
+        else:
+            root = os.path.join(temp_dir, 'tree')
+            created = _create_benchmark_tree(root, depth=4, width=4, files=20)
+            print(f"Created benchmark tree with {created} files in {root}")
+
+        cold = _drop_caches()
+        print(f"Measuring with {'cold' if cold else 'warm (could not drop caches)'} filesystem caches")
+        start = time.perf_counter()
+        serial_count = _serial_walk(root)
+        serial_time = time.perf_counter() - start
+        print(f"os.walk + stat calls: {serial_count} files in {serial_time:.3f}s")
+
+        for workers in (1, 4, TRAVERSAL_WORKERS, 16):
+            _drop_caches()
+            start = time.perf_counter()
+            count = sum(1 for _ in walk_files(root, workers=workers))
+            parallel_time = time.perf_counter() - start
+            print(f"parallel scandir ({workers:2d} workers): {count} files in {parallel_time:.3f}s "
+                  f"- speedup {serial_time / parallel_time if parallel_time else 0:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
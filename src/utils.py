@@ -1,10 +1,13 @@
 import errno
+import functools
 import os
 import requests
 import re
 import mimetypes
-from pathlib import Path
+from typing import Optional
+
 from loguru import logger
+
 from globals import FolderState
 
 
@@ -105,80 +108,152 @@ def check_folder(path) -> tuple[str,FolderState]:
 
 
 
-def get_mime_type(file_path):
-    """
-    Determines the MIME type of file based on its extension and content.
+SNIFF_HEADER_SIZE = 1024
+TS_PACKET_SIZE = 188
+M2TS_PACKET_SIZE = 192
+
+# video extensions the system mime.types maps wrong or not at all (.ts is often a Qt translation file)
+VIDEO_EXTENSION_TYPES = {
+    '.ts': 'video/mp2t',
+    '.m2ts': 'video/mp2t',
+    '.mts': 'video/mp2t',
+}
+
+# (offset, magic bytes, mime type) - checked in order, first match wins
+MAGIC_SIGNATURES = (
+    (0, b'\xFF\xD8\xFF', 'image/jpeg'),
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'%PDF', 'application/pdf'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'%!', 'application/postscript'),
+    (0, b'OggS', 'video/ogg'),
+    (0, b'FLV', 'video/x-flv'),
+    (0, b'\x00\x00\x01\xBA', 'video/mpeg'),
+    (0, b'\x00\x00\x01\xB3', 'video/mpeg'),
+    (0, b'\x30\x26\xB2\x75\x8E\x66\xCF\x11', 'video/x-ms-wmv'),
+)
+
+# RIFF form types
+RIFF_TYPES = {
+    b'AVI ': 'video/x-msvideo',
+    b'WEBP': 'image/webp',
+    b'WAVE': 'audio/wav',
+}
+
+# ISO base media file format major/compatible brands (ftyp box)
+FTYP_BRANDS = {
+    b'qt  ': 'video/quicktime',
+    b'M4V ': 'video/x-m4v', b'M4VH': 'video/x-m4v', b'M4VP': 'video/x-m4v',
+    b'M4A ': 'audio/mp4', b'M4B ': 'audio/mp4', b'F4A ': 'audio/mp4',
+    b'3gp4': 'video/3gpp', b'3gp5': 'video/3gpp', b'3gp6': 'video/3gpp', b'3ge6': 'video/3gpp',
+    b'3g2a': 'video/3gpp2', b'3g2b': 'video/3gpp2', b'3g2c': 'video/3gpp2',
+    b'avif': 'image/avif', b'heic': 'image/heic', b'mif1': 'image/heif',
+}
+FTYP_DEFAULT = 'video/mp4'      # isom, iso2-9, mp41, mp42, avc1, dash, MSNV, f4v, ...
+
+# Matroska EBML DocType values
+EBML_DOCTYPES = {
+    b'webm': 'video/webm',
+    b'matroska': 'video/x-matroska',
+}
+EBML_DOCTYPE_ID = b'\x42\x82'
+
+
+def _sniff_riff(header: bytes) -> Optional[str]:
+    if not header.startswith(b'RIFF'):
+        return None
+    return RIFF_TYPES.get(header[8:12])
 
-    :param file_path: path to file
-    :return: A tuple containing the MIME type (string) and encoding (string), or
-        (None, None) if the MIME type cannot be determined.
-        Raises FileNotFoundError if the file does not exist.
-    """
 
-    file_path = Path(file_path) # Convert to Path object for easier handling
-    if not file_path.exists():
-        raise FileNotFoundError(f"File not found: {file_path}")
+def _sniff_ftyp(header: bytes) -> Optional[str]:
+    if header[4:8] != b'ftyp':
+        return None
+    box_size = int.from_bytes(header[0:4], 'big')
+    brands = [header[8:12]] + [header[i:i + 4] for i in range(16, min(box_size, len(header)) - 3, 4)]
+    for brand in brands:
+        if brand in FTYP_BRANDS:
+            return FTYP_BRANDS[brand]
+    return FTYP_DEFAULT
 
-    mime_type, encoding = mimetypes.guess_type(str(file_path))
 
-    # For more robust mime type detection (especially for files without extensions or with unusual extensions)
+def _sniff_ebml(header: bytes) -> Optional[str]:
+    if not header.startswith(b'\x1A\x45\xDF\xA3'):
+        return None
+    pos = header.find(EBML_DOCTYPE_ID)
+    if pos >= 0 and pos + 3 <= len(header):
+        # DocType size is a variable length integer - it is always short, a one byte vint is expected
+        size_byte = header[pos + 2]
+        if size_byte & 0x80:
+            doctype = header[pos + 3:pos + 3 + (size_byte & 0x7F)].rstrip(b'\x00')
+            return EBML_DOCTYPES.get(doctype, 'video/x-matroska')
+    return 'video/x-matroska'
+
+
+def _sniff_transport_stream(header: bytes) -> Optional[str]:
+    # sync byte 0x47 repeating every packet - plain TS (188) or M2TS/BDAV with 4 byte timestamp (192)
+    for packet_size, offset, mime_type in ((TS_PACKET_SIZE, 0, 'video/mp2t'), (M2TS_PACKET_SIZE, 4, 'video/mp2t')):
+        positions = [offset + i * packet_size for i in range(3)]
+        if positions[-1] < len(header) and all(header[p] == 0x47 for p in positions):
+            return mime_type
+    return None
+
+
+def sniff_mime_type(header: bytes) -> Optional[str]:
+    """
+    Determine the MIME type from the first bytes of a file (container signatures)
+
+    :param header: first bytes of the file - SNIFF_HEADER_SIZE bytes are enough for all checks
+    :return: MIME type or None if not detected
+    """
+    for offset, magic, mime_type in MAGIC_SIGNATURES:
+        if header[offset:offset + len(magic)] == magic:
+            return mime_type
+    for sniffer in (_sniff_riff, _sniff_ftyp, _sniff_ebml, _sniff_transport_stream):
+        mime_type = sniffer(header)
+        if mime_type:
+            return mime_type
+    return None
+
+
+# lru_cache - the cache decorator is not bounded and every changed file adds a key
+@functools.lru_cache(maxsize=16384)
+def _mime_type_for(file_path: str, size: int, mtime: int) -> tuple[Optional[str], Optional[str]]:
+    # size and mtime are part of the cache key - a changed file is sniffed again
+    extension_type = VIDEO_EXTENSION_TYPES.get(os.path.splitext(file_path)[1].lower())
+    if extension_type:
+        return extension_type, None
+    mime_type, encoding = mimetypes.guess_type(file_path)
     if mime_type is None:
-        # Check file signature for common file types
         try:
             with open(file_path, 'rb') as f:
-                header = f.read(16)  # Read first few bytes for signature detection
-
-                # Check for common file signatures
-                if header.startswith(b'\xFF\xD8\xFF'):  # JPEG
-                    mime_type = 'image/jpeg'
-                elif header.startswith(b'\x89PNG\r\n\x1a\n'):  # PNG
-                    mime_type = 'image/png'
-                elif header.startswith(b'GIF87a') or header.startswith(b'GIF89a'):  # GIF
-                    mime_type = 'image/gif'
-                elif header.startswith(b'%PDF'):  # PDF
-                    mime_type = 'application/pdf'
-                elif header[0:4] == b'PK\x03\x04':  # ZIP, DOCX, XLSX, etc.
-                    mime_type = 'application/zip'
-                elif header.startswith(b'\x25\x21'):  # PostScript
-                    mime_type = 'application/postscript'
-                # Video formats
-                elif header.startswith(b'\x00\x00\x00\x18ftypmp42'):  # MP4 (MPEG-4 Part 14)
-                    mime_type = 'video/mp4'
-                elif header.startswith(b'\x00\x00\x00\x1cftypmp42'):  # MP4
-                    mime_type = 'video/mp4'
-                elif header.startswith(b'\x00\x00\x00\x20ftypisom'):  # MP4 (ISO Base Media)
-                    mime_type = 'video/mp4'
-                elif header.startswith(b'\x00\x00\x00\x20ftypM4V'):  # M4V
-                    mime_type = 'video/x-m4v'
-                elif header.startswith(b'\x1A\x45\xDF\xA3'):  # MKV (Matroska)
-                    mime_type = 'video/x-matroska'
-                elif header.startswith(b'RIFF') and b'AVI' in header:  # AVI
-                    mime_type = 'video/x-msvideo'
-                elif header.startswith(b'OggS'):  # OGG (container for Theora, etc.)
-                    mime_type = 'video/ogg'
-                elif header.startswith(b'\x00\x00\x00\x14ftyf'):  # MPEG-4 video
-                    mime_type = 'video/mp4'
-                elif header.startswith(b'\x1C\x00\x00\x00') and b'webm' in header:  # WebM
-                    mime_type = 'video/webm'
-                elif header.startswith(b'\x00\x00\x01\xBA') or header.startswith(b'\x00\x00\x01\xB3'):  # MPEG (1/2)
-                    mime_type = 'video/mpeg'
-                elif header.startswith(b'FLV'):  # Flash Video
-                    mime_type = 'video/x-flv'
-                # Add more signature checks as needed
-
+                mime_type = sniff_mime_type(f.read(SNIFF_HEADER_SIZE))
         except IOError as e:
             logger.warning(f"Could not read file for signature check: {e}")
+    return mime_type, encoding
 
-    # Try using file command if available (Unix/Linux/macOS)
-    if mime_type is None and os.name != 'nt':  # Not Windows
-        try:
-            import subprocess
-            output = subprocess.check_output(['file', '--mime-type', '-b', str(file_path)])
-            mime_type = output.decode('utf-8').strip()
-        except (subprocess.SubprocessError, FileNotFoundError):
-            logger.warning("Could not determine MIME type using 'file' command")
 
-    return mime_type, encoding
+def get_mime_type(file_path, stat: os.stat_result = None):
+    """
+    Determines the MIME type of file based on its extension and content.
+    The result is cached by path, size and modification time,
+    the file header is only read if the extension is not known.
+
+    :param file_path: path to file
+    :param stat: optional stat result of the file to avoid another stat call
+    :return: A tuple containing the MIME type (string) and encoding (string), or
+        (None, None) if the MIME type cannot be determined.
+        Raises FileNotFoundError if the file does not exist.
+    """
+
+    file_path = str(file_path)
+    if stat is None:
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"File not found: {file_path}")
+    return _mime_type_for(file_path, stat.st_size, stat.st_mtime_ns)
 
 def check_video_url_stale(url: str) -> tuple[bool, int]:
     """
@@ -13,11 +13,13 @@ from yt_dlp.networking.impersonate import ImpersonateTarget
 from bus import push_text_to_client
 from database.video_database import get_video_db
 from database.video_models import Videos, Similarity, Online
-from files import list_files
+from files import list_files, invalidate_files
 from globals import get_application_path, \
     remove_ansi_codes, VideoFolder, ServerResponse, UNKNOWN_VIDEO_EXTENSION, ID_NAME_SEPERATOR, get_real_path_from_url
 from onlines import list_onlines
-from similar import build_features_for_video, clear_similarity_cache
+from similar import build_features_for_video, build_features_for_videos, clear_similarity_cache, \
+    update_similarity_features, rebuild_similarity_neighbors
+from jobs import JobPriority
 from thumbnail import generate_thumbnail_for_path, get_video_info
 from utils import check_video_url_stale
 
@@ -165,6 +167,7 @@ def get_stream(url) -> tuple:
                                     resolution=online_resolution, info=json.dumps(info, default=str),
                                     size=content_length, duration=duration, description=description)
                     db.for_online_table.upsert_online(url, online)
+                    db.for_search_table.store_onlines([db.for_online_table.get_online(url)])
                 # clear list cache
                 list_onlines.cache__clear()
 
@@ -214,19 +217,19 @@ def download_video(url, title):
             current_download.original_url = url
             db.session.merge(current_download)
 
-        list_files.cache__clear()
+        invalidate_files(os.path.abspath(filename))
         # only generate thumbnails if download is a video check for file with extension ".unknown_video" this is not a video
         if not video_url.endswith(UNKNOWN_VIDEO_EXTENSION):
-            generate_thumbnail_for_path(video_url)
+            generate_thumbnail_for_path(video_url, JobPriority.DOWNLOAD)
             real_path, _ = get_real_path_from_url(video_url)
             video_uid = None
             if real_path:
                 video_info = get_video_info(real_path)
                 if video_info:
                     video_uid = video_info.get('infos', {}).get('video_uid', None)
+            features = build_features_for_video(video_url)
             with get_video_db() as db:
                 similarity = None
-                features = build_features_for_video(video_url)
                 if features:
                     similarity = Similarity(histogramm=features.histogram.tobytes(),
                                             phash=features.phash.tobytes(),
@@ -234,8 +237,9 @@ def download_video(url, title):
                 video = Videos(video_url=video_url, source_url=url, file_name=basename, title=title, download_id=download_random_id,
                                video_uid=video_uid, download_date=download_date, similarity=similarity)
                 db.for_video_table.upsert_video(video_url, video)
+            if features:
+                update_similarity_features(video_url, features)
 
-        clear_similarity_cache()
         list_onlines.cache__clear()
         logger.debug(f"Download finished: {video_url}")
         push_text_to_client(f"Download finished: {video_url}")
@@ -277,10 +281,13 @@ def download_progress(d):
         output = f"Downloading...[{video_id}] - 100.0% complete: {fname}"
     push_text_to_client(output)
 
-def _add_video_to_db(file):
+def add_video_to_db(file) -> bool:
+    """
+    :return: True if the video has no similarity features yet
+    """
     video_url = file.get('filename')
     if not video_url:
-        return
+        return False
 
     with get_video_db() as db:
         video = db.for_video_table.get_video(video_url)
@@ -299,31 +306,27 @@ def _add_video_to_db(file):
             for attr, value in file_vars.items():
                 if getattr(video, attr) != value:
                     setattr(video, attr, value)
-            if not video.similarity or video.similarity.histogramm is None or video.similarity.phash is None:
-                features = build_features_for_video(video_url)
-                if features:
-                    video.similarity = Similarity(histogramm=features.histogram.tobytes(),
-                                                  phash=features.phash.tobytes(),
-                                                  hog=features.hog.tobytes())
-        else:
-            video = Videos(video_url=video_url, **file_vars)
-            features = build_features_for_video(video_url)
-            if features:
-                video.similarity = Similarity(histogramm=features.histogram.tobytes(),
-                                              phash=features.phash.tobytes(),
-                                              hog=features.hog.tobytes())
-            db.session.add(video)
+            return not video.similarity or video.similarity.histogramm is None or video.similarity.phash is None
+        db.session.add(Videos(video_url=video_url, **file_vars))
+        return True
 
 
 def scan_for_videos():
     files = list_files()
     try:
+        missing_features = []
         for i, file in enumerate(files):
             if i != 0 and i % 10 == 0:
                 push_text_to_client(f"...scanned {i} videos - running")
-            _add_video_to_db(file)
+            if add_video_to_db(file):
+                missing_features.append(file['filename'])
 
+        # features are built on all cores after the scan - no database session is held while the thumbnails are decoded
+        added_features = len(build_features_for_videos(missing_features))
         clear_similarity_cache()
+        if added_features:
+            # one build over all pairs is cheaper than updating the neighbor lists video by video
+            rebuild_similarity_neighbors()
         push_text_to_client(f"Scanned {len(files)} videos finished")
     except Exception as e:
         logger.error(f"Error scanning for videos: {e}")
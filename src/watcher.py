@@ -0,0 +1,345 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from enum import Enum
+from typing import Optional
+
+from loguru import logger
+
+from bus import push_text_to_client
+from catalog import CatalogChanges, update_catalog_paths, sync_catalog, set_catalog_watched
+from database.video_database import get_video_db
+from files import list_files, library_subfolders, catalog_extractor
+from globals import get_static_directory, VideoFolder, FolderState
+from traversal import walk_directories
+from utils import check_folder
+from similar import build_features_for_videos, update_similarity_features
+from videos import add_video_to_db
+
+
+class WatchMode(Enum):
+    OFF = 'off'
+    AUTO = 'auto'
+    INOTIFY = 'inotify'
+    POLL = 'poll'
+
+
+POLL_INTERVAL = 1.0         # seconds between two polls for roots without inotify
+DEBOUNCE_DELAY = 0.3        # wait for quiet time before applying inotify events
+MAX_EVENT_DELAY = 1.0       # apply pending inotify events at least this often during event storms
+
+# inotify does not see changes done by other hosts on these
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', '9p', 'afs', 'davfs', 'fuse.sshfs', 'fuse.rclone')
+
+IN_CLOSE_WRITE = 0x00000008  # files are applied once written (or moved in) - IN_CREATE is only used for directories
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class _Inotify:
+    """
+    Minimal inotify binding using ctypes - only available on linux
+    """
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path: str) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_add_watch failed for {path}: {os.strerror(errno)}")
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout: float) -> list[tuple[int, int, str]]:
+        """
+        Wait for events and return them as list of (wd, mask, name)
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class _WatchedRoot:
+    def __init__(self, folder: str, directory: VideoFolder):
+        self.folder = os.path.normpath(folder)
+        self.directory = directory
+        self.extract = catalog_extractor(folder, directory)
+        self.mode: Optional[WatchMode] = None
+
+
+_roots: list[_WatchedRoot] = []
+
+
+def _filesystem_type(path: str) -> Optional[str]:
+    """
+    Find the filesystem type for a path by looking up the longest matching mount point in /proc/mounts
+    """
+    try:
+        real_path = os.path.realpath(path)
+        best_match, fs_type = '', None
+        with open('/proc/mounts', 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 3:
+                    continue
+                mount_point = parts[1].replace('\\040', ' ')
+                if (real_path == mount_point or real_path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) > len(best_match):
+                    best_match, fs_type = mount_point, parts[2]
+        return fs_type
+    except OSError:
+        return None
+
+
+def _merge_changes(changes: list[CatalogChanges]) -> CatalogChanges:
+    # a move between the library and the videos folder is a removed entry in one root and an added one in the other
+    return CatalogChanges([entry for change in changes for entry in change.added],
+                          [entry for change in changes for entry in change.changed],
+                          [entry for change in changes for entry in change.removed],
+                          any(change.directories_changed for change in changes))
+
+
+def _sync_videos_table(changes: CatalogChanges) -> None:
+    # a move shows up as removed and added entry with the same inode and size
+    removed_by_inode = {(entry.inode, entry.size): entry for entry in changes.removed}
+    with get_video_db() as db:
+        for entry in changes.added:
+            moved_from = removed_by_inode.pop((entry.inode, entry.size), None)
+            if moved_from and moved_from.details.get('filename') and entry.details.get('filename'):
+                db.move_video(moved_from.details['filename'], entry.details['filename'])
+        for entry in removed_by_inode.values():
+            video_url = entry.details.get('filename')
+            if video_url:
+                db.for_video_table.delete_video(video_url)
+
+    missing_features = []
+    for entry in changes.added + changes.changed:
+        details = entry.details
+        if details.get('partial') or details.get('unknown'):
+            continue
+        try:
+            if add_video_to_db(details):
+                missing_features.append(details['filename'])
+        except Exception as e:
+            logger.error(f"Watcher could not update videos table for {entry.path}: {e}")
+
+    # new videos without thumbnails get their features when the thumbnails are generated
+    try:
+        for video_url, features in build_features_for_videos(missing_features).items():
+            update_similarity_features(video_url, features)
+    except Exception as e:
+        logger.error(f"Watcher could not build similarity features: {e}")
+
+
+def _apply_changes(changes: CatalogChanges) -> None:
+    if not (changes.added or changes.changed or changes.removed or changes.directories_changed):
+        return
+
+    list_files.cache__clear()
+    if changes.directories_changed:
+        library_subfolders.cache__clear()
+    _sync_videos_table(changes)
+    push_text_to_client(f"Library changed: {len(changes.added)} added, {len(changes.changed)} changed, "
+                        f"{len(changes.removed)} removed")
+
+
+def _root_for(path: str) -> Optional[_WatchedRoot]:
+    for root in _roots:
+        if path == root.folder or path.startswith(root.folder + os.sep):
+            return root
+    return None
+
+
+class _InotifyWatcher:
+    """
+    Watches all directories below the inotify roots and turns events into catalog updates
+    """
+    def __init__(self, roots: list[_WatchedRoot]):
+        self.inotify = _Inotify()
+        self.roots = roots
+        self.watches: dict[int, str] = {}
+        try:
+            for root in roots:
+                self.add_tree(root.folder)
+        except OSError:
+            self.inotify.close()
+            raise
+
+    def add_tree(self, folder: str) -> None:
+        for record in walk_directories(folder, stat_files=False):
+            wd = self.inotify.add_watch(record.path)
+            self.watches[wd] = record.path
+
+    def remove_tree(self, folder: str) -> None:
+        for wd, path in list(self.watches.items()):
+            if path == folder or path.startswith(folder + os.sep):
+                self.inotify.rm_watch(wd)
+                self.watches.pop(wd, None)
+
+    def run(self) -> None:
+        pending: set[str] = set()
+        first_pending = last_event = 0.0
+        while True:
+            try:
+                events = self.inotify.read_events(DEBOUNCE_DELAY)
+            except OSError as e:
+                logger.error(f"Watcher stopped reading inotify events: {e}")
+                self.fallback_to_poll()
+                return
+
+            now = time.monotonic()
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    # events lost - check everything once
+                    pending.update(root.folder for root in self.roots)
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                directory = self.watches.get(wd)
+                if directory is None:
+                    continue
+                path = os.path.join(directory, name) if name else directory
+                if mask & IN_ISDIR:
+                    if name.startswith('.'):
+                        continue
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        try:
+                            self.add_tree(path)
+                        except OSError as e:
+                            logger.warning(f"Watcher could not watch new directory {path}: {e}")
+                    elif mask & IN_MOVED_FROM:
+                        self.remove_tree(path)
+                elif mask & IN_CREATE:
+                    # the file may still be copied - it is applied with IN_CLOSE_WRITE
+                    continue
+                pending.add(path)
+                if not first_pending:
+                    first_pending = now
+                last_event = now
+
+            if pending and (now - last_event >= DEBOUNCE_DELAY or now - first_pending >= MAX_EVENT_DELAY):
+                self.flush(pending)
+                pending = set()
+                first_pending = 0.0
+
+    def flush(self, paths: set[str]) -> None:
+        by_root: dict[_WatchedRoot, set[str]] = {}
+        for path in paths:
+            root = _root_for(path)
+            if root:
+                by_root.setdefault(root, set()).add(path)
+        changes = []
+        for root, root_paths in by_root.items():
+            try:
+                changes.append(update_catalog_paths(root_paths, root.extract))
+            except Exception as e:
+                logger.error(f"Watcher failed to apply changes for {root.folder}: {e}")
+        _apply_changes(_merge_changes(changes))
+
+    def fallback_to_poll(self) -> None:
+        for root in self.roots:
+            set_catalog_watched(root.folder, False)
+            root.mode = WatchMode.POLL
+        _start_poll_thread(self.roots)
+
+
+def _start_poll_thread(roots: list[_WatchedRoot]) -> None:
+    def poll():
+        while True:
+            time.sleep(POLL_INTERVAL)
+            changes = []
+            for root in roots:
+                try:
+                    changes.append(sync_catalog(root.folder, root.extract))
+                except Exception as e:
+                    logger.error(f"Watcher poll failed for {root.folder}: {e}")
+            _apply_changes(_merge_changes(changes))
+
+    threading.Thread(target=poll, name='watcher-poll', daemon=True).start()
+
+
+def start_watcher(mode: WatchMode) -> None:
+    """
+    Start watching the video folders for changes done outside the server (files copied, moved or deleted by hand).
+    Changes are applied to the catalog, the list and subfolder caches and the videos table without a full rescan.
+
+    auto uses inotify for local folders and polling for network mounts where inotify does not see remote changes.
+
+    :param mode: watch mode
+    """
+    if mode == WatchMode.OFF:
+        logger.info("Filesystem watcher disabled")
+        return
+
+    for directory in VideoFolder:
+        folder, folder_state = check_folder(os.path.join(get_static_directory(), directory.dir))
+        if folder_state != FolderState.ACCESSIBLE:
+            logger.warning(f"Watcher skips folder: {folder} - state: {folder_state}")
+            continue
+        root = _WatchedRoot(folder, directory)
+        if mode == WatchMode.AUTO:
+            fs_type = _filesystem_type(folder)
+            root.mode = WatchMode.POLL if fs_type in NETWORK_FILESYSTEMS else WatchMode.INOTIFY
+        else:
+            root.mode = mode
+        _roots.append(root)
+
+    inotify_roots = [root for root in _roots if root.mode == WatchMode.INOTIFY]
+    if inotify_roots:
+        try:
+            watcher = _InotifyWatcher(inotify_roots)
+        except OSError as e:
+            logger.warning(f"inotify not usable ({e}) - falling back to polling")
+            for root in inotify_roots:
+                root.mode = WatchMode.POLL
+        else:
+            # catch up with changes done while the server was not running, then rely on events
+            _apply_changes(_merge_changes([sync_catalog(root.folder, root.extract) for root in inotify_roots]))
+            for root in inotify_roots:
+                set_catalog_watched(root.folder, True)
+            threading.Thread(target=watcher.run, name='watcher-inotify', daemon=True).start()
+
+    poll_roots = [root for root in _roots if root.mode == WatchMode.POLL]
+    if poll_roots:
+        _start_poll_thread(poll_roots)
+
+    for root in _roots:
+        logger.info(f"Watching {root.folder} for changes using {root.mode.value}")
@@ -26,6 +26,7 @@ const template = `
                 <ul class="dropdown-menu">
                     <li><a class="dropdown-item" href="#" @click.prevent="generateThumbnails('force')"><i class="bi bi-images text-danger"></i> Force redo All</a></li>
                     <li><a class="dropdown-item" href="#" @click.prevent="generateThumbnails('missing')"><i class="bi bi-image text-secondary"></i> Only Missing</a></li>
+                    <li><a class="dropdown-item" href="#" @click.prevent="generateThumbnails('stale')"><i class="bi bi-arrow-repeat text-warning"></i> Changed Videos</a></li>
                 </ul>
             </div>
             <a href="#" @click.prevent="fetchFiles" class="btn btn-secondary btn-sm">Reload files</a>
@@ -96,19 +97,28 @@ export const PageFunctions = {
             // if we are in library url path we should use library api
             const scrollPosition = window.scrollY;
 
+            const done = () => {
+                sharedState.loading = false;
+                if (restoreScrollPosition) {
+                    setTimeout(() => window.scrollTo(0, scrollPosition));
+                }
+            };
+
             sharedState.loading = true;
-            apiCall('/api/list', { errorMessage: 'Error fetching files',
+            if (libraryGeneration === null) {
+                fetchAllFiles().then(done);
+                return;
+            }
+            // only fetch the changes since the last known library generation
+            apiCall(`/api/list/changes?since=${libraryGeneration}`, { errorMessage: 'Error fetching files',
                 onError: () => sharedState.loading = false, showToastMessage: false })
                 .then(data => {
-                    sharedState.files = data.map(file => ({
-                        ...file,
-                        showPreview: false,
-                    }));
-                    sharedState.loading = false;
-                    if (restoreScrollPosition) {
-                        setTimeout(() => window.scrollTo(0, scrollPosition));
+                    if (!data || data.full_resync) {
+                        return fetchAllFiles();
                     }
-                });
+                    applyFileChanges(data);
+                })
+                .then(done);
         }, 2000),
         findDuplicates() {
             sharedState.loading = true;
@@ -119,7 +129,7 @@ export const PageFunctions = {
                     if (data.error) {
                         showToast(data.message, { title: data.error });
                     } else {
-                        const output = `TODO: implement nice dialog.... found ${Object.keys(data).length} possible duplicates<br>${outputSimilarVideos(data)}`;
+                        const output = `TODO: implement nice dialog.... found ${data.length} groups of possible duplicates<br>${outputSimilarVideos(data)}`;
                         showToast(output, { stayOpen: true, asHtml: true, wide: true });
                     }
                 });
@@ -139,19 +149,52 @@ export const PageFunctions = {
     }
 }
 
+let libraryGeneration = null;
+
+function fetchAllFiles() {
+    return fetch('/api/list')
+        .then(response => {
+            const generation = response.headers.get('X-Library-Generation');
+            libraryGeneration = generation ? Number(generation) : null;
+            return response.json();
+        })
+        .then(data => {
+            sharedState.files = data.map(file => ({
+                ...file,
+                showPreview: false,
+            }));
+        })
+        .catch(error => {
+            console.error('Error fetching files', error);
+            showToast('Error fetching files');
+            libraryGeneration = null;
+        });
+}
+
+function applyFileChanges(data) {
+    libraryGeneration = data.generation;
+    if (!data.added.length && !data.changed.length && !data.removed.length) {
+        return;
+    }
+    const removed = new Set(data.removed);
+    const updated = new Map([...data.added, ...data.changed].map(file => [file.filename, file]));
+    const files = sharedState.files
+        .filter(file => !removed.has(file.filename) && !updated.has(file.filename));
+    updated.forEach(file => files.push({ ...file, showPreview: false }));
+    files.sort((a, b) => (b.created || 0) - (a.created || 0));
+    sharedState.files = files;
+}
+
 function outputSimilarVideos(data) {
     let htmlOutput = '<div class="similar-videos-container">';
-    for (const [videoPath, details] of Object.entries(data)) {
+    for (const cluster of data) {
         htmlOutput += `<div class="video-section">
-                <p>Video: ${details.file.title} [${videoPath}] has similar videos:</p>`;
-        const simData = details.similar;
-        if (simData) {
-            htmlOutput += '<ul>';
-            simData.forEach(similarVideo => {
-                htmlOutput += `<li><strong>Score:</strong> ${similarVideo.score} - <strong>Similar to:</strong> ${similarVideo.file.title} [${similarVideo.video_url}]</li>`;
-            });
-            htmlOutput += '</ul>';
-        }
+                <p>${cluster.videos.length} similar videos (best score ${cluster.score}):</p>`;
+        htmlOutput += '<ul>';
+        cluster.videos.forEach(video => {
+            htmlOutput += `<li>${video.file.title} [${video.video_url}]</li>`;
+        });
+        htmlOutput += '</ul>';
         htmlOutput += '</div>';
     }
     htmlOutput += '</div>';
@@ -73,6 +73,8 @@ const app = createApp({
 
             if (data.includes('Download finished') ||
               data.includes('Generate thumbnails finished') ||
+              data.includes('Library changed') ||
+              data.includes('Batch finished') ||
               data.includes(' 0.0% complete')) {
                 fetchFiles();
             }